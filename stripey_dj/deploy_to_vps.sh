@@ -54,10 +54,11 @@ EOF
     ssh django@${VPSHOSTNAME} "source venv_stripey/bin/activate && python import.py 2>&1"
 fi
 
-echo "Remove server picklify data? [y/N]"
+echo "Invalidate the server's cached data? [y/N]"
 read ok
 if [[ ${ok} == 'y' ]]; then
-    ssh www-data@${VPSHOSTNAME} "find .picklify -type f -delete 2>&1"
+    # Move on the data generation (see stripey_app/memoize.py)
+    ssh www-data@${VPSHOSTNAME} 'gen=$(cat .stripey_generation 2>/dev/null); echo $((${gen:-0} + 1)) > .stripey_generation.tmp && mv .stripey_generation.tmp .stripey_generation && rm -rf .picklify 2>&1'
 fi
 
     
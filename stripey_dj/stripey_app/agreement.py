@@ -0,0 +1,224 @@
+"""
+How often each pair of witnesses agree, from an algorithm's collation.
+
+A LabelMatrix has a row per hand and a column per variant unit, holding the
+label of the hand's reading in that unit (see Reading.label - 0 is an
+omission, which counts as a reading) or ABSENT where the hand doesn't have
+the verse. The pairwise agreements come from two matrix products, so a whole
+book of hundreds of witnesses takes seconds rather than an export to
+SplitsTree.
+"""
+
+import logging
+
+import numpy as np
+from django.utils.functional import cached_property
+
+from .memoize import memoize
+from .models import Book, Algorithm, Variant, StripeReading, MsStripe
+
+logger = logging.getLogger(__name__)
+
+# The cell for a variant unit a hand doesn't have
+ABSENT = -1
+
+
+def _verse_filter(prefix, book_obj, chapter_num=None, verse_num=None):
+    """
+    Return the filter kwargs for the verses in a range
+    """
+    ret = {prefix + '__chapter__book': book_obj}
+    if chapter_num is not None:
+        ret[prefix + '__chapter__num'] = chapter_num
+        if verse_num is not None:
+            ret[prefix + '__num'] = verse_num
+    return ret
+
+
+def join_stripes(ms_stripe_ids, stripe_ids):
+    """
+    Join MsStripes to the readings of their stripes, in numpy.
+
+    @param ms_stripe_ids: the stripe id of each MsStripe
+    @param stripe_ids: the stripe id of each StripeReading - in order
+    @returns: (left, right) arrays of indexes into the two, for every
+              pair with the same stripe id
+    """
+    ms_stripe_ids = np.asarray(ms_stripe_ids, dtype=np.int64)
+    uniques, starts, counts = np.unique(stripe_ids, return_index=True, return_counts=True)
+    if not len(uniques):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    stripes = np.minimum(np.searchsorted(uniques, ms_stripe_ids), len(uniques) - 1)
+    # (Stripes without any readings have nothing to join)
+    known = np.flatnonzero(uniques[stripes] == ms_stripe_ids)
+    stripes = stripes[known]
+    # Repeat each MsStripe once per reading of its stripe, then pair the
+    # repeats up with those readings
+    reps = counts[stripes]
+    ends = np.cumsum(reps)
+    right = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - reps - starts[stripes], reps)
+    return np.repeat(known, reps), right
+
+
+def count_agreement(labels):
+    """
+    Return (agree, compared) for a 2D array of labels (with ABSENT where a
+    row doesn't have a column) - square arrays of the number of columns in
+    which each pair of rows have the same label, and the number they both
+    have.
+    """
+    present = labels != ABSENT
+    rows, columns = np.nonzero(present)
+    # One column per (variant unit, label) that any row has
+    keys = columns.astype(np.int64) * (int(labels.max(initial=0)) + 1) + labels[rows, columns]
+    uniques, codes = np.unique(keys, return_inverse=True)
+    readings = np.zeros((labels.shape[0], len(uniques)), dtype=np.float32)
+    readings[rows, codes] = 1
+    present = present.astype(np.float32)
+    # Exact, as float32 holds whole numbers up to 2**24
+    agree = np.rint(readings @ readings.T).astype(np.int64)
+    compared = np.rint(present @ present.T).astype(np.int64)
+    return agree, compared
+
+
+class LabelMatrix(object):
+    """
+    The readings of every hand in a range of verses, by variant unit.
+    Duplicate verses (see MsVerse.item) only have their first reading.
+    """
+    def __init__(self, labels, hands, variants):
+        """
+        @param labels: 2D array of reading labels, a row per hand and a column
+                       per variant unit
+        @param hands: [(hand id, manuscript id, ga, hand name), ...] for the
+                      rows
+        @param variants: [(variant id, chapter num, verse num), ...] for the
+                         columns
+        """
+        self.labels = labels
+        self.hands = hands
+        self.variants = variants
+        self._rows = {x[0]: i for i, x in enumerate(hands)}
+
+    @classmethod
+    def build(cls, algorithm_obj, book_obj, chapter_num=None, verse_num=None):
+        """
+        Make the matrix for a range of verses from the collation tables
+        """
+        variants = list(Variant.objects.filter(algorithm=algorithm_obj,
+                                               **_verse_filter('verse', book_obj,
+                                                               chapter_num, verse_num))
+                        .order_by('verse__chapter__num', 'verse__num', 'variant_num')
+                        .values_list('id', 'verse__chapter__num', 'verse__num'))
+        columns = {x[0]: i for i, x in enumerate(variants)}
+
+        # [(stripe id, column, label)], in stripe order
+        stripe_readings = sorted(
+            (stripe_id, columns[variant_id], label) for stripe_id, variant_id, label in
+            StripeReading.objects.filter(algorithm=algorithm_obj,
+                                         **_verse_filter('stripe__verse', book_obj,
+                                                         chapter_num, verse_num))
+            .values_list('stripe_id', 'reading__variant_id', 'reading__label'))
+
+        hands = {}
+        seen = set()
+        ms_stripes = []  # [(hand id, stripe id)]
+        for hand_id, ms_id, ga, name, verse_id, stripe_id in (
+                MsStripe.objects.filter(algorithm=algorithm_obj,
+                                        **_verse_filter('ms_verse__verse', book_obj,
+                                                        chapter_num, verse_num))
+                .order_by('ms_verse__item', 'ms_verse_id')
+                .values_list('ms_verse__hand_id', 'ms_verse__hand__manuscript_id',
+                             'ms_verse__hand__manuscript__ga', 'ms_verse__hand__name',
+                             'ms_verse__verse_id', 'stripe_id')):
+            if (hand_id, verse_id) in seen:
+                continue
+            seen.add((hand_id, verse_id))
+            hands.setdefault(hand_id, (hand_id, ms_id, ga, name))
+            ms_stripes.append((hand_id, stripe_id))
+
+        hands = sorted(hands.values(), key=lambda x: (x[1], x[0]))
+        ret = cls(np.full((len(hands), len(variants)), ABSENT, dtype=np.int16), hands, variants)
+        if not ms_stripes or not stripe_readings:
+            return ret
+
+        stripe_readings = np.array(stripe_readings, dtype=np.int64)
+        rows = np.array([ret._rows[x[0]] for x in ms_stripes], dtype=np.int64)
+        left, right = join_stripes([x[1] for x in ms_stripes], stripe_readings[:, 0])
+        ret.labels[rows[left], stripe_readings[right, 1]] = stripe_readings[right, 2]
+        return ret
+
+    @cached_property
+    def agreement(self):
+        """
+        Return (agree, compared) - square arrays of the number of variant
+        units in which each pair of hands have the same reading, and the
+        number they both have.
+        """
+        return count_agreement(self.labels)
+
+    def closest(self, hand_id, k=10):
+        """
+        Return the k hands that agree most with this one (of those they
+        share any variant units with), closest first.
+
+        @returns: [(hand, agree, compared), ...] - hand being one of
+                  self.hands
+        """
+        if hand_id not in self._rows:
+            return []
+        i = self._rows[hand_id]
+        agree, compared = self.agreement
+        agree, compared = agree[i], compared[i]
+        others = np.flatnonzero(compared > 0)
+        others = others[others != i]
+        ratio = agree[others] / compared[others]
+        # Most agreement first, then most compared
+        order = others[np.lexsort((-compared[others], -ratio))][:k]
+        return [(self.hands[j], int(agree[j]), int(compared[j])) for j in order]
+
+    def profile(self, hand_id, window, others):
+        """
+        Return how much this hand agrees with others over a window of
+        variant units, sliding through the range. Each window's counts come
+        from the difference of two prefix sums, so it's one pass whatever
+        the size of the window.
+
+        @param window: the number of variant units in each window - all of
+                       them, if there aren't that many
+        @param others: the hand ids to compare with
+        @returns: array with a row per other hand, and a column per window
+                  (starting at each variant unit in turn) of the percentage
+                  of the units they both have in which they agree - or nan
+                  where they have none in common (which is all of them, if
+                  this hand has none of the variant units)
+        """
+        window = max(1, min(window, len(self.variants)))
+        if hand_id not in self._rows:
+            return np.full((len(others), len(self.variants) - window + 1), np.nan)
+        mine = self.labels[self._rows[hand_id]]
+        theirs = self.labels[[self._rows[x] for x in others]]
+        present = (theirs != ABSENT) & (mine != ABSENT)
+        agree = (theirs == mine) & present
+
+        def window_sums(x):
+            sums = np.zeros((x.shape[0], x.shape[1] + 1), dtype=np.int64)
+            np.cumsum(x, axis=1, out=sums[:, 1:])
+            return sums[:, window:] - sums[:, :-window]
+
+        compared = window_sums(present)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(compared > 0, 100.0 * window_sums(agree) / compared, np.nan)
+
+
+@memoize
+def get_label_matrix(bk, ch, v, al):
+    """
+    Return the LabelMatrix for a range of verses
+
+    @param bk: book num
+    @param ch: chapter num or None for all chapters
+    @param v: verse num or None for all verses
+    @param al: algorithm name
+    """
+    return LabelMatrix.build(Algorithm.objects.get(name=al), Book.objects.get(num=bk), ch, v)
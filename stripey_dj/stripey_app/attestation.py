@@ -0,0 +1,234 @@
+"""
+Which witnesses attest which readings, as bitmaps - so set questions about
+the witnesses ("where do P66 and 01 agree against 03?") are answered with
+bitwise operations over a whole book at once.
+
+An AttestationIndex is built for each book and algorithm after collating
+(see build_index), and queried with expressions like:
+
+    P66 and 01 and not 03
+    only @majuscules
+    (01 or 01:corrector) and not @papyri
+
+A witness is a manuscript's GA number, for its first hand, or GA:hand for
+another hand. A group (@papyri, @majuscules, @minuscules, @lectionaries or
+@special) stands for any of its hands. "only" takes a witness or group, and
+matches the readings that no other hands attest. Expressions are made of
+those with and, or, not and brackets. Note that "not 03" matches the readings
+03 doesn't attest - including those in verses it doesn't have.
+"""
+
+import re
+import json
+import logging
+
+import numpy as np
+
+from .memoize import memoize
+from .models import (Book, Algorithm, Reading, StripeReading, MsStripe,
+                     AttestationIndex)
+from .agreement import join_stripes
+
+logger = logging.getLogger(__name__)
+
+# Liste id ranges of the witness groups - as in the manuscript menu
+GROUPS = {'special': (0, 10000),
+          'papyri': (10000, 20000),
+          'majuscules': (20000, 30000),
+          'minuscules': (30000, 40000),
+          'lectionaries': (40000, None)}
+
+_token_re = re.compile(r"\(|\)|[^\s()]+")
+
+
+def build_index(algorithm_obj, book_obj):
+    """
+    (Re)build and store the AttestationIndex of a book's collation
+    """
+    readings = list(Reading.objects.filter(algorithm=algorithm_obj,
+                                           variant__verse__chapter__book=book_obj)
+                    .order_by('variant__verse__chapter__num', 'variant__verse__num',
+                              'variant__variant_num', 'label', 'id')
+                    .values_list('id', 'variant__verse__chapter__num', 'variant__verse__num',
+                                 'variant__variant_num', 'label', 'text'))
+    rows = {x[0]: i for i, x in enumerate(readings)}
+
+    # [(stripe id, row)], in stripe order
+    stripe_readings = np.array(sorted(
+        (stripe_id, rows[reading_id]) for stripe_id, reading_id in
+        StripeReading.objects.filter(algorithm=algorithm_obj,
+                                     stripe__verse__chapter__book=book_obj)
+        .values_list('stripe_id', 'reading_id')), dtype=np.int64).reshape(-1, 2)
+
+    hands = {}
+    ms_stripes = []  # [(hand id, stripe id)]
+    for hand_id, ms_id, ga, liste_id, name, stripe_id in (
+            MsStripe.objects.filter(algorithm=algorithm_obj,
+                                    ms_verse__verse__chapter__book=book_obj)
+            .values_list('ms_verse__hand_id', 'ms_verse__hand__manuscript_id',
+                         'ms_verse__hand__manuscript__ga',
+                         'ms_verse__hand__manuscript__liste_id',
+                         'ms_verse__hand__name', 'stripe_id')):
+        hands.setdefault(hand_id, (hand_id, ms_id, ga, liste_id, name))
+        ms_stripes.append((hand_id, stripe_id))
+    hands = sorted(hands.values(), key=lambda x: (x[3], x[1], x[0]))
+    columns = {x[0]: i for i, x in enumerate(hands)}
+
+    attested = np.zeros((len(readings), len(hands)), dtype=bool)
+    left, right = join_stripes([x[1] for x in ms_stripes], stripe_readings[:, 0])
+    hand_columns = np.array([columns[x[0]] for x in ms_stripes], dtype=np.int64)
+    attested[stripe_readings[right, 1], hand_columns[left]] = True
+
+    index, _ = AttestationIndex.objects.update_or_create(
+        algorithm=algorithm_obj, book=book_obj,
+        defaults={'hands': json.dumps(hands),
+                  'readings': json.dumps(readings),
+                  'bits': np.packbits(attested, axis=1).tobytes()})
+    logger.debug("Built the attestation index of {} ({}): {} readings, {} hands".format(
+                 book_obj.name, algorithm_obj.name, len(readings), len(hands)))
+    return index
+
+
+class Attestations(object):
+    """
+    An AttestationIndex, ready to query
+    """
+    def __init__(self, index):
+        self.hands = [tuple(x) for x in json.loads(index.hands)]
+        self.readings = [tuple(x) for x in json.loads(index.readings)]
+        width = (len(self.hands) + 7) // 8
+        self.bits = np.frombuffer(bytes(index.bits), dtype=np.uint8).reshape(
+            len(self.readings), width)
+        self._witnesses = {}
+        for i, (hand_id, ms_id, ga, liste_id, name) in enumerate(self.hands):
+            self._witnesses.setdefault(self._witness(ga, name).lower(), []).append(i)
+
+    @staticmethod
+    def _witness(ga, name):
+        return ga if name == 'firsthand' else '{}:{}'.format(ga, name)
+
+    def _mask(self, hand_indexes):
+        """
+        Return the packed bits with just these hands set
+        """
+        mask = np.zeros(len(self.hands), dtype=bool)
+        mask[hand_indexes] = True
+        return np.packbits(mask)
+
+    def witness_mask(self, token):
+        """
+        Return the packed bits of the hands a witness or @group stands for
+        """
+        token = token.lower()
+        if token.startswith('@'):
+            if token[1:] not in GROUPS:
+                raise ValueError("Unknown group {} - try one of: {}".format(
+                                 token, ', '.join('@' + x for x in sorted(GROUPS))))
+            low, high = GROUPS[token[1:]]
+            return self._mask([i for i, x in enumerate(self.hands)
+                               if x[3] >= low and (high is None or x[3] < high)])
+        if token not in self._witnesses:
+            raise ValueError("Unknown witness {}".format(token))
+        return self._mask(self._witnesses[token])
+
+    def attested_by(self, mask):
+        """
+        Return whether each reading is attested by any of the hands in mask
+        """
+        return (self.bits & mask).any(axis=1)
+
+    def query(self, expression):
+        """
+        Return whether each reading matches the expression (see the module
+        docstring)
+        """
+        tokens = _token_re.findall(expression)
+        if not tokens:
+            raise ValueError("Empty query")
+        ret, pos = self._or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError("Unexpected {}".format(tokens[pos]))
+        return ret
+
+    def _or(self, tokens, pos):
+        ret, pos = self._and(tokens, pos)
+        while pos < len(tokens) and tokens[pos].lower() == 'or':
+            other, pos = self._and(tokens, pos + 1)
+            ret = ret | other
+        return ret, pos
+
+    def _and(self, tokens, pos):
+        ret, pos = self._not(tokens, pos)
+        while pos < len(tokens) and tokens[pos].lower() == 'and':
+            other, pos = self._not(tokens, pos + 1)
+            ret = ret & other
+        return ret, pos
+
+    def _not(self, tokens, pos):
+        if pos >= len(tokens):
+            raise ValueError("Unexpected end of query")
+        token = tokens[pos]
+        if token.lower() == 'not':
+            ret, pos = self._not(tokens, pos + 1)
+            return ~ret, pos
+        if token == '(':
+            ret, pos = self._or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise ValueError("Missing )")
+            return ret, pos + 1
+        if token.lower() == 'only':
+            if pos + 1 >= len(tokens):
+                raise ValueError("Unexpected end of query")
+            mask = self.witness_mask(tokens[pos + 1])
+            # (The padding bits of ~mask are harmless, as no reading has them)
+            return self.attested_by(mask) & ~self.attested_by(~mask), pos + 2
+        if token == ')' or token.lower() in ('and', 'or'):
+            raise ValueError("Unexpected {}".format(token))
+        return self.attested_by(self.witness_mask(token)), pos + 1
+
+    def witnesses(self, row):
+        """
+        Return the witnesses that attest a reading
+        """
+        attested = np.unpackbits(self.bits[row])[:len(self.hands)]
+        return [self._witness(self.hands[i][2], self.hands[i][4]) for i in np.flatnonzero(attested)]
+
+    def units(self, expression, limit=None):
+        """
+        Return the variant units with readings that match the expression
+
+        @param limit: (optional) the most units to return
+        @returns: (number of units, [(chapter num, verse num, variant num,
+                                      [(label, text, [witness, ...]), ...]), ...])
+        """
+        ret = []
+        count = 0
+        unit = None
+        for row in np.flatnonzero(self.query(expression)):
+            reading_id, chapter_num, verse_num, variant_num, label, text = self.readings[row]
+            if unit != (chapter_num, verse_num, variant_num):
+                unit = (chapter_num, verse_num, variant_num)
+                count += 1
+                if limit is None or count <= limit:
+                    ret.append(unit + ([], ))
+            if limit is None or count <= limit:
+                ret[-1][3].append((label, text, self.witnesses(row)))
+        return count, ret
+
+
+@memoize
+def get_attestations(bk, al):
+    """
+    Return the Attestations of a book's collation - building its index if
+    it hasn't been built
+
+    @param bk: book num
+    @param al: algorithm name
+    """
+    book_obj = Book.objects.get(num=bk)
+    algorithm_obj = Algorithm.objects.get(name=al)
+    try:
+        index = AttestationIndex.objects.get(algorithm=algorithm_obj, book=book_obj)
+    except AttestationIndex.DoesNotExist:
+        index = build_index(algorithm_obj, book_obj)
+    return Attestations(index)
@@ -1,86 +1,429 @@
 import threading
 import pickle as pickle
 import os
+import sys
 import time
+import json
+import zlib
+import fcntl
 import hashlib
+import tempfile
+import functools
+import logging
+import weakref
+from collections import OrderedDict
 
+logger = logging.getLogger(__name__)
 
-class memoize(dict):
+HOME = os.environ.get('HOME', '/var/www')
+# Defaults for memoize - override them per function if need be. Sizes are
+# only worked out (by pickling each value) for functions with a max_bytes.
+MAX_ENTRIES = 256
+MAX_BYTES = None
+# Holds the data generation number, which bump_generation increments after
+# the data changes - so every cache, in every process, knows it's out of
+# date. They all need to agree on where it is.
+GENERATION_FILE = os.environ.get('STRIPEY_GENERATION_FILE',
+                                 os.path.join(HOME, '.stripey_generation'))
+# How long (in seconds) to go on using the generation number we last read,
+# before reading the file again to see if another process has moved it on
+GENERATION_CHECK_INTERVAL = 1.0
+# Defaults for diskcache
+DISKCACHE_FOLDER = os.path.join(HOME, '.diskcache')
+DISKCACHE_MAX_BYTES = 1024 * 1024 * 1024
+COMPRESS_LEVEL = 6
+# Keys share this many lock files, for filling the diskcache one at a time
+LOCK_STRIPES = 256
+# Temp files older than this (in seconds) are left over from a crash
+TEMP_MAXAGE = 3600
+
+
+def _sizeof(value):
+    """
+    Roughly how big is this value? Its pickled size will do.
+    """
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+def _atomic_write(path, data):
+    """
+    Write data (bytes) to path, so nobody ever sees a half-written file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# (GENERATION_FILE, time.monotonic() when we read it, generation number)
+_last_generation = (None, 0, 0)
+
+
+def _read_generation():
+    try:
+        with open(GENERATION_FILE, 'rb') as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def data_generation():
+    """
+    Return the current data generation number - as of the last
+    GENERATION_CHECK_INTERVAL seconds, so we aren't reading the file on
+    every call
+    """
+    global _last_generation
+    path, checked, generation = _last_generation
+    now = time.monotonic()
+    if path != GENERATION_FILE or now - checked >= GENERATION_CHECK_INTERVAL:
+        generation = _read_generation()
+        _last_generation = (GENERATION_FILE, now, generation)
+    return generation
+
+
+def bump_generation():
+    """
+    Move on to a new data generation, and return its number
+    """
+    global _last_generation
+    with open(GENERATION_FILE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = _read_generation() + 1
+        _atomic_write(GENERATION_FILE, str(generation).encode('ascii'))
+        _last_generation = (GENERATION_FILE, time.monotonic(), generation)
+    return generation
+
+
+class _Flight(object):
+    """
+    A calculation in progress, for callers with the same args to wait for
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class memoize(object):
     """
     A memoize decorator based on:
      http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
 
-    But with added locking - so we only calculate things once...
+    But with added locking - so we only calculate things once, while callers
+    with different args don't wait for each other - and bounded,
+    with least recently used entries evicted once there are more than
+    max_entries or (if set) they take up more than max_bytes. Entries older
+    than ttl seconds (if set) are recalculated.
+
+    Use it as @memoize, or @memoize(max_entries=..., max_bytes=..., ttl=...)
     """
-    def __init__(self, func):
+    # Every memoized function, for invalidate_all
+    instances = weakref.WeakSet()
+
+    def __init__(self, func=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=None):
+        self.func = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data_lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+        self.instances.add(self)
+        if func is not None:
+            self._wrap(func)
+
+    def _wrap(self, func):
         self.func = func
-        self.lock = threading.Lock()
+        # Not __dict__ - func might be another decorator
+        functools.update_wrapper(self, func, updated=())
+        return self
+
+    def clear(self):
+        """
+        Forget everything
+        """
+        with self._data_lock:
+            self._cache = OrderedDict()  # {args: (value, size, time)}
+            self.bytes = 0
+            self._data_generation = data_generation()
+            # Calculations already in progress won't store their results, and
+            # new callers won't wait for them
+            self._flights = {}  # {args: _Flight}
+            self._generation += 1
+
+    def invalidate(self, *args):
+        """
+        Forget the result for these args
+        """
+        with self._data_lock:
+            if args in self._cache:
+                self.bytes -= self._cache.pop(args)[1]
+
+    @classmethod
+    def invalidate_all(cls):
+        """
+        Forget everything in every memoized function - in this process and,
+        the next time they're called, in any others. This also moves on the
+        data generation, so everything in the diskcache is out of date. Call
+        this after changing the data, e.g. loading or collating.
+        """
+        bump_generation()
+        for instance in cls.instances:
+            instance.clear()
+
+    def stats(self):
+        return {'entries': len(self._cache),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _get(self, key):
+        """
+        Return (True, value) if we have an up to date value, or (False, None).
+        The caller must hold _data_lock.
+        """
+        if key not in self._cache:
+            return False, None
+        value, size, created = self._cache[key]
+        if self.ttl is not None and time.time() - created > self.ttl:
+            del self._cache[key]
+            self.bytes -= size
+            return False, None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def _put(self, key, value, generation):
+        size = _sizeof(value) if self.max_bytes is not None else 0
+        with self._data_lock:
+            if generation != self._generation:
+                # We've been cleared since this calculation started
+                return
+            self._cache[key] = (value, size, time.time())
+            self.bytes += size
+            # Evict the least recently used - but always keep the new one
+            while len(self._cache) > 1 and (len(self._cache) > self.max_entries or
+                                            (self.max_bytes is not None and
+                                             self.bytes > self.max_bytes)):
+                old_key, (old_value, old_size, old_time) = self._cache.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+                logger.debug("Evicted {}{} ({} bytes)".format(self.func.__name__, old_key, old_size))
 
     def __call__(self, *args):
-        return self[args]
+        if self.func is None:
+            # We're being used as @memoize(...) - so this is the function
+            return self._wrap(*args)
 
-    def __missing__(self, key):
-        with self.lock:
-            result = self[key] = self.func(*key)
-            return result
+        if data_generation() != self._data_generation:
+            # Someone has invalidated everything
+            self.clear()
+
+        with self._data_lock:
+            hit, value = self._get(args)
+            if hit:
+                return value
+            flight = self._flights.get(args)
+            if flight is None:
+                # It's up to us to calculate it
+                leader = True
+                flight = self._flights[args] = _Flight()
+                generation = self._generation
+                self.misses += 1
+            else:
+                leader = False
+
+        if not leader:
+            # Wait for someone else to calculate it
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self.func(*args)
+            self._put(args, flight.value, generation)
+            return flight.value
+        except BaseException as e:
+            # Everyone waiting gets the exception - but we don't cache it
+            flight.error = e
+            raise
+        finally:
+            with self._data_lock:
+                if self._flights.get(args) is flight:
+                    del self._flights[args]
+            flight.done.set()
 
 
-class picklify(object):
+def _plain(arg):
     """
-    A picklify decorator that does memoization but in pickles on disk,
-    rather than in memory.
+    Return a stable, JSON-able version of arg for a cache key - Django model
+    instances are represented by their primary key.
+    """
+    if hasattr(arg, '_meta') and hasattr(arg, 'pk'):
+        return [arg._meta.label, arg.pk]
+    if isinstance(arg, (list, tuple)):
+        return [_plain(x) for x in arg]
+    return arg
 
-    The in-memory dictionary is a map of args to pickle file.
 
-    This also has locking, so you can only use it one at a time.
+class diskcache(object):
     """
-    if 'HOME' not in os.environ:
-        print("Forcing HOME to be /var/www")
-        os.environ['HOME'] = "/var/www"
-    FOLDER = os.path.join(os.environ.get('HOME'), '.picklify')
-    MAXAGE = 24 * 3600 * 14  # a fortnight
+    A memoize decorator that keeps results on disk, so they survive restarts
+    and are shared between processes.
+
+    Results are stored compressed, as plain data (anything json can do) -
+    dump and load, if given, convert the function's results to and from that.
+    The key is made of the function's name, its args (with model instances
+    as their primary key) and the data generation - so everything is out of
+    date once the data changes (see bump_generation). Files are written
+    atomically, and the least recently used are removed once they all take
+    up more than max_bytes.
+
+    Only one process calculates a result at a time - any others wanting it
+    wait for it, and then load it.
 
-    def __init__(self, func):
+    Use it as @diskcache, or @diskcache(folder=..., max_bytes=..., dump=..., load=...)
+    """
+    def __init__(self, func=None, folder=None, max_bytes=DISKCACHE_MAX_BYTES,
+                 dump=None, load=None):
+        self.func = None
+        self._folder = folder
+        self.max_bytes = max_bytes
+        self.dump = dump
+        self.load = load
+        if func is not None:
+            self._wrap(func)
+
+    def _wrap(self, func):
         self.func = func
-        self.lock = threading.Lock()
-        if not os.path.exists(self.FOLDER):
-            os.mkdir(self.FOLDER)
+        functools.update_wrapper(self, func, updated=())
+        return self
 
-        self.mapping = {}
+    @property
+    def folder(self):
+        return self._folder or DISKCACHE_FOLDER
 
-    def _get_pickle_file(self, args):
-        if args in self.mapping:
-            return self.mapping[args]
+    def _paths(self, args, generation):
+        """
+        Return the paths of the cache file and lock file for these args
+        """
+        key = json.dumps([self.func.__module__, self.func.__qualname__, _plain(args)],
+                         sort_keys=True)
+        myhash = hashlib.sha224(key.encode('utf8')).hexdigest()
+        stripe = int(myhash, 16) % LOCK_STRIPES
+        return (os.path.join(self.folder, "{}-{}.json.z".format(generation, myhash)),
+                os.path.join(self.folder, ".lock-{}".format(stripe)))
 
-        myhash = hashlib.sha224(str(args).encode('iso8859-1')).hexdigest()
-        pickle_file = os.path.join(self.FOLDER, myhash)
-        self.mapping[args] = pickle_file
-        return pickle_file
+    def _load(self, path):
+        """
+        Return (True, value) if it's in the cache, or (False, None)
+        """
+        try:
+            with open(path, 'rb') as f:
+                value = json.loads(zlib.decompress(f.read()).decode('utf8'))
+        except FileNotFoundError:
+            return False, None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning("Ignoring bad cache file {}: {}".format(path, e))
+            return False, None
+        if self.load is not None:
+            value = self.load(value)
+        # For the least recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return True, value
 
-    def __call__(self, *args):
-        pickle_file = self._get_pickle_file(args)
-        if os.path.exists(pickle_file):
-            mtime = os.path.getmtime(self.mapping[args])
-            if time.time() - mtime <= self.MAXAGE:
-                # Get the pickled version
-                with open(self.mapping[args], 'rb') as pf:
-                    print((" - unpickle <- {}".format(self.mapping[args])))
-                    return pickle.load(pf)
+    def _evict(self, generation):
+        """
+        Remove files from old generations, and then the least recently used,
+        until we're within max_bytes.
+        """
+        current = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.folder):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Someone else got there first
+                continue
+            if entry.name.startswith('.lock-'):
+                continue
+            elif entry.name.startswith('.tmp-'):
+                old = now - stat.st_mtime > TEMP_MAXAGE
+            else:
+                old = not entry.name.startswith("{}-".format(generation))
+            if old:
+                self._unlink(entry.path)
             else:
-                # Too old - delete it
-                os.unlink(pickle_file)
+                current.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
 
-        # We're still here - so get fresh data and store it
-        with self.lock:
-            result = self.func(*args)
-            with open(pickle_file, 'wb') as pf:
-                print((" - pickle -> {}".format(pickle_file)))
-                pickle.dump(result, pf)
-            return result
+        current.sort()
+        while len(current) > 1 and total > self.max_bytes:
+            mtime, size, path = current.pop(0)
+            self._unlink(path)
+            total -= size
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+            logger.debug("Evicted {}".format(path))
+        except FileNotFoundError:
+            pass
+
+    def __call__(self, *args):
+        if self.func is None:
+            # We're being used as @diskcache(...) - so this is the function
+            return self._wrap(*args)
+
+        generation = data_generation()
+        path, lock_path = self._paths(args, generation)
+        hit, value = self._load(path)
+        if hit:
+            return value
+
+        os.makedirs(self.folder, exist_ok=True)
+        with open(lock_path, 'a') as lock:
+            # If someone else is calculating it, wait for them and use theirs
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            hit, value = self._load(path)
+            if hit:
+                return value
+
+            value = self.func(*args)
+            plain = self.dump(value) if self.dump is not None else value
+            data = zlib.compress(json.dumps(plain).encode('utf8'), COMPRESS_LEVEL)
+            _atomic_write(path, data)
+
+        self._evict(generation)
+        return value
 
 
 if __name__ == "__main__":
-    @picklify
+    @memoize(max_entries=2)
+    def square(a):
+        return a * a
+
+    print((square(1), square(2), square(1), square(3), square(2)))
+    print((square.stats()))
+
+    @diskcache(folder=tempfile.mkdtemp())
     def test(a, b):
         return {'a': a, 'b': b}
 
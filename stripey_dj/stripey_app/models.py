@@ -1,18 +1,23 @@
 # coding=UTF-8
 
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ObjectDoesNotExist
 try:
     from stripey_lib import xmlmss
 except ImportError:
     xmlmss = None
 
-from django.db.models import Max
-from .memoize import memoize, picklify
+from django.db.models import Max, Prefetch
+from django.utils.functional import cached_property
+from .memoize import memoize, diskcache
 
 import Levenshtein
+import numpy as np
 import unicodedata
+import hashlib
+import json
 import logging
+from collections import defaultdict
 logger = logging.getLogger('stripey_app.models')
 
 
@@ -43,6 +48,17 @@ test_out = "ουκ ην εκεινος το φως αλλ ινα μαρτυρη
 assert strip_accents(test_in) == test_out, "ERROR: \n{}\n{}".format(test_in, test_out)
 
 
+def normalize_text(raw_text):
+    """
+    Convert the raw text into whatever stripped form we want
+    """
+    if SHOW_ACCENTS == 'none':
+        # Strip out anything that isn't a normal character
+        return strip_accents(raw_text)
+    else:
+        return raw_text
+
+
 class ManuscriptTranscription(models.Model):
     ms_ref = models.CharField(max_length=10, unique=True)
     ms_name = models.CharField(max_length=50, blank=True)
@@ -130,7 +146,7 @@ class ManuscriptTranscription(models.Model):
                         ms_verse.verse = db_verse
                         ms_verse.hand = db_hand
                         ms_verse.item = j
-                        ms_verse.raw_text = text
+                        ms_verse.verse_text = VerseText.intern(text)
                         ms_verse.save()
 
         self.save()
@@ -192,21 +208,19 @@ class ManuscriptTranscription(models.Model):
         more than once.
         """
         v_d = {}
-        for hand in Hand.objects.filter(manuscript=self):
-            if verse_num is None:
-                verses = MsVerse.objects.filter(verse__chapter=chapter_obj,
-                                                hand=hand,
-                                                ).order_by('verse__num')
-            else:
-                verses = MsVerse.objects.filter(verse__chapter=chapter_obj,
-                                                hand=hand,
-                                                verse__num=verse_num)
-            for verse in verses:
-                me = v_d.get(verse.verse.num)
-                if not me:
-                    me = []
-                    v_d[verse.verse.num] = me
-                me.append(verse)
+        verses = (MsVerse.objects.filter(verse__chapter=chapter_obj, hand__manuscript=self)
+                  .select_related('hand', 'verse', 'verse_text')
+                  .order_by('verse__num', 'hand_id', 'id'))
+        if verse_num is not None:
+            verses = verses.filter(verse__num=verse_num)
+
+        for verse in verses:
+            verse.hand.manuscript = self
+            me = v_d.get(verse.verse.num)
+            if not me:
+                me = []
+                v_d[verse.verse.num] = me
+            me.append(verse)
 
         ret = []
         keys = list(v_d.keys())
@@ -263,22 +277,50 @@ class Verse(models.Model):
                                        self.num)
 
 
+class VerseText(models.Model):
+    """
+    A witness text of a verse - stored once, however many witnesses have
+    it, and looked up by the hash of its raw text. See intern().
+    """
+    hash = models.CharField(max_length=56, unique=True)  # sha224 of raw
+    raw = models.CharField(max_length=1000)
+    normalized = models.CharField(max_length=1000)  # see normalize_text
+
+    @staticmethod
+    def text_hash(raw_text):
+        return hashlib.sha224(raw_text.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def intern(cls, raw_text):
+        """
+        Return the VerseText for this raw text, making it if need be
+        """
+        obj, _ = cls.objects.get_or_create(
+            hash=cls.text_hash(raw_text),
+            defaults={'raw': raw_text, 'normalized': normalize_text(raw_text)})
+        return obj
+
+    def __repr__(self):
+        return "VerseText: {}".format(self.raw)
+
+
 class MsVerse(models.Model):
     verse = models.ForeignKey(Verse)
     hand = models.ForeignKey(Hand)
     item = models.IntegerField()  # for "duplicate" verses
-    raw_text = models.CharField(max_length=1000)
+    verse_text = models.ForeignKey(VerseText)
+
+    @property
+    def raw_text(self):
+        return self.verse_text.raw
+
+    @raw_text.setter
+    def raw_text(self, value):
+        self.verse_text = VerseText.intern(value)
 
     @property
     def text(self):
-        """
-        Convert the raw text into whatever stripped form we want
-        """
-        if SHOW_ACCENTS == 'none':
-            # Strip out anything that isn't a normal character
-            return strip_accents(self.raw_text)
-        else:
-            return self.raw_text
+        return self.verse_text.normalized
 
     def __repr__(self):
         return "MsVerse: ms:{}, hand:{}, verse:{} ({})".format(
@@ -309,12 +351,18 @@ class Reading(models.Model):
     variant = models.ForeignKey(Variant)
     text = models.CharField(max_length=1000)
     label = models.IntegerField()
+    # The variant's algorithm - so that all the collation tables can be
+    # filtered, and partitioned, by algorithm without joins
+    algorithm = models.ForeignKey(Algorithm)
     unique_together = (variant, text, label)
 
     def save(self):
         """
         Save the object - setting a label if there's isn't one already
         """
+        if self.algorithm_id is None:
+            self.algorithm_id = self.variant.algorithm_id
+
         if not self.label:
             if not self.text:
                 self.label = 0
@@ -336,7 +384,7 @@ class Stripe(models.Model):
     A Stripe is a generic mapping of verse to reading. A stripe
     """
     verse = models.ForeignKey(Verse)
-    readings = models.ManyToManyField(Reading)
+    readings = models.ManyToManyField(Reading, through='StripeReading')
     algorithm = models.ForeignKey(Algorithm)
 
     def save(self, *args):
@@ -352,18 +400,232 @@ class Stripe(models.Model):
         return ret
 
 
+class StripeReading(models.Model):
+    """
+    The many-to-many mapping of stripes to readings - with the algorithm,
+    like the other collation tables.
+    """
+    stripe = models.ForeignKey(Stripe)
+    reading = models.ForeignKey(Reading)
+    algorithm = models.ForeignKey(Algorithm)
+
+    class Meta:
+        # The table django made for Stripe.readings before we had this model
+        db_table = 'stripey_app_stripe_readings'
+        unique_together = ('stripe', 'reading')
+
+    def save(self, *args):
+        if self.algorithm_id is None:
+            self.algorithm_id = self.stripe.algorithm_id
+        return super(StripeReading, self).save(*args)
+
+
 class MsStripe(models.Model):
     """
     An MsStripe is a many-to-many mapping of hands to stripes.
     """
     stripe = models.ForeignKey(Stripe)
     ms_verse = models.ForeignKey(MsVerse)
+    algorithm = models.ForeignKey(Algorithm)
+
+    def save(self, *args):
+        if self.algorithm_id is None:
+            self.algorithm_id = self.stripe.algorithm_id
+        return super(MsStripe, self).save(*args)
 
     def __repr__(self):
         return "MsStripe: ms_verse {}, stripe {}".format(self.ms_verse,
                                                           self.stripe)
 
 
+class CollationSnapshot(models.Model):
+    """
+    A denormalized copy of one algorithm's collation of one verse - its
+    stripes with their readings and witnesses, and the similarity of their
+    texts - for the web app to read in one go. See materialize().
+    """
+    verse = models.ForeignKey(Verse)
+    algorithm = models.ForeignKey(Algorithm)
+    data = models.TextField()  # JSON - see _snapshot_data
+
+    class Meta:
+        unique_together = ('algorithm', 'verse')
+
+    @cached_property
+    def _data(self):
+        return json.loads(self.data)
+
+    @property
+    def matrix(self):
+        """
+        The SimilarityMatrix of the stripes' texts (see stripe_text), by
+        stripe id
+        """
+        return SimilarityMatrix.from_plain(self._data['similarity'])
+
+    def stripes(self, mss):
+        """
+        Return [(stripe, readings, ms_stripes), ...] from the snapshot, with
+        the related objects all filled in.
+
+        @param mss: {id: ManuscriptTranscription} to share manuscripts between
+                    snapshots - new ones are added to it
+        """
+        ret = []
+        for stripe, readings, ms_stripes in self._data['stripes']:
+            stripe = _from_plain(Stripe, stripe)
+            stripe.verse = self.verse
+            readings = [_from_plain(Reading, x) for x in readings]
+            my_ms_stripes = []
+            for ms_stripe, ms_verse, hand, ms in ms_stripes:
+                ms_stripe = _from_plain(MsStripe, ms_stripe)
+                ms_stripe.stripe = stripe
+                ms_stripe.ms_verse = _from_plain(MsVerse, ms_verse)
+                ms_stripe.ms_verse.verse = self.verse
+                ms_stripe.ms_verse.hand = _from_plain(Hand, hand)
+                ms_stripe.ms_verse.hand.manuscript = mss.setdefault(
+                    ms['id'], _from_plain(ManuscriptTranscription, ms))
+                my_ms_stripes.append(ms_stripe)
+            ret.append((stripe, readings, my_ms_stripes))
+        return ret
+
+
+class AttestationIndex(models.Model):
+    """
+    Which hands attest each of one algorithm's readings in one book - a row
+    of bits per reading, with a bit per hand. See attestation.py.
+    """
+    book = models.ForeignKey(Book)
+    algorithm = models.ForeignKey(Algorithm)
+    # JSON [[hand id, ms id, ga, liste id, hand name], ...] - one per bit
+    hands = models.TextField()
+    # JSON [[reading id, chapter num, verse num, variant num, label, text], ...]
+    # - one per row
+    readings = models.TextField()
+    bits = models.BinaryField()  # numpy.packbits of the rows
+
+    class Meta:
+        unique_together = ('algorithm', 'book')
+
+
+class CharacterMatrix(models.Model):
+    """
+    The labels of each witness's readings of one algorithm's variant units
+    in one book, ready for NEXUS files - an int8 row per witness, with a
+    column per variant unit. See nexus.py.
+    """
+    book = models.ForeignKey(Book)
+    algorithm = models.ForeignKey(Algorithm)
+    # JSON [[ga, hand name], ...] - one per row, as NEXUS taxa
+    witnesses = models.TextField()
+    # JSON [[chapter num, verse num, first column, end column], ...] - in order
+    verses = models.TextField()
+    labels = models.BinaryField()  # the int8 array
+    present = models.BinaryField()  # numpy.packbits of which rows have which verses
+
+    class Meta:
+        unique_together = ('algorithm', 'book')
+
+
+def similarity(text_a, text_b):
+    """
+    Return the similarity of two texts, as a percentage (the Levenshtein
+    ratio)
+    """
+    return Levenshtein.ratio(text_a if text_a else '',
+                             text_b if text_b else '') * 100.0
+
+
+class SimilarityMatrix(object):
+    """
+    The similarity between every pair of a list of texts, so we can look
+    it up rather than work it out. The texts are known by their ids (e.g.
+    VerseText ids), and each similarity is kept as a whole percentage, in
+    a uint8. The similarity is symmetric, so we only keep the upper
+    triangle.
+    """
+    def __init__(self, ids, ratios):
+        self.ids = list(ids)
+        self._index = {x: i for i, x in enumerate(self.ids)}
+        self.ratios = np.asarray(ratios, dtype=np.uint8)
+
+    @classmethod
+    def build(cls, texts):
+        """
+        Work out the similarities of some texts
+
+        @param texts: {id: text}
+        """
+        ids = sorted(texts)
+        return cls(ids, [round(similarity(texts[a], texts[b])) for i, a in enumerate(ids)
+                         for b in ids[i + 1:]])
+
+    def to_plain(self):
+        return {'ids': self.ids, 'ratios': self.ratios.tolist()}
+
+    @classmethod
+    def from_plain(cls, data):
+        return cls(data['ids'], data['ratios'])
+
+    def __call__(self, id_a, id_b):
+        """
+        Return the similarity of the texts with these ids, or None if we
+        don't know one of them
+        """
+        i = self._index.get(id_a)
+        j = self._index.get(id_b)
+        if i is None or j is None:
+            return None
+        if i == j:
+            return 100.0
+        if i > j:
+            i, j = j, i
+        return float(self.ratios[i * len(self.ids) - i * (i + 1) // 2 + j - i - 1])
+
+
+class VerseSimilarity(models.Model):
+    """
+    The SimilarityMatrix of the texts of all the witnesses to a verse, by
+    VerseText id - see update_similarities().
+    """
+    verse = models.OneToOneField(Verse)
+    verse_texts = models.TextField()  # JSON [VerseText id, ...] - sorted
+    ratios = models.BinaryField()  # SimilarityMatrix.ratios
+
+    @property
+    def matrix(self):
+        return SimilarityMatrix(json.loads(self.verse_texts),
+                                np.frombuffer(bytes(self.ratios), dtype=np.uint8))
+
+
+def update_similarities(verses):
+    """
+    (Re)build the similarity matrices of these verses - skipping those
+    whose texts haven't changed.
+
+    @param verses: a queryset of verses
+    @returns: the number of matrices built
+    """
+    texts = defaultdict(dict)
+    for verse_id, text_id, text in (MsVerse.objects.filter(verse__in=verses)
+                                    .values_list('verse_id', 'verse_text_id',
+                                                 'verse_text__normalized').distinct()):
+        texts[verse_id][text_id] = text
+    existing = dict(VerseSimilarity.objects.filter(verse__in=verses)
+                    .values_list('verse_id', 'verse_texts'))
+
+    count = 0
+    for verse_id in sorted(texts):
+        if verse_id in existing and json.loads(existing[verse_id]) == sorted(texts[verse_id]):
+            continue
+        matrix = SimilarityMatrix.build(texts[verse_id])
+        VerseSimilarity.objects.update_or_create(
+            verse_id=verse_id,
+            defaults={'verse_texts': json.dumps(matrix.ids), 'ratios': matrix.ratios.tobytes()})
+        count += 1
+    return count
+
+
 def _get_book(name, num):
     """
     Retrieve or create the specified book
@@ -438,7 +700,61 @@ def _get_hand(ms, hand, order_of_hands):
     return db_hand
 
 
+def _to_plain(obj):
+    """
+    Return a model instance's fields as plain data, for the diskcache
+    """
+    return {f.attname: getattr(obj, f.attname) for f in obj._meta.concrete_fields}
+
+
+def _from_plain(model, fields):
+    """
+    Make a model instance from _to_plain's fields
+    """
+    return model(**fields)
+
+
+def _dump_all_verses(all_verses):
+    """
+    Convert the results of get_all_verses to plain data
+    """
+    mss = {}
+    ret = []
+    for v, verse_mss in all_verses:
+        plain_mss = []
+        for ms, verses in verse_mss:
+            mss[ms.id] = _to_plain(ms)
+            plain_mss.append([ms.id, [[_to_plain(x), _to_plain(x.hand), _to_plain(x.verse),
+                                       _to_plain(x.verse_text), x.similarity] for x in verses]])
+        ret.append([v, plain_mss])
+    return {'mss': list(mss.values()), 'verses': ret}
+
+
+def _load_all_verses(data):
+    """
+    Convert the results of _dump_all_verses back into get_all_verses' form
+    """
+    mss = {x['id']: _from_plain(ManuscriptTranscription, x) for x in data['mss']}
+    all_verses = []
+    for v, plain_mss in data['verses']:
+        verse_mss = []
+        for ms_id, verses in plain_mss:
+            ms_verses = []
+            for ms_verse, hand, verse, verse_text, similarity in verses:
+                ms_verse = _from_plain(MsVerse, ms_verse)
+                ms_verse.hand = _from_plain(Hand, hand)
+                ms_verse.hand.manuscript = mss[ms_id]
+                ms_verse.verse = _from_plain(Verse, verse)
+                ms_verse.verse_text = _from_plain(VerseText, verse_text)
+                ms_verse.similarity = similarity
+                ms_verses.append(ms_verse)
+            verse_mss.append((mss[ms_id], ms_verses))
+        all_verses.append((v, verse_mss))
+    return all_verses
+
+
 @memoize
+@diskcache(dump=_dump_all_verses, load=_load_all_verses)
 def get_all_verses(book_obj, chapter_obj, base_ms_id=None, verse_num=None):
     """
     Return all verses in a particular chapter, in this form:
@@ -460,7 +776,6 @@ def get_all_verses(book_obj, chapter_obj, base_ms_id=None, verse_num=None):
      (2,
       [...]]
     """
-    all_mss = ManuscriptTranscription.objects.all()
     base_ms = None
     if base_ms_id:
         try:
@@ -472,40 +787,50 @@ def get_all_verses(book_obj, chapter_obj, base_ms_id=None, verse_num=None):
         # We still need one - so pick the first we get...
         base_ms = ManuscriptTranscription.objects.all()[0]
 
-    base_texts = base_ms.get_text(book_obj, chapter_obj)
-    sorters = {}
-    for x in base_texts:
-        first_hands = [i.text for i in x[1] if i.hand.name == 'firsthand']
-        base = first_hands[0] if first_hands else (x[1][0].text if x[1] else '')
-        sorters[x[0]] = TextSorter(base)
+    # Get everything in one go, in the order we want it
+    ms_verses = (MsVerse.objects.filter(verse__chapter=chapter_obj)
+                 .select_related('hand__manuscript', 'verse', 'verse_text')
+                 .order_by('verse__num', 'hand__manuscript_id', 'hand_id', 'id'))
+    if verse_num is not None:
+        ms_verses = ms_verses.filter(verse__num=verse_num)
+
+    # The precomputed similarities of the texts, where we have them
+    matrices = VerseSimilarity.objects.filter(verse__chapter=chapter_obj).select_related('verse')
+    if verse_num is not None:
+        matrices = matrices.filter(verse__num=verse_num)
+    matrices = {x.verse.num: x.matrix for x in matrices}
 
+    # {verse num: {ms id: (ms, [ms_verse, ...])}}
     vs_d = {}
-    for ms in all_mss:
-        # If verse_num == None, then this will get everything in the chapter
-        verses = ms.get_text(book_obj, chapter_obj, verse_num)
-        #  [(1,[verse obj, verse obj, ...]),
-        #   (2,[verse obj]),
-        #   ...]
-        for v in verses:
-            for ms_verse in v[1]:
-                if base_ms is not None:
-                    my_sorter = sorters.get(v[0])
-                    if my_sorter:
-                        ms_verse.similarity = my_sorter(ms_verse.text)
-                    else:
-                        # The base text doesn't exist in this verse
-                        ms_verse.similarity = ''
-            me = vs_d.get(v[0])
-            if not me:
-                me = []
-                vs_d[v[0]] = me
-            me.append((ms, v[1]))
+    mss = {}
+    for ms_verse in ms_verses:
+        # Use the same manuscript object for all its hands
+        ms = mss.setdefault(ms_verse.hand.manuscript_id, ms_verse.hand.manuscript)
+        ms_verse.hand.manuscript = ms
+        by_ms = vs_d.setdefault(ms_verse.verse.num, {})
+        by_ms.setdefault(ms.id, (ms, []))[1].append(ms_verse)
 
-    keys = list(vs_d.keys())
-    keys.sort()
     all_verses = []
-    for k in keys:
-        all_verses.append((k, vs_d[k]))
+    for v in sorted(vs_d):
+        verse_mss = [vs_d[v][k] for k in sorted(vs_d[v])]
+
+        # The base text is our base ms's firsthand (or any hand if need be)
+        sorter = None
+        if base_ms.id in vs_d[v]:
+            base_verses = vs_d[v][base_ms.id][1]
+            first_hands = [i for i in base_verses if i.hand.name == 'firsthand']
+            base_verse = first_hands[0] if first_hands else base_verses[0]
+            sorter = TextSorter(base_verse.verse_text_id, base_verse.text, matrices.get(v))
+
+        for ms, verses in verse_mss:
+            for ms_verse in verses:
+                if sorter:
+                    ms_verse.similarity = sorter(ms_verse.verse_text_id, ms_verse.text)
+                else:
+                    # The base text doesn't exist in this verse
+                    ms_verse.similarity = ''
+
+        all_verses.append((v, verse_mss))
 
     return all_verses
 
@@ -513,15 +838,28 @@ def get_all_verses(book_obj, chapter_obj, base_ms_id=None, verse_num=None):
 class TextSorter(object):
     """
     An object for returning the Levenshtein distance between our base text
-    and any other text.
+    and any other text - looked up in a SimilarityMatrix by the texts' ids
+    (as a whole percentage), if we have one.
     """
-    def __init__(self, base_text):
+    def __init__(self, base_id, base_text, matrix=None):
+        self.base_id = base_id
         self.base_text = base_text
+        self.matrix = matrix
+
+    def __call__(self, text_id, text):
+        ret = None
+        if self.matrix is not None:
+            ret = self.matrix(self.base_id, text_id)
+        if ret is None:
+            ret = similarity(self.base_text, text)
+        return ret
 
-    def __call__(self, text):
-        lev = Levenshtein.ratio(self.base_text if self.base_text else '',
-                                text if text else '') * 100.0
-        return lev
+
+def stripe_text(readings):
+    """
+    Return the text of a stripe, from its readings
+    """
+    return ' '.join([x.text for x in readings if x.text.strip()])
 
 
 class StripeSorter(TextSorter):
@@ -529,45 +867,44 @@ class StripeSorter(TextSorter):
     An object for returning the Levenshtein distance between our base text
     and any other stripe.
     """
-    def __init__(self, base_ms_id, stripe_data):
+    def __init__(self, base_ms_id, stripe_data, matrix=None):
         # If the verse doesn't exist in our base text, then just set it to blank
+        self.base_id = None
         self.base_text = ""
+        self.matrix = matrix
         for (stripe, ms_stripes) in stripe_data:
             my_ms_stripe = [x for x in ms_stripes if
                             (x.ms_verse.hand.manuscript.id == base_ms_id and
                              x.ms_verse.hand.name == 'firsthand')]
             if my_ms_stripe:
                 # This ms_stripe is our base text's firsthand
-                self.base_text = self._textify(my_ms_stripe[0].stripe.readings.all())
-
-    def _textify(self, readings):
-        return ' '.join([x.text for x in readings if x.text.strip()])
+                self.base_id = stripe.id
+                self.base_text = stripe_text(stripe.sorted_readings)
 
     def __call__(self, stripe):
-        text = self._textify(stripe.readings.all())
-        return super(StripeSorter, self).__call__(text)
+        text = stripe_text(stripe.sorted_readings)
+        return super(StripeSorter, self).__call__(stripe.id, text)
 
 
-@picklify
-def _collate_verse(verse, algorithm_obj, base_ms_id):
-    """
-    Collate a single verse - this is an internal function used
-    by collate() - which should be called instead.
+def _collate_verse(verse, stripes, base_ms_id, matrix=None):
     """
-    print(verse)
-    print(algorithm_obj)
-    stripes = Stripe.objects.filter(verse=verse, algorithm=algorithm_obj)
+    Collate a single verse, from its [(stripe, readings, ms_stripes), ...] -
+    this is an internal function used by collate() - which should be called
+    instead.
 
+    @param matrix: (optional) SimilarityMatrix of the stripes' texts, by
+                   stripe id
+    """
     my_data = []
-    for st in stripes:
-        ms_stripes = sorted(MsStripe.objects.filter(stripe=st),
+    for st, readings, ms_stripes in stripes:
+        ms_stripes = sorted(ms_stripes,
                             key=lambda a: a.ms_verse.hand.manuscript.liste_id)
         my_data.append((st, ms_stripes))
-        st.sorted_readings = st.readings.all().order_by('variant__id')
+        st.sorted_readings = readings
 
     # Now sort it by similarity to our base ms's reading - and add the
     # similarity to the object
-    sorter = StripeSorter(base_ms_id, my_data)
+    sorter = StripeSorter(base_ms_id, my_data, matrix)
     for st, ms_stripes in my_data:
         st.similarity = sorter(st)
 
@@ -575,6 +912,107 @@ def _collate_verse(verse, algorithm_obj, base_ms_id):
     return (verse, sorted_data)
 
 
+def _prefetch_stripes(algorithm_obj, stripes):
+    """
+    Return the stripes queryset with its readings (in variant order) and
+    MsStripes (with their hands and manuscripts) prefetched
+    """
+    readings = Reading.objects.filter(algorithm=algorithm_obj).order_by('variant_id')
+    ms_stripes = (MsStripe.objects.filter(algorithm=algorithm_obj)
+                  .select_related('ms_verse__hand__manuscript'))
+    return stripes.order_by('id').prefetch_related(Prefetch('readings', queryset=readings),
+                                                   Prefetch('msstripe_set', queryset=ms_stripes))
+
+
+def _snapshot_data(stripes):
+    """
+    Return the snapshot of a verse's prefetched stripes, as plain data
+    """
+    texts = {st.id: stripe_text(st.readings.all()) for st in stripes}
+    return {'stripes': [[_to_plain(st),
+                         [_to_plain(x) for x in st.readings.all()],
+                         [[_to_plain(x), _to_plain(x.ms_verse), _to_plain(x.ms_verse.hand),
+                           _to_plain(x.ms_verse.hand.manuscript)] for x in st.msstripe_set.all()]]
+                        for st in stripes],
+            'similarity': SimilarityMatrix.build(texts).to_plain()}
+
+
+def materialize(algorithm_obj, verses):
+    """
+    (Re)build the collation snapshots of these verses from the collation
+    tables. Verses that haven't been collated don't get one.
+
+    @param algorithm_obj: the algorithm
+    @param verses: a queryset of verses
+    @returns: the number of snapshots made
+    """
+    stripes = _prefetch_stripes(algorithm_obj,
+                                Stripe.objects.filter(algorithm=algorithm_obj, verse__in=verses))
+    verse_stripes = defaultdict(list)
+    for st in stripes:
+        verse_stripes[st.verse_id].append(st)
+
+    with transaction.atomic():
+        CollationSnapshot.objects.filter(algorithm=algorithm_obj, verse__in=verses).delete()
+        CollationSnapshot.objects.bulk_create(
+            [CollationSnapshot(verse_id=verse_id, algorithm=algorithm_obj,
+                               data=json.dumps(_snapshot_data(stripes)))
+             for verse_id, stripes in verse_stripes.items()])
+    return len(verse_stripes)
+
+
+def _dump_collation(collation):
+    """
+    Convert the results of collate to plain data
+    """
+    mss = {}
+    ret = []
+    for verse, data in collation:
+        stripes = []
+        for stripe, ms_stripes in data:
+            plain_ms_stripes = []
+            for ms_stripe in ms_stripes:
+                ms_verse = ms_stripe.ms_verse
+                mss[ms_verse.hand.manuscript_id] = _to_plain(ms_verse.hand.manuscript)
+                plain_ms_stripes.append([_to_plain(ms_stripe), _to_plain(ms_verse),
+                                         _to_plain(ms_verse.hand)])
+            stripes.append([_to_plain(stripe), stripe.similarity,
+                            [_to_plain(x) for x in stripe.sorted_readings],
+                            plain_ms_stripes])
+        ret.append([_to_plain(verse), stripes])
+    return {'mss': list(mss.values()), 'verses': ret}
+
+
+def _load_collation(data):
+    """
+    Convert the results of _dump_collation back into collate's form
+    """
+    mss = {x['id']: _from_plain(ManuscriptTranscription, x) for x in data['mss']}
+    collation = []
+    for verse, stripes in data['verses']:
+        verse = _from_plain(Verse, verse)
+        verse_data = []
+        for stripe, similarity, readings, plain_ms_stripes in stripes:
+            stripe = _from_plain(Stripe, stripe)
+            stripe.verse = verse
+            stripe.similarity = similarity
+            stripe.sorted_readings = [_from_plain(Reading, x) for x in readings]
+            ms_stripes = []
+            for ms_stripe, ms_verse, hand in plain_ms_stripes:
+                ms_stripe = _from_plain(MsStripe, ms_stripe)
+                ms_stripe.stripe = stripe
+                ms_stripe.ms_verse = _from_plain(MsVerse, ms_verse)
+                ms_stripe.ms_verse.verse = verse
+                ms_stripe.ms_verse.hand = _from_plain(Hand, hand)
+                ms_stripe.ms_verse.hand.manuscript = mss[ms_stripe.ms_verse.hand.manuscript_id]
+                ms_stripes.append(ms_stripe)
+            verse_data.append((stripe, ms_stripes))
+        collation.append((verse, verse_data))
+    return collation
+
+
+@memoize
+@diskcache(dump=_dump_collation, load=_load_collation)
 def collate(book_obj, chapter_obj, verse_obj, algorithm_obj, base_ms_id):
     """
     @param book obj: the book to collate
@@ -593,6 +1031,10 @@ def collate(book_obj, chapter_obj, verse_obj, algorithm_obj, base_ms_id):
           [<MsStripe: MsStripe: hand Hand firsthand of Manuscript 013...>, ...])
         ]),
      (<Verse: Verse john 1:2>...
+
+    Everything is loaded up front, in a fixed number of queries - two, if
+    all the verses have been materialized (see CollationSnapshot). The
+    stripes' readings are in variant order, in stripe.sorted_readings.
     """
     print(("Creating collation for {}:{}:{}:{}:{}"
            .format(book_obj.name,
@@ -601,19 +1043,39 @@ def collate(book_obj, chapter_obj, verse_obj, algorithm_obj, base_ms_id):
                    algorithm_obj.name,
                    base_ms_id)))
 
-    if chapter_obj:
-        chapters = [chapter_obj]
-    else:
-        chapters = Chapter.objects.filter(book=book_obj).order_by('num')
-
+    stripes = Stripe.objects.filter(algorithm=algorithm_obj)
+    snapshots = CollationSnapshot.objects.filter(algorithm=algorithm_obj)
     if verse_obj:
         verses = [verse_obj]
+        stripes = stripes.filter(verse=verse_obj)
+        snapshots = snapshots.filter(verse=verse_obj)
     else:
-        verses = []
-        for chapter in chapters:
-            verses.extend(Verse.objects.filter(chapter=chapter).order_by('num'))
+        verses = Verse.objects.filter(chapter__book=book_obj).order_by('chapter__num', 'num')
+        stripes = stripes.filter(verse__chapter__book=book_obj)
+        snapshots = snapshots.filter(verse__chapter__book=book_obj)
+        if chapter_obj:
+            verses = verses.filter(chapter=chapter_obj)
+            stripes = stripes.filter(verse__chapter=chapter_obj)
+            snapshots = snapshots.filter(verse__chapter=chapter_obj)
+        verses = list(verses)
+    verses_d = {x.id: x for x in verses}
+
+    # Use the snapshots where we have them...
+    verse_stripes = defaultdict(list)
+    matrices = {}
+    mss = {}
+    for snapshot in snapshots:
+        snapshot.verse = verses_d[snapshot.verse_id]
+        verse_stripes[snapshot.verse_id] = snapshot.stripes(mss)
+        matrices[snapshot.verse_id] = snapshot.matrix
+
+    # ... and the collation tables where we don't (yet)
+    if len(verse_stripes) < len(verses):
+        stripes = _prefetch_stripes(algorithm_obj,
+                                    stripes.exclude(verse__in=snapshots.values('verse_id')))
+        for st in stripes:
+            verse_stripes[st.verse_id].append((st, st.readings.all(), st.msstripe_set.all()))
 
     print(("Collating {} verses".format(len(verses))))
-    for i, verse in enumerate(verses):
-        print((" - collating {}/{} - {}".format(i + 1, len(verses), verse.num)))
-        yield _collate_verse(verse, algorithm_obj, base_ms_id)
+    return [_collate_verse(verse, verse_stripes[verse.id], base_ms_id, matrices.get(verse.id))
+            for verse in verses]
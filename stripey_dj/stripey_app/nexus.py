@@ -0,0 +1,340 @@
+"""
+NEXUS files of the collations, for SplitsTree, Mesquite and MrBayes.
+
+A CharacterMatrix is built for each book and algorithm after collating (see
+build_matrix): a row per witness - a manuscript's GA number and hand name,
+as they appear in the NEXUS taxa - and a column per variant unit (NEXUS
+character), holding the label of the witness's reading. Each NEXUS file is a
+slice of it, by range of verses and by witness, written out a row at a time.
+
+The files that are downloaded are kept in EXPORT_FOLDER (see save_export),
+so asking for the same one again is just a matter of serving the file - until
+the data changes.
+
+A hand that has a verse more than once (see MsVerse.item) only has its first
+reading in the matrix.
+"""
+
+import os
+import re
+import json
+import time
+import string
+import hashlib
+import tempfile
+import logging
+
+import numpy as np
+
+from .memoize import (memoize, HOME, TEMP_MAXAGE, data_generation, _atomic_write,
+                      _plain)
+from .models import (Book, Algorithm, Verse, Variant, StripeReading, MsStripe,
+                     CharacterMatrix)
+from .agreement import join_stripes, count_agreement
+
+logger = logging.getLogger(__name__)
+
+# The cell for a variant unit a witness doesn't have
+ABSENT = -1
+# Labels bigger than this are stored as this - they're beyond the symbols of
+# any NEXUS variant anyway
+MAX_LABEL = 127
+
+# The symbols for labels 1, 2, 3... in each NEXUS variant
+SYMBOLS = {'default': string.ascii_letters,  # Mesquite and my modified MrBayes
+           'mrbayes': "0123456789"}  # mrbayes doesn't support custom symbols...
+MISSING = "-"
+GAP = "?"  # label 0 implies blank text
+
+# Where the exported files are kept - each named after the data generation
+# and a hash of its contents, with a .ref file for each set of args (named
+# after a hash of them) holding the name of its file
+EXPORT_FOLDER = os.path.join(HOME, '.nexus_exports')
+
+
+def taxon_name(hand_name):
+    """
+    Return a hand's name as it appears in a NEXUS taxon
+    """
+    return hand_name.replace('(', '').replace(')', '').replace(':', '_')
+
+
+def build_matrix(algorithm_obj, book_obj):
+    """
+    (Re)build and store the CharacterMatrix of a book's collation
+    """
+    verses = list(Verse.objects.filter(chapter__book=book_obj)
+                  .order_by('chapter__num', 'num')
+                  .values_list('id', 'chapter__num', 'num'))
+    verse_index = {x[0]: i for i, x in enumerate(verses)}
+
+    # In variant order within each verse, as in collate()
+    variants = list(Variant.objects.filter(algorithm=algorithm_obj, verse__chapter__book=book_obj)
+                    .order_by('verse__chapter__num', 'verse__num', 'id')
+                    .values_list('id', 'verse_id'))
+    columns = {x[0]: i for i, x in enumerate(variants)}
+    bounds = np.searchsorted([verse_index[x[1]] for x in variants],
+                             np.arange(len(verses) + 1)).tolist()
+
+    # [(stripe id, column, label)], in stripe order
+    stripe_readings = sorted(
+        (stripe_id, columns[variant_id], min(label, MAX_LABEL)) for stripe_id, variant_id, label in
+        StripeReading.objects.filter(algorithm=algorithm_obj,
+                                     stripe__verse__chapter__book=book_obj)
+        .values_list('stripe_id', 'reading__variant_id', 'reading__label'))
+
+    seen = set()
+    ms_stripes = []  # [(witness, verse index, stripe id)]
+    for ga, name, verse_id, stripe_id in (
+            MsStripe.objects.filter(algorithm=algorithm_obj,
+                                    ms_verse__verse__chapter__book=book_obj)
+            .order_by('ms_verse__item', 'ms_verse_id')
+            .values_list('ms_verse__hand__manuscript__ga', 'ms_verse__hand__name',
+                         'ms_verse__verse_id', 'stripe_id')):
+        witness = (ga, taxon_name(name))
+        if (witness, verse_id) in seen:
+            continue
+        seen.add((witness, verse_id))
+        ms_stripes.append((witness, verse_index[verse_id], stripe_id))
+
+    witnesses = sorted(set(x[0] for x in ms_stripes))
+    rows = {x: i for i, x in enumerate(witnesses)}
+    labels = np.full((len(witnesses), len(variants)), ABSENT, dtype=np.int8)
+    present = np.zeros((len(witnesses), len(verses)), dtype=bool)
+    if ms_stripes:
+        ms_rows = np.array([rows[x[0]] for x in ms_stripes], dtype=np.int64)
+        present[ms_rows, [x[1] for x in ms_stripes]] = True
+        if stripe_readings:
+            stripe_readings = np.array(stripe_readings, dtype=np.int64)
+            left, right = join_stripes([x[2] for x in ms_stripes], stripe_readings[:, 0])
+            labels[ms_rows[left], stripe_readings[right, 1]] = stripe_readings[right, 2]
+
+    matrix, _ = CharacterMatrix.objects.update_or_create(
+        algorithm=algorithm_obj, book=book_obj,
+        defaults={'witnesses': json.dumps(witnesses),
+                  'verses': json.dumps([(chapter_num, verse_num, bounds[i], bounds[i + 1])
+                                        for i, (verse_id, chapter_num, verse_num)
+                                        in enumerate(verses)]),
+                  'labels': labels.tobytes(),
+                  'present': np.packbits(present, axis=1).tobytes()})
+    logger.debug("Built the character matrix of {} ({}): {} witnesses, {} characters".format(
+                 book_obj.name, algorithm_obj.name, len(witnesses), len(variants)))
+    return matrix
+
+
+class Characters(object):
+    """
+    A CharacterMatrix, ready to slice
+    """
+    def __init__(self, matrix):
+        self.witnesses = [tuple(x) for x in json.loads(matrix.witnesses)]
+        self.verses = [tuple(x) for x in json.loads(matrix.verses)]
+        width = self.verses[-1][3] if self.verses else 0
+        self.labels = np.frombuffer(bytes(matrix.labels), dtype=np.int8).reshape(
+            len(self.witnesses), width)
+        self.present = np.unpackbits(
+            np.frombuffer(bytes(matrix.present), dtype=np.uint8).reshape(
+                len(self.witnesses), (len(self.verses) + 7) // 8),
+            axis=1)[:, :len(self.verses)].astype(bool)
+
+    def select(self, ch=None, v=None, frag=0, ga_regex=None):
+        """
+        Return the taxa and rows of a range of verses
+
+        @param ch: chapter num or None for all chapters
+        @param v: verse num or None for all verses
+        @param frag: the threshold (percentage) of variant units that a witness
+                 needs to have so as not to be considered "fragmentary" and thus
+                 be excluded.
+        @param ga_regex: (optional) a regular expression used to restrict the witnesses
+        @returns: ([taxon, ...], 2D array of labels with a row per taxon,
+                   [label, ...] - every label in the range, fragmentary
+                   witnesses included)
+        """
+        rows = np.arange(len(self.witnesses))
+        if ga_regex:
+            ga_regex_re = re.compile(ga_regex)
+            rows = rows[[bool(ga_regex_re.match(x[0])) for x in self.witnesses]]
+        verses = np.array([i for i, (chapter_num, verse_num, start, end) in enumerate(self.verses)
+                           if ch is None or (chapter_num == ch and (v is None or verse_num == v))],
+                          dtype=np.int64)
+
+        # The witnesses that have any of the verses, and the verses that any
+        # of them have
+        present = self.present[np.ix_(rows, verses)]
+        rows = rows[present.any(axis=1)]
+        verses = verses[present.any(axis=0)]
+        columns = np.array([c for i in verses for c in range(*self.verses[i][2:])], dtype=np.int64)
+        labels = self.labels[np.ix_(rows, columns)]
+        used = np.unique(labels).tolist()
+
+        # Remove fragmentary witnesses
+        counts = (labels != ABSENT).sum(axis=1)
+        keep = counts >= counts.max(initial=0) * frag / 100.0
+        if not keep.all():
+            logger.warning("Ignoring {} fragmentary witnesses (threshold {}%)".format(
+                           len(keep) - keep.sum(), frag))
+        return ["{}_{}".format(*self.witnesses[i]) for i in rows[keep]], labels[keep], used
+
+    def nexus(self, ch=None, v=None, variant="default", frag=0, ga_regex=None):
+        """
+        Return a NEXUS file of a range of verses, as a generator of chunks
+        (bytes) - the taxa block, and then a row of the matrix at a time. The
+        arguments are checked up front, so any errors are raised here rather
+        than by the generator.
+
+        @param variant: NEXUS file variant to create (see SYMBOLS)
+        @param ch, v, frag, ga_regex: as for select
+        """
+        symbols = SYMBOLS['mrbayes' if variant == 'mrbayes' else 'default']
+        taxa, labels, used = self.select(ch, v, frag, ga_regex)
+        if used and used[-1] > len(symbols):
+            raise ValueError("Unsupported label index {} - check NEXUS variant"
+                             .format(used[-1]))
+        syms = sorted(symbols[x - 1] for x in used if x > 0)
+        return self._chunks(taxa, labels, syms, symbols)
+
+    def distances(self, ch=None, v=None, frag=0, ga_regex=None):
+        """
+        Return a NEXUS file of the distances between the witnesses in a range
+        of verses, as a generator of chunks (bytes). The distance between two
+        witnesses is the proportion of the variant units they both have in
+        which their readings differ - or missing, if they have none in common.
+
+        @param ch, v, frag, ga_regex: as for select
+        """
+        taxa, labels, used = self.select(ch, v, frag, ga_regex)
+        agree, compared = count_agreement(labels)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distances = np.where(compared > 0, 1.0 - agree / compared, np.nan)
+        return self._distance_chunks(taxa, distances)
+
+    @staticmethod
+    def _taxa_chunk(taxa):
+        return ("#nexus\nBEGIN Taxa;\nDIMENSIONS ntax={};\nTAXLABELS\n{}".format(
+                len(taxa), ''.join(x + "\n" for x in taxa)) + ";\nEND;").encode('utf-8')
+
+    @classmethod
+    def _chunks(cls, taxa, labels, syms, symbols):
+        yield cls._taxa_chunk(taxa)
+
+        # Characters section
+        yield """
+BEGIN Characters;
+DIMENSIONS nchar={};
+
+FORMAT
+    datatype=STANDARD
+    missing={}
+    gap={}
+    symbols="{}"
+;
+MATRIX
+""".format(labels.shape[1] if taxa else None, MISSING, GAP, ' '.join(syms)).encode('utf-8')
+
+        # Now the matrix - one byte per character, looked up by label + 1
+        chars = np.frombuffer((MISSING + GAP + symbols).encode('ascii'), dtype=np.uint8)
+        for taxon, row in zip(taxa, labels):
+            yield (taxon + " ").encode('utf-8') + chars[row.astype(np.int64) + 1].tobytes() + b"\n"
+        yield b";\nEND;\n"
+
+    @classmethod
+    def _distance_chunks(cls, taxa, distances):
+        yield cls._taxa_chunk(taxa)
+        yield """
+BEGIN Distances;
+DIMENSIONS ntax={};
+FORMAT
+    triangle=both
+    diagonal
+    labels=left
+    missing={}
+;
+MATRIX
+""".format(len(taxa), GAP).encode('utf-8')
+        for taxon, row in zip(taxa, distances):
+            yield "{} {}\n".format(taxon, ' '.join(GAP if np.isnan(x) else "{:.6f}".format(x)
+                                                   for x in row.tolist())).encode('utf-8')
+        yield b";\nEND;\n"
+
+
+@memoize
+def get_characters(bk, al):
+    """
+    Return the Characters of a book's collation - building its matrix if it
+    hasn't been built
+
+    @param bk: book num
+    @param al: algorithm name
+    """
+    book_obj = Book.objects.get(num=bk)
+    algorithm_obj = Algorithm.objects.get(name=al)
+    try:
+        matrix = CharacterMatrix.objects.get(algorithm=algorithm_obj, book=book_obj)
+    except CharacterMatrix.DoesNotExist:
+        matrix = build_matrix(algorithm_obj, book_obj)
+    return Characters(matrix)
+
+
+def _ref_path(args, generation):
+    key = json.dumps(_plain(args), sort_keys=True)
+    return os.path.join(EXPORT_FOLDER, "{}-{}.ref".format(
+                        generation, hashlib.sha224(key.encode('utf8')).hexdigest()))
+
+
+def open_export(*args):
+    """
+    Return the file saved for these args (see save_export), open for
+    reading - or None if there isn't one from the current data generation.
+    """
+    try:
+        with open(_ref_path(args, data_generation()), 'rb') as f:
+            name = f.read().decode('ascii')
+        return open(os.path.join(EXPORT_FOLDER, name), 'rb')
+    except FileNotFoundError:
+        return None
+
+
+def _evict(generation):
+    """
+    Remove the files from old data generations, and any temp files left
+    over from a crash
+    """
+    now = time.time()
+    for entry in os.scandir(EXPORT_FOLDER):
+        try:
+            if entry.name.startswith('.tmp-'):
+                if now - entry.stat().st_mtime > TEMP_MAXAGE:
+                    os.unlink(entry.path)
+            elif not entry.name.startswith("{}-".format(generation)):
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            # Someone else got there first
+            pass
+
+
+def save_export(chunks, *args):
+    """
+    Pass a file's chunks (bytes) through, while saving them in EXPORT_FOLDER
+    for open_export to find by these args. Nothing is saved unless all the
+    chunks get through - a download that's abandoned part way doesn't count.
+    """
+    generation = data_generation()
+    os.makedirs(EXPORT_FOLDER, exist_ok=True)
+    _evict(generation)
+    fd, tmp = tempfile.mkstemp(dir=EXPORT_FOLDER, prefix='.tmp-')
+    try:
+        myhash = hashlib.sha224()
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                myhash.update(chunk)
+                yield chunk
+        # Identical files (e.g. from different fragmentary thresholds that
+        # leave out the same witnesses) share a name
+        name = "{}-{}.nex".format(generation, myhash.hexdigest())
+        os.replace(tmp, os.path.join(EXPORT_FOLDER, name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    _atomic_write(_ref_path(args, generation), name.encode('ascii'))
@@ -0,0 +1,90 @@
+// Display how much a manuscript agrees with its closest witnesses over a
+// window of variant units sliding through a book
+
+function agreement_profile_gr(manuscript, book, algorithm, window) {
+
+    // Based on http://bl.ocks.org/mbostock/3884955
+    var margin = {top: 10, right: 120, bottom: 30, left: 40},
+        width = 800 - margin.left - margin.right,
+        height = 300 - margin.top - margin.bottom;
+
+    var x = d3.scale.linear()
+        .range([0, width]);
+
+    var y = d3.scale.linear()
+        .domain([0, 100])
+        .range([height, 0]);
+
+    var color = d3.scale.category10();
+
+    var yAxis = d3.svg.axis()
+        .scale(y)
+        .orient("left")
+        .ticks(5);
+
+    var svg = d3.select("#profile").append("svg")
+        .attr("width", width + margin.left + margin.right)
+        .attr("height", height + margin.top + margin.bottom)
+        .append("g")
+        .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
+
+    d3.json("profile.json?ms_id="+manuscript+"&bk="+book+"&al="+encodeURIComponent(algorithm)+"&window="+window, function(error, data) {
+        if (error || data['series'].length == 0) {
+            d3.select("#profile").append("p")
+                .text(error ? "Couldn't load the agreement profile" : "No variant units to compare");
+            return;
+        }
+        var windows = data['windows'];
+        x.domain([0, Math.max(1, windows.length - 1)]);
+
+        // A tick at the first window of each chapter
+        var ticks = [];
+        windows.forEach(function(d, i) {
+            if (i == 0 || d[0][0] != windows[i - 1][0][0]) {
+                ticks.push(i);
+            }
+        });
+        var xAxis = d3.svg.axis()
+            .scale(x)
+            .orient("bottom")
+            .tickValues(ticks)
+            .tickFormat(function(i) { return windows[i][0][0]; });
+
+        svg.append("g")
+            .attr("class", "x axis")
+            .attr("transform", "translate(0," + height + ")")
+            .call(xAxis);
+
+        svg.append("g")
+            .attr("class", "y axis")
+            .call(yAxis)
+            .append("text")
+            .attr("transform", "rotate(-90)")
+            .attr("y", 6)
+            .attr("dy", ".71em")
+            .style("text-anchor", "end")
+            .text("% agreement");
+
+        var line = d3.svg.line()
+            .defined(function(d) { return d !== null; })
+            .x(function(d, i) { return x(i); })
+            .y(function(d) { return y(d); });
+
+        data['series'].forEach(function(d, i) {
+            var name = d['ga'] + (d['hand'] == 'firsthand' ? '' : ' ' + d['hand']);
+            svg.append("path")
+                .datum(d['percent'])
+                .attr("d", line)
+                .style("fill", "none")
+                .style("stroke", color(i))
+                .append("svg:title")
+                .text(name);
+
+            svg.append("text")
+                .attr("x", width + 10)
+                .attr("y", 15 * i + 10)
+                .style("fill", color(i))
+                .text(name);
+        });
+    });
+}
@@ -5,7 +5,23 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import time
+import tempfile
+import threading
+import json
+import numpy
+from unittest import mock
+from django.test import TestCase, SimpleTestCase
+from stripey_app.memoize import memoize, diskcache
+from stripey_app import text_matrix
+from stripey_app.text_matrix import get_text_matrix, update_text_matrix
+from stripey_app.nexus import get_characters
+from stripey_app.models import (ManuscriptTranscription, Hand, Book, Chapter,
+                                Verse, MsVerse, VerseText, Algorithm, Variant, Reading,
+                                Stripe, StripeReading, MsStripe, CollationSnapshot,
+                                AttestationIndex, CharacterMatrix, VerseSimilarity,
+                                get_all_verses, collate, materialize, update_similarities)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +30,561 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def isolate_caches(testcase):
+    """
+    Give a test its own diskcache folder, data generation, text matrices and
+    NEXUS exports - and empty memoized functions
+    """
+    tmp = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmp.cleanup)
+    patchers = [mock.patch('stripey_app.memoize.DISKCACHE_FOLDER', os.path.join(tmp.name, 'cache')),
+                mock.patch('stripey_app.memoize.GENERATION_FILE', os.path.join(tmp.name, 'gen')),
+                mock.patch('stripey_app.text_matrix.TEXT_MATRIX_FOLDER', os.path.join(tmp.name, 'tm')),
+                mock.patch('stripey_app.nexus.EXPORT_FOLDER', os.path.join(tmp.name, 'nexus')),
+                mock.patch.dict('stripey_app.text_matrix._loaded', clear=True)]
+    for patcher in patchers:
+        patcher.start()
+        testcase.addCleanup(patcher.stop)
+    for instance in memoize.instances:
+        instance.clear()
+    return tmp.name
+
+
+class MemoizeTest(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _func(self, a):
+        self.calls.append(a)
+        return 'x' * a
+
+    def test_lru(self):
+        func = memoize(max_entries=2)(self._func)
+        for a in (1, 2, 1, 3, 1, 2):
+            func(a)
+        # 2 was the least recently used when 3 came along
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(func.stats()['entries'], 2)
+        self.assertEqual((func.hits, func.misses, func.evictions), (2, 4, 2))
+
+    def test_max_bytes(self):
+        func = memoize(max_bytes=1500)(self._func)
+        func(1000)
+        func(1000)
+        func(1001)
+        self.assertEqual(func.stats()['entries'], 1)
+        self.assertEqual(self.calls, [1000, 1001])
+
+    def test_ttl(self):
+        func = memoize(ttl=0.05)(self._func)
+        func(1)
+        func(1)
+        time.sleep(0.1)
+        func(1)
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_invalidate(self):
+        func = memoize(self._func)
+        func(1)
+        func(2)
+        func.invalidate(1)
+        func(1)
+        func(2)
+        self.assertEqual(self.calls, [1, 2, 1])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch('stripey_app.memoize.GENERATION_FILE', os.path.join(tmp, 'gen')), \
+                    mock.patch('stripey_app.memoize.GENERATION_CHECK_INTERVAL', 60):
+                memoize.invalidate_all()
+                func(2)
+                self.assertEqual(self.calls, [1, 2, 1, 2])
+                # Another process invalidating everything - which we notice
+                # once we next read the generation file
+                with open(os.path.join(tmp, 'gen'), 'w') as f:
+                    f.write('7')
+                func(2)
+                self.assertEqual(self.calls, [1, 2, 1, 2])
+                with mock.patch('stripey_app.memoize.GENERATION_CHECK_INTERVAL', 0):
+                    func(2)
+                self.assertEqual(self.calls, [1, 2, 1, 2, 2])
+
+    def _run_threads(self, func, args):
+        results = {}
+
+        def call(i, a):
+            try:
+                results[i] = func(a)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i, a)) for i, a in enumerate(args)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return [results[i] for i in range(len(args))]
+
+    def test_single_flight(self):
+        """
+        Different args are calculated in parallel, and the same args once
+        """
+        running = []
+        overlaps = []
+
+        @memoize
+        def slow(a):
+            running.append(a)
+            time.sleep(0.2)
+            overlaps.append(len(running))
+            running.remove(a)
+            self.calls.append(a)
+            return a * 2
+
+        start = time.time()
+        results = self._run_threads(slow, [1, 2, 3, 1, 2, 3])
+        self.assertEqual(results, [2, 4, 6, 2, 4, 6])
+        self.assertEqual(sorted(self.calls), [1, 2, 3])
+        self.assertGreater(max(overlaps), 1)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_single_flight_error(self):
+        """
+        Everyone waiting gets the exception, and it isn't cached
+        """
+        @memoize
+        def fail(a):
+            self.calls.append(a)
+            time.sleep(0.1)
+            if len(self.calls) == 1:
+                raise ValueError("Failed")
+            return a
+
+        results = self._run_threads(fail, [1, 1, 1])
+        self.assertTrue(all(isinstance(x, ValueError) for x in results))
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(fail(1), 1)
+        self.assertEqual(self.calls, [1, 1])
+
+
+class DiskcacheTest(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.folder = os.path.join(isolate_caches(self), 'cache')
+
+    def _func(self, a, b=None):
+        self.calls.append(a)
+        return {'a': 'x' * a}
+
+    def test_shared(self):
+        """
+        Another instance (as in another process) uses the same files, until
+        the data changes
+        """
+        diskcache(folder=self.folder)(self._func)(1)
+        func = diskcache(folder=self.folder)(self._func)
+        self.assertEqual(func(1), {'a': 'x'})
+        self.assertEqual(self.calls, [1])
+
+        memoize.invalidate_all()
+        func(1)
+        self.assertEqual(self.calls, [1, 1])
+        # The old generation's file has gone
+        self.assertEqual(len(self._files()), 1)
+
+    def test_model_keys(self):
+        func = diskcache(folder=self.folder)(self._func)
+        func(1, Book(id=1, name='john', num=4))
+        func(1, Book(id=1, name='renamed', num=4))
+        func(1, Book(id=2, name='john', num=4))
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_max_bytes(self):
+        # Room for two of them
+        func = diskcache(folder=self.folder, max_bytes=50)(self._func)
+        for a in (1, 2, 1, 3, 1, 2):
+            func(a)
+            # So they're all used at different times
+            time.sleep(0.01)
+        # 2 was the least recently used when 3 came along
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(len(self._files()), 2)
+
+    def test_single_flight(self):
+        """
+        Separate instances (as in separate processes) only calculate it once
+        """
+        def slow(a):
+            time.sleep(0.1)
+            return self._func(a)
+
+        threads = [threading.Thread(target=diskcache(folder=self.folder)(slow), args=(1,))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, [1])
+
+    def _files(self):
+        return [x for x in os.listdir(self.folder) if not x.startswith('.')]
+
+
+class GetAllVersesTest(TestCase):
+    def setUp(self):
+        isolate_caches(self)
+        self.book = Book.objects.create(name='john', num=4)
+        self.chapter = Chapter.objects.create(book=self.book, num=1)
+        verses = [Verse.objects.create(chapter=self.chapter, num=i) for i in (1, 2, 3)]
+        self.mss = []
+        for i in range(5):
+            ms = ManuscriptTranscription.objects.create(ms_ref='ms{}'.format(i),
+                                                        ga='0{}'.format(i + 1),
+                                                        liste_id=20000 + i)
+            self.mss.append(ms)
+            hands = [Hand.objects.create(manuscript=ms, name='firsthand', handorder=-1)]
+            if i % 2:
+                hands.append(Hand.objects.create(manuscript=ms, name='corrector', handorder=0))
+            for hand in hands:
+                for verse in verses:
+                    MsVerse.objects.create(verse=verse, hand=hand, item=0,
+                                           raw_text='εν αρχη ην ο λογος {}'.format(i))
+
+    def test_query_count(self):
+        """
+        Everything should come from a fixed number of queries, however many
+        manuscripts and hands there are.
+        """
+        with self.assertNumQueries(3):
+            all_verses = get_all_verses.func(self.book, self.chapter, self.mss[0].id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual([x[0] for x in all_verses], [1, 2, 3])
+            for v, mss in all_verses:
+                self.assertEqual([ms.id for ms, verses in mss], [x.id for x in self.mss])
+                for ms, verses in mss:
+                    self.assertEqual(len(verses), 2 if int(ms.ga) % 2 == 0 else 1)
+                    for verse in verses:
+                        self.assertEqual(verse.verse.num, v)
+                        self.assertEqual(verse.hand.manuscript.display_short(), ms.display_short())
+                        self.assertIn(verse.hand.name, ('firsthand', 'corrector'))
+                        self.assertEqual(verse.similarity == 100.0, ms == self.mss[0])
+
+    def test_diskcache(self):
+        """
+        The results come back from the diskcache as they went in
+        """
+        def summary(all_verses):
+            return [(v, [(ms.id, ms.display_short(), [(x.id, x.text, x.hand.name, x.verse.num,
+                                                       x.hand.manuscript.ga, x.similarity)
+                                                      for x in verses])
+                         for ms, verses in mss])
+                    for v, mss in all_verses]
+
+        expected = summary(get_all_verses.func(self.book, self.chapter, self.mss[1].id))
+        with self.assertNumQueries(0):
+            self.assertEqual(summary(get_all_verses.func(self.book, self.chapter, self.mss[1].id)),
+                             expected)
+
+    def test_similarities(self):
+        """
+        With the similarities worked out in advance, the results are the
+        same (to whole percentages) but without any Levenshtein.
+        """
+        def similarities(all_verses):
+            return [(v, [(ms.id, [round(x.similarity) for x in verses]) for ms, verses in mss])
+                    for v, mss in all_verses]
+
+        MsVerse.objects.filter(verse__num=2, hand__name='corrector').update(
+            verse_text=VerseText.intern('εν αρχη ην'))
+        for base_ms in self.mss[:2]:
+            expected = similarities(get_all_verses.func(self.book, self.chapter, base_ms.id))
+            memoize.invalidate_all()
+            self.assertEqual(update_similarities(Verse.objects.all()), 3 if base_ms == self.mss[0] else 0)
+            with mock.patch('Levenshtein.ratio', side_effect=AssertionError):
+                self.assertEqual(similarities(get_all_verses.func(self.book, self.chapter, base_ms.id)),
+                                 expected)
+
+        # The matrices are by VerseText id
+        self.assertEqual(VerseSimilarity.objects.get(verse__num=2).matrix.ids,
+                         sorted(set(MsVerse.objects.filter(verse__num=2)
+                                    .values_list('verse_text_id', flat=True))))
+
+    def test_single_verse(self):
+        with self.assertNumQueries(3):
+            all_verses = get_all_verses.func(self.book, self.chapter, None, 2)
+        self.assertEqual([x[0] for x in all_verses], [2])
+        self.assertEqual(len(all_verses[0][1]), 5)
+
+    def test_get_text(self):
+        with self.assertNumQueries(1):
+            text = self.mss[1].get_text(self.book, self.chapter)
+            self.assertEqual([(v, [x.hand.name for x in verses]) for v, verses in text],
+                             [(i, ['firsthand', 'corrector']) for i in (1, 2, 3)])
+            self.assertEqual(set(x.text for v, verses in text for x in verses),
+                             {'εν αρχη ην ο λογος 1'})
+
+    def test_verse_texts(self):
+        """
+        Each distinct text is only stored once
+        """
+        self.assertEqual(MsVerse.objects.count(), 3 * 7)
+        self.assertEqual(VerseText.objects.count(), 5)
+        ms_verse = MsVerse.objects.filter(hand__manuscript=self.mss[2]).first()
+        self.assertEqual(ms_verse.raw_text, 'εν αρχη ην ο λογος 2')
+        self.assertEqual(ms_verse.verse_text.hash, VerseText.text_hash(ms_verse.raw_text))
+
+
+class TextMatrixTest(TestCase):
+    def setUp(self):
+        isolate_caches(self)
+        self.book = Book.objects.create(name='john', num=4)
+        chapters = [Chapter.objects.create(book=self.book, num=i) for i in (1, 2)]
+        self.verses = [Verse.objects.create(chapter=ch, num=i) for ch in chapters for i in (1, 2)]
+        ms = ManuscriptTranscription.objects.create(ms_ref='ms0', ga='01', liste_id=20000)
+        self.hands = [Hand.objects.create(manuscript=ms, name=name, handorder=i)
+                      for i, name in enumerate(('firsthand', 'corrector'))]
+        ms = ManuscriptTranscription.objects.create(ms_ref='ms1', ga='02', liste_id=20001)
+        self.hands.append(Hand.objects.create(manuscript=ms, name='firsthand', handorder=-1))
+        for hand, texts in zip(self.hands, (('a', 'b', 'c', 'd'),
+                                            (None, 'x', None, None),
+                                            ('a', 'x', 'c', None))):
+            for verse, text in zip(self.verses, texts):
+                if text is not None:
+                    MsVerse.objects.create(verse=verse, hand=hand, item=0, raw_text=text)
+
+    def test_queries(self):
+        first, corr, other = [x.id for x in self.hands]
+        matrix = get_text_matrix(self.book)
+        self.assertEqual(matrix.texts.shape, (3, 4))
+        self.assertEqual(matrix.coverage(), {first: 4, corr: 1, other: 3})
+        self.assertEqual(matrix.coverage(chapter_num=2), {first: 2, corr: 0, other: 1})
+        self.assertEqual(matrix.witnesses(self.verses[1].id), [first, corr, other])
+        self.assertEqual(sorted(matrix.text_groups(self.verses[1].id).values()),
+                         [[first], [corr, other]])
+        agree, shared = matrix.agreement(first)
+        self.assertEqual((agree.tolist(), shared.tolist()), ([4, 0, 2], [4, 1, 3]))
+        self.assertEqual(matrix.lacunae(other), [self.verses[3].id])
+        self.assertEqual(matrix.verse_count([corr, other]), 3)
+
+    def test_stored(self):
+        """
+        The matrix is read from disk, and again once it's rebuilt
+        """
+        matrix = get_text_matrix(self.book)
+        with self.assertNumQueries(0):
+            self.assertIs(get_text_matrix(self.book), matrix)
+
+        MsVerse.objects.create(verse=self.verses[3], hand=self.hands[2], item=0, raw_text='d')
+        update_text_matrix(self.book)
+        matrix = get_text_matrix(self.book)
+        self.assertIsInstance(matrix.texts, numpy.memmap)
+        self.assertEqual(matrix.lacunae(self.hands[2].id), [])
+        self.assertEqual(len([x for x in os.listdir(text_matrix.TEXT_MATRIX_FOLDER)
+                              if x.endswith('.npy')]), 1)
+
+        # If its .npy file has gone, it's rebuilt
+        for x in os.listdir(text_matrix.TEXT_MATRIX_FOLDER):
+            if x.endswith('.npy'):
+                os.unlink(os.path.join(text_matrix.TEXT_MATRIX_FOLDER, x))
+        text_matrix._loaded.clear()
+        self.assertEqual(get_text_matrix(self.book).lacunae(self.hands[2].id), [])
+
+
+class CollateTest(TestCase):
+    def setUp(self):
+        isolate_caches(self)
+        self.book = Book.objects.create(name='john', num=4)
+        self.chapter = Chapter.objects.create(book=self.book, num=1)
+        self.algo = Algorithm.objects.create(name='dekker')
+        for v in (1, 2, 3):
+            verse = Verse.objects.create(chapter=self.chapter, num=v)
+            variant = Variant.objects.create(verse=verse, variant_num=0, algorithm=self.algo)
+            for i, text in enumerate(('λογος', 'θεος', '')):
+                reading = Reading(variant=variant, text=text)
+                reading.save()
+                stripe = Stripe(verse=verse, algorithm=self.algo)
+                stripe.save()
+                StripeReading(stripe=stripe, reading=reading).save()
+                for j in range(3):
+                    ms = ManuscriptTranscription.objects.get_or_create(
+                        ms_ref='ms{}_{}'.format(i, j), defaults={'ga': '0{}'.format(j), 'liste_id': 20000 + j})[0]
+                    hand = Hand.objects.get_or_create(manuscript=ms, name='firsthand', handorder=-1)[0]
+                    ms_verse = MsVerse.objects.create(verse=verse, hand=hand, item=0, raw_text=text)
+                    MsStripe(stripe=stripe, ms_verse=ms_verse).save()
+
+    def _summary(self, collation):
+        return [(verse.id, verse.num,
+                 [(stripe.id, round(stripe.similarity),
+                   [(r.variant_id, r.text, r.label) for r in stripe.sorted_readings],
+                   [(m.id, m.stripe.id, m.ms_verse.verse.num, m.ms_verse.hand.name,
+                     m.ms_verse.hand.manuscript.id, m.ms_verse.hand.manuscript.display_short())
+                    for m in mss])
+                  for stripe, mss in data])
+                for verse, data in collation]
+
+    def test_query_count(self):
+        base_ms = ManuscriptTranscription.objects.get(ms_ref='ms1_0')
+        with self.assertNumQueries(5):
+            collation = collate.func(self.book, self.chapter, None, self.algo, base_ms.id)
+
+        self.assertEqual([verse.num for verse, data in collation], [1, 2, 3])
+        for verse, data in collation:
+            # The base text's stripe comes first
+            self.assertEqual([[r.text for r in stripe.sorted_readings] for stripe, mss in data],
+                             [['θεος'], ['λογος'], ['']])
+            self.assertEqual(data[0][0].similarity, 100.0)
+            self.assertEqual([len(mss) for stripe, mss in data], [3, 3, 3])
+
+    def test_snapshots(self):
+        """
+        Materialized verses come from their snapshots, in two queries, and
+        the rest from the collation tables - all just the same (to the
+        whole percentages the snapshots keep).
+        """
+        base_ms = ManuscriptTranscription.objects.get(ms_ref='ms1_0')
+        expected = self._summary(collate.func(self.book, self.chapter, None, self.algo, base_ms.id))
+
+        self.assertEqual(materialize(self.algo, Verse.objects.filter(num__in=(1, 3))), 2)
+        memoize.invalidate_all()
+        self.assertEqual(self._summary(collate.func(self.book, self.chapter, None, self.algo,
+                                                    base_ms.id)), expected)
+
+        self.assertEqual(materialize(self.algo, Verse.objects.all()), 3)
+        self.assertEqual(CollationSnapshot.objects.count(), 3)
+        memoize.invalidate_all()
+        with self.assertNumQueries(2), mock.patch('Levenshtein.ratio', side_effect=AssertionError):
+            self.assertEqual(self._summary(collate.func(self.book, self.chapter, None, self.algo,
+                                                        base_ms.id)), expected)
+
+    def test_diskcache(self):
+        """
+        The results come back from the diskcache as they went in, ready for
+        the collation template.
+        """
+        expected = self._summary(collate.func(self.book, self.chapter, None, self.algo, None))
+        with self.assertNumQueries(0):
+            self.assertEqual(self._summary(collate.func(self.book, self.chapter, None, self.algo,
+                                                        None)), expected)
+
+    def test_closest(self):
+        """
+        Each manuscript agrees with those that share its readings, and no
+        others
+        """
+        ms = ManuscriptTranscription.objects.get(ms_ref='ms1_0')
+        response = self.client.get('/closest.json', {'ms_id': ms.id, 'bk': 4, 'ch': 1,
+                                                     'al': 'dekker', 'k': 3})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['ga'], '00')
+        self.assertEqual([(x['ms_id'], x['agree'], x['compared']) for x in data['closest']],
+                         [(ManuscriptTranscription.objects.get(ms_ref=x).id, a, 3)
+                          for x, a in (('ms1_1', 3), ('ms1_2', 3), ('ms0_0', 0))])
+
+    def test_attestations(self):
+        """
+        Queries of the readings' witnesses, from the attestation index
+        """
+        def query(q):
+            response = self.client.get('/attestations.json', {'bk': 4, 'al': 'dekker', 'q': q})
+            if response.status_code != 200:
+                return response.status_code
+            data = json.loads(response.content.decode('utf-8'))
+            return [(x['verse'], [(r['text'], len(r['witnesses'])) for r in x['readings']])
+                    for x in data['units']]
+
+        # Each reading has a manuscript of each GA number
+        self.assertEqual(query('00 and 01'), [(v, [('', 3), ('λογος', 3), ('θεος', 3)])
+                                              for v in (1, 2, 3)])
+        self.assertEqual(query('only @majuscules'), query('@majuscules'))
+        self.assertEqual(query('not (01 or @papyri)'), [])
+        self.assertEqual(query('01 and not'), 400)
+        self.assertEqual(AttestationIndex.objects.count(), 1)
+
+    def test_profile(self):
+        """
+        The agreement over a sliding window of variant units
+        """
+        ms = ManuscriptTranscription.objects.get(ms_ref='ms1_0')
+        response = self.client.get('/profile.json', {'ms_id': ms.id, 'bk': 4, 'al': 'dekker',
+                                                     'window': 2, 'k': 3})
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['windows'], [[[1, 1], [1, 2]], [[1, 2], [1, 3]]])
+        self.assertEqual([(x['ga'], x['percent']) for x in data['series']],
+                         [('01', [100.0, 100.0]), ('02', [100.0, 100.0]), ('00', [0.0, 0.0])])
+
+        # A hand with none of the variant units has an empty profile
+        hand = Hand.objects.create(manuscript=ManuscriptTranscription.objects.create(
+            ms_ref='ms9', ga='09', liste_id=20009), name='firsthand', handorder=-1)
+        response = self.client.get('/profile.json', {'ms_id': hand.manuscript.id, 'bk': 4,
+                                                     'al': 'dekker', 'window': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['series'], [])
+
+    def test_nexus(self):
+        """
+        NEXUS files are slices of the stored character matrix. The three
+        manuscripts with each GA number are one taxon - with the first one's
+        readings.
+        """
+        # The view shares the character matrix the exporter loads
+        get_characters(4, 'dekker')
+        with self.assertNumQueries(0):
+            response = self.client.get('/nexus_file.txt', {'bk': 4, 'al': 'dekker'})
+        self.assertTrue(response.streaming)
+        nexus = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(nexus, """#nexus
+BEGIN Taxa;
+DIMENSIONS ntax=3;
+TAXLABELS
+00_firsthand
+01_firsthand
+02_firsthand
+;
+END;
+BEGIN Characters;
+DIMENSIONS nchar=3;
+
+FORMAT
+    datatype=STANDARD
+    missing=-
+    gap=?
+    symbols="a"
+;
+MATRIX
+00_firsthand aaa
+01_firsthand aaa
+02_firsthand aaa
+;
+END;
+""")
+        self.assertEqual(CharacterMatrix.objects.count(), 1)
+
+        # Then it's saved, to serve in whole or in part
+        with mock.patch('stripey_app.nexus.Characters.nexus', side_effect=AssertionError):
+            response = self.client.get('/nexus_file.txt', {'bk': 4, 'al': 'dekker'})
+            self.assertEqual(int(response['Content-Length']), len(nexus))
+            self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), nexus)
+            response = self.client.get('/nexus_file.txt', {'bk': 4, 'al': 'dekker'},
+                                       HTTP_RANGE='bytes=-8')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes {}-{}/{}'.format(
+                             len(nexus) - 8, len(nexus) - 1, len(nexus)))
+            self.assertEqual(b''.join(response.streaming_content), b'\n;\nEND;\n')
+
+        response = self.client.get('/nexus_file.txt', {'bk': 4, 'ch': 1, 'v': 2, 'al': 'dekker',
+                                                       'variant': 'mrbayes', 'ga_regex': '0[12]'})
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8').split('MATRIX\n')[1],
+                         "01_firsthand 0\n02_firsthand 0\n;\nEND;\n")
+
+    def test_distances(self):
+        """
+        The distances between the witnesses, as a NEXUS Distances block.
+        Without ms0_1's verse 3, "01" has ms1_1's reading of it instead.
+        """
+        ms = ManuscriptTranscription.objects.get(ms_ref='ms0_1')
+        MsVerse.objects.filter(hand__manuscript=ms, verse__num=3).delete()
+        chunks = get_characters(4, 'dekker').distances(ga_regex='0[12]')
+        self.assertEqual(b''.join(chunks).decode('utf-8').split('MATRIX\n')[1],
+                         "01_firsthand 0.000000 0.333333\n02_firsthand 0.333333 0.000000\n;\nEND;\n")
@@ -0,0 +1,247 @@
+"""
+A per-book index of which witnesses have which texts: a matrix with a row
+per hand and a column per verse, holding the VerseText id of the hand's text
+of the verse (or 0 where the hand doesn't have the verse). It's stored as a
+.npy file, memory-mapped when it's read, so questions about coverage,
+agreement and lacunae are answered with numpy rather than by queries.
+
+The matrices are rebuilt by stripey_lib/text_matrices.py, which load_all.py
+runs after loading - and any that are missing are built when they're needed.
+"""
+
+import os
+import io
+import json
+import fcntl
+import hashlib
+import threading
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+from .memoize import HOME, _atomic_write
+from .models import MsVerse
+
+logger = logging.getLogger(__name__)
+
+# Where the matrices live - one .npy and one .json (its rows and columns) per
+# book.
+TEXT_MATRIX_FOLDER = os.path.join(HOME, '.text_matrices')
+# The cell for a verse a hand doesn't have
+ABSENT = 0
+
+
+class TextMatrix(object):
+    """
+    The texts of every hand in a book, by verse. Duplicate verses (see
+    MsVerse.item) only have their first text in the matrix.
+    """
+    def __init__(self, texts, hands, verses):
+        """
+        @param texts: 2D array of VerseText ids, a row per hand and a column
+                      per verse
+        @param hands: [(hand id, manuscript id, hand name), ...] for the rows
+        @param verses: [(verse id, chapter num, verse num), ...] for the
+                       columns
+        """
+        self.texts = texts
+        self.hands = [tuple(x) for x in hands]
+        self.verses = [tuple(x) for x in verses]
+        self._rows = {x[0]: i for i, x in enumerate(self.hands)}
+        self._columns = {x[0]: i for i, x in enumerate(self.verses)}
+
+    @classmethod
+    def build(cls, book_obj):
+        """
+        Make the matrix for a book from the database
+        """
+        rows = (MsVerse.objects.filter(verse__chapter__book=book_obj)
+                .order_by('hand__manuscript_id', 'hand_id', 'verse__chapter__num',
+                          'verse__num', 'item', 'id')
+                .values_list('hand_id', 'hand__manuscript_id', 'hand__name', 'verse_id',
+                             'verse__chapter__num', 'verse__num', 'verse_text_id'))
+        hands = {}
+        verses = {}
+        cells = []
+        for hand_id, ms_id, name, verse_id, chapter_num, verse_num, text_id in rows:
+            hands.setdefault(hand_id, (hand_id, ms_id, name))
+            verses.setdefault(verse_id, (verse_id, chapter_num, verse_num))
+            cells.append((hand_id, verse_id, text_id))
+
+        hands = sorted(hands.values(), key=lambda x: (x[1], x[0]))
+        verses = sorted(verses.values(), key=lambda x: (x[1], x[2]))
+        ret = cls(np.zeros((len(hands), len(verses)), dtype=np.int32), hands, verses)
+        # Reversed, so the first of any duplicates is the one left behind
+        for hand_id, verse_id, text_id in reversed(cells):
+            ret.texts[ret._rows[hand_id], ret._columns[verse_id]] = text_id
+        return ret
+
+    def row(self, hand_id):
+        """
+        Return the texts of one hand, by verse
+        """
+        return self.texts[self._rows[hand_id]]
+
+    def column(self, verse_id):
+        """
+        Return the texts of one verse, by hand
+        """
+        return self.texts[:, self._columns[verse_id]]
+
+    def _chapter_mask(self, chapter_num):
+        return np.array([x[1] == chapter_num for x in self.verses], dtype=bool)
+
+    def coverage(self, chapter_num=None):
+        """
+        Return {hand id: number of verses}, for the book or one chapter
+        """
+        present = self.texts != ABSENT
+        if chapter_num is not None:
+            present = present[:, self._chapter_mask(chapter_num)]
+        return dict(zip([x[0] for x in self.hands], present.sum(axis=1).tolist()))
+
+    def witnesses(self, verse_id):
+        """
+        Return the ids of the hands that have this verse
+        """
+        column = self.column(verse_id)
+        return [self.hands[i][0] for i in np.flatnonzero(column != ABSENT)]
+
+    def text_groups(self, verse_id):
+        """
+        Return {VerseText id: [hand id, ...]} for the hands sharing each
+        text of this verse
+        """
+        ret = {}
+        for i, text_id in enumerate(self.column(verse_id).tolist()):
+            if text_id != ABSENT:
+                ret.setdefault(text_id, []).append(self.hands[i][0])
+        return ret
+
+    def agreement(self, hand_id):
+        """
+        Compare one hand with every hand (including itself).
+
+        @returns: (agree, shared) arrays by row - the number of verses in
+                  which each hand has the same text as this one, and the
+                  number they both have
+        """
+        mine = self.row(hand_id)
+        present = (self.texts != ABSENT) & (mine != ABSENT)
+        agree = (self.texts == mine) & present
+        return agree.sum(axis=1), present.sum(axis=1)
+
+    def verse_count(self, hand_ids):
+        """
+        Return the number of verses that any of these hands have
+        """
+        rows = [self._rows[x] for x in hand_ids]
+        return int((self.texts[rows] != ABSENT).any(axis=0).sum())
+
+    def lacunae(self, hand_id):
+        """
+        Return the ids of the verses this hand doesn't have, but other
+        hands do
+        """
+        missing = (self.row(hand_id) == ABSENT) & (self.texts != ABSENT).any(axis=0)
+        return [self.verses[i][0] for i in np.flatnonzero(missing)]
+
+
+def _paths(book_num):
+    """
+    Return the path of the json file, and the path for a new .npy file
+    """
+    return (os.path.join(TEXT_MATRIX_FOLDER, 'book-{}.json'.format(book_num)),
+            os.path.join(TEXT_MATRIX_FOLDER, 'book-{}-{{}}.npy'.format(book_num)))
+
+
+@contextmanager
+def _locked(book_num, operation):
+    """
+    Hold a book's lock file - exclusively (fcntl.LOCK_EX) while its matrix
+    is saved, and shared (fcntl.LOCK_SH) while it's read
+    """
+    os.makedirs(TEXT_MATRIX_FOLDER, exist_ok=True)
+    with open(_paths(book_num)[0] + '.lock', 'a') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def save(book_num, matrix):
+    """
+    Store a book's matrix. The .npy file is named after its contents, and
+    written before the json file that refers to it - so readers always see
+    a matching pair. Saves of the same book take turns, so one can't tidy
+    up the .npy file another's json file refers to.
+    """
+    json_path, npy_path = _paths(book_num)
+    buf = io.BytesIO()
+    np.save(buf, matrix.texts)
+    data = buf.getvalue()
+    npy_path = npy_path.format(hashlib.sha224(data).hexdigest()[:16])
+    with _locked(book_num, fcntl.LOCK_EX):
+        _atomic_write(npy_path, data)
+        _atomic_write(json_path, json.dumps({'npy': os.path.basename(npy_path),
+                                             'hands': matrix.hands,
+                                             'verses': matrix.verses}).encode('utf-8'))
+
+        # Tidy up the old ones - anyone still using them has them mapped already
+        prefix = os.path.basename(json_path)[:-len('.json')] + '-'
+        for f in os.listdir(TEXT_MATRIX_FOLDER):
+            if f.startswith(prefix) and f.endswith('.npy') and f != os.path.basename(npy_path):
+                os.unlink(os.path.join(TEXT_MATRIX_FOLDER, f))
+
+
+def update_text_matrix(book_obj):
+    """
+    (Re)build and store a book's matrix
+    """
+    matrix = TextMatrix.build(book_obj)
+    logger.debug("Built the text matrix of {} ({} hands, {} verses)".format(
+                 book_obj.name, len(matrix.hands), len(matrix.verses)))
+    save(book_obj.num, matrix)
+    return matrix
+
+
+# {book num: ((inode, mtime) of the json file, TextMatrix)}
+_loaded = {}
+_lock = threading.Lock()
+
+
+def _read(json_path):
+    """
+    Read a matrix from its json file (and the .npy file it refers to)
+    """
+    with open(json_path, 'rb') as f:
+        data = json.loads(f.read().decode('utf-8'))
+    texts = np.load(os.path.join(TEXT_MATRIX_FOLDER, data['npy']), mmap_mode='r')
+    return TextMatrix(texts, data['hands'], data['verses'])
+
+
+def get_text_matrix(book_obj):
+    """
+    Return a book's matrix, reading it again if it's been rebuilt since we
+    last did - or building it if it's never been built (or its files have
+    gone).
+    """
+    json_path = _paths(book_obj.num)[0]
+    with _lock:
+        for attempt in range(2):
+            # Nobody can save it while we read it
+            with _locked(book_obj.num, fcntl.LOCK_SH):
+                try:
+                    st = os.stat(json_path)
+                    stamp = (st.st_ino, st.st_mtime_ns)
+                    cached = _loaded.get(book_obj.num)
+                    if cached is not None and cached[0] == stamp:
+                        return cached[1]
+                    matrix = _read(json_path)
+                except FileNotFoundError:
+                    if attempt:
+                        raise
+                else:
+                    _loaded[book_obj.num] = (stamp, matrix)
+                    return matrix
+
+            update_text_matrix(book_obj)
@@ -16,4 +16,7 @@ urlpatterns = [
     url(r'chapter_correctors.json', views.chapter_correctors_json),
     url(r'nexus.html', views.nexus),
     url(r'nexus_file.txt', views.nexus_file),
+    url(r'closest.json', views.closest_json),
+    url(r'attestations.json', views.attestations_json),
+    url(r'profile.json', views.profile_json),
 ]
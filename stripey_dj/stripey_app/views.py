@@ -1,17 +1,28 @@
-import json
-import string
+import os
 import re
+import json
 from collections import defaultdict
 import logging
+import numpy as np
 from django.shortcuts import render_to_response, get_object_or_404
 from stripey_app.models import (ManuscriptTranscription, Book, Chapter,
                                 Hand, Verse, MsVerse, get_all_verses,
                                 collate, Algorithm, MsChapter, MsBook)
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import (HttpResponseRedirect, HttpResponse, HttpResponseBadRequest,
+                         StreamingHttpResponse, FileResponse)
 
 from .memoize import memoize
+from .text_matrix import get_text_matrix
+from .agreement import get_label_matrix
+from .attestation import get_attestations
+from .nexus import get_characters, open_export, save_export
 logger = logging.getLogger('stripey_app.views')
 
+# The default number of variant units in each window of an agreement profile
+PROFILE_WINDOW = 50
+# How much of a file to read at a time, when serving part of it
+FILE_CHUNK_SIZE = 64 * 1024
+
 
 def default_response(request, url, data):
     if 'base_ms_id' not in data:
@@ -68,7 +79,8 @@ def search(request):
     """
     query = request.GET.get('query')
 
-    res = MsVerse.objects.filter(raw_text__icontains=query).order_by(
+    res = MsVerse.objects.filter(verse_text__raw__icontains=query).select_related(
+        'verse_text', 'hand__manuscript').order_by(
         'verse__chapter__book__num',
         'verse__chapter__num',
         'verse__num',
@@ -164,9 +176,9 @@ def manuscript(request):
             book.chapters = chapters
 
             # Now calculate how many corrected verses there are in this book
-            n_corr = len(set([x.verse for x in
-                              MsVerse.objects.filter(hand__manuscript=ms,
-                                                     verse__chapter__book=book).exclude(hand__name='firsthand')]))
+            matrix = get_text_matrix(book)
+            n_corr = matrix.verse_count([x[0] for x in matrix.hands
+                                         if x[1] == ms.id and x[2] != 'firsthand'])
             n_vs = MsVerse.objects.filter(hand__manuscript=ms,
                                           verse__chapter__book=book,
                                           hand__name='firsthand').count()
@@ -189,9 +201,16 @@ def manuscript(request):
 
     correctors = [x.name for x in sorted(hands, key=lambda z:z.handorder) if x.name != 'firsthand']
 
+    # The collation to draw the agreement profile from
+    algorithms = Algorithm.objects.order_by('id')
+    algorithm = algorithms.filter(name=request.GET.get('al')).first() or algorithms.first()
+
     return default_response(request,
                             'manuscript.html',
                             {'ms': ms,
+                             'algorithms': algorithms,
+                             'algorithm': algorithm,
+                             'profile_window': PROFILE_WINDOW,
                              'correctors': correctors,
                              'corrections_per_book': corrections_per_book,
                              'books': my_books,
@@ -479,12 +498,56 @@ def nexus(request):
                              'ga_regex': ga_regex})
 
 
+def _file_response(request, f, content_type):
+    """
+    Return a response serving an open file - or the part of it asked for by
+    a Range header (just a single range, which is all anyone asks for).
+    """
+    size = os.fstat(f.fileno()).st_size
+    match = re.match(r'bytes=(\d*)-(\d*)$', request.META.get('HTTP_RANGE', ''))
+    if not match or not any(match.groups()):
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    start, end = match.groups()
+    if not start:
+        # The last "end" bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    def read_range(length):
+        with f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(length, FILE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    response = StreamingHttpResponse(read_range(end + 1 - start), status=206,
+                                     content_type=content_type)
+    response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Content-Length'] = end + 1 - start
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 def nexus_file(request):
     """
-    Takes a collation and makes a SplitsTree4-compatible nexus file
+    Takes a collation and makes a SplitsTree4-compatible nexus file. It's
+    streamed out as it's made, and saved - so the next request for it is
+    served from the saved file.
     """
-    base_ms_id = int(request.COOKIES.get('base_ms', '0'))
-    bk = request.GET.get('bk')
+    bk = _int_from_val(request.GET.get('bk'))
     ch = _int_from_val(request.GET.get('ch'))
     v = _int_from_val(request.GET.get('v'))
     frag = _int_from_val(request.GET.get('frag'), 0)
@@ -492,155 +555,107 @@ def nexus_file(request):
     nexus_variant = request.GET.get('variant', None)
     ga_regex = request.GET.get('ga_regex', '')
 
-    nexus = _nexus_file(bk, ch, v, al, base_ms_id, nexus_variant, frag, ga_regex)
-    return HttpResponse(nexus, content_type='text/plain')
+    args = (bk, ch, v, al, nexus_variant, frag, ga_regex)
+    f = open_export(*args)
+    if f is not None:
+        return _file_response(request, f, 'text/plain')
 
+    chunks = get_characters(bk, al).nexus(ch, v, nexus_variant, frag, ga_regex)
+    return StreamingHttpResponse(save_export(chunks, *args), content_type='text/plain')
 
-@memoize
-def _nexus_file(bk, ch, v, al, base_ms_id, variant="default", frag=0, ga_regex=None):
-    """
-    Memoized innards of the nexus file creation
-    @param bk: book num
-    @param ch: chapter num or None for all chapters
-    @param v: verse num or None for all verses
-    @param al: algorithm name to use, e.g. dekker
-    @param base_ms_id: id of the base manuscript for the collation
-    @param variant: NEXUS file variant to create. Options are:
-        * default - default (Mesquite and my modified MrBayes
-        * mrbayes - has restrictions on symbols that can be used
-    @param frag: the threshold (percentage) of variant units that a witness
-             needs to have so as not to be considered "fragmentary" and thus
-             be excluded.
-    @param ga_regex: (optional) a regular expression used to restrict the witnesses
-    """
-    book_obj = Book.objects.get(num=bk)
-    if ch is not None:
-        chapter_obj = Chapter.objects.get(book=book_obj,
-                                          num=ch)
-        if v is not None:
-            verse_obj = Verse.objects.get(chapter=chapter_obj,
-                                          num=v)
-        else:
-            verse_obj = None
-    else:
-        chapter_obj = None
-        verse_obj = None
 
-    algorithm_obj = Algorithm.objects.get(name=al)
+def closest_json(request):
+    """
+    Return the witnesses that agree most with a manuscript hand in a book,
+    chapter or verse - according to the chosen algorithm's collation.
+    """
+    ms = get_object_or_404(ManuscriptTranscription, pk=request.GET.get('ms_id'))
+    hand = get_object_or_404(Hand, manuscript=ms, name=request.GET.get('hand', 'firsthand'))
+    bk = _int_from_val(request.GET.get('bk'))
+    ch = _int_from_val(request.GET.get('ch'))
+    v = _int_from_val(request.GET.get('v'))
+    al = request.GET.get('al')
+    k = _int_from_val(request.GET.get('k'), 10)
+
+    matrix = get_label_matrix(bk, ch, v, al)
+    closest = []
+    for (hand_id, ms_id, ga, name), agree, compared in matrix.closest(hand.id, k):
+        closest.append({'ms_id': ms_id,
+                        'ga': ga,
+                        'hand': name,
+                        'agree': agree,
+                        'compared': compared,
+                        'percent': 100.0 * agree / compared})
+
+    ret = {'ms_id': ms.id,
+           'ga': ms.ga,
+           'hand': hand.name,
+           'closest': closest}
+
+    return HttpResponse(json.dumps(ret), content_type='application/json')
 
-    ga_regex_re = None
-    if ga_regex:
-        ga_regex_re = re.compile(ga_regex)
 
-    # Get our memoized collation data
-    collation = collate(book_obj, chapter_obj, verse_obj, algorithm_obj, base_ms_id)
+def attestations_json(request):
+    """
+    Return the variant units in a book with readings whose witnesses match
+    a query - see attestation.py for what the queries look like.
+    """
+    bk = _int_from_val(request.GET.get('bk'))
+    al = request.GET.get('al')
+    query = request.GET.get('q', '')
+    limit = _int_from_val(request.GET.get('limit'), 100)
+
+    try:
+        count, units = get_attestations(bk, al).units(query, limit)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e), content_type='text/plain')
+
+    ret = {'query': query,
+           'count': count,
+           'units': [{'chapter': chapter_num,
+                      'verse': verse_num,
+                      'variant': variant_num,
+                      'readings': [{'label': label, 'text': text, 'witnesses': witnesses}
+                                   for label, text, witnesses in readings]}
+                     for chapter_num, verse_num, variant_num, readings in units]}
 
-    if variant == 'mrbayes':
-        LABELS = "0123456789"  # mrbayes doesn't support custom symbols...
-    else:
-        LABELS = string.ascii_letters
-
-    MISSING = "-"
-    GAP = "?"
-
-    # to keep a list of unique taxa and count their variant units:
-    taxa = defaultdict(int)
-    symbols = set()
-    matrix = {}  # keyed on verse, then {(ms_ga, hand_name): [labels], ...}
-
-    for verse, data in collation:
-        matrix[verse] = {}
-        for stripe, mss in data:
-            if ga_regex_re:
-                mss = [x for x in mss if ga_regex_re.match(x.ms_verse.hand.manuscript.ga)]
-                if not mss:
-                    continue
-                #~ print "Restricting by {} to {} mss".format(ga_regex, len(mss))
-
-            stripe_labels = []
-            for r in stripe.readings.all():
-                if r.label == 0:
-                    # Label 0 implies blank text => gap
-                    stripe_labels.append(GAP)
-                elif r.label > len(LABELS):
-                    raise ValueError("Unsupported label index {} - check NEXUS variant"
-                                     .format(r.label))
-                else:
-                    symbols.add(LABELS[r.label - 1])
-                    stripe_labels.append(LABELS[r.label - 1])
-
-            for ms in mss:
-                hand = ms.ms_verse.hand
-                ident = (hand.manuscript.ga,
-                         hand.name.replace('(', '').replace(')', '').replace(':', '_'))
-                if ident in matrix[verse]:
-                    # Can't handle multiple instances of the same passage
-                    # in a given hand. Ignore the rest...
-                    print(("Ignoring {}'s subsequent reading of {}".format(
-                        ident, ms.ms_verse.verse)))
-                    continue
-                matrix[verse][ident] = stripe_labels
-                taxa[ident] += len(stripe_labels)
-        if matrix[verse] == {}:
-            print(("WARNING: Empty dict for {} - it will be omitted".format(verse)))
-            del matrix[verse]
-
-    # Remove fragmentary witnesses
-    frag_thresh = max(taxa.values()) * frag / 100.0
-    labs = [x for x in sorted(taxa.keys())
-            if taxa[x] >= frag_thresh]
-    if len(labs) < len(taxa):
-        print(("WARNING: Ignoring {} fragmentary witnesses (threshold {}%)"
-               .format(len(taxa) - len(labs), frag)))
-
-    # Taxa section
-    nexus = """#nexus
-BEGIN Taxa;
-DIMENSIONS ntax={};
-TAXLABELS
-""".format(len(labs))
-    for i, l in enumerate(labs):
-        #nexus += "[{}] '{}_{}'\n".format(i + 1, l[0], l[1])
-        nexus += "{}_{}\n".format(l[0], l[1])
-    nexus += ";\nEND;"
-
-    # Characters section
-    syms = sorted(symbols)
-
-    # Now the matrix
-    matrix_bit = "MATRIX\n"
-    linelength = None
-    for lab in labs:
-        all_chars = []
-        for verse in matrix:
-            if lab in matrix[verse]:
-                all_chars.extend(matrix[verse][lab])
-            else:
-                # Add correct num of "missing" signs
-                any_old_lab = list(matrix[verse].keys())[0]
-                for i in range(len(matrix[verse][any_old_lab])):
-                    all_chars.append(MISSING)
-        else:
-            if linelength is not None:
-                assert linelength == len(all_chars), (linelength, len(all_chars))
-            linelength = len(all_chars)
-            matrix_bit += "{}_{} {}\n".format(lab[0], lab[1], ''.join(all_chars))
-
-    nexus += """
-BEGIN Characters;
-DIMENSIONS nchar={};
-
-FORMAT
-    datatype=STANDARD
-    missing={}
-    gap={}
-    symbols="{}"
-;
-""".format(linelength, MISSING, GAP, ' '.join(syms))
-
-    nexus += matrix_bit
-    nexus += """;
-END;
-"""
-
-    return nexus
+    return HttpResponse(json.dumps(ret), content_type='application/json')
+
+
+def profile_json(request):
+    """
+    Return how much a manuscript hand agrees with its closest witnesses
+    over a window of variant units sliding through a book - to show where
+    its affinities change.
+    """
+    ms = get_object_or_404(ManuscriptTranscription, pk=request.GET.get('ms_id'))
+    hand = get_object_or_404(Hand, manuscript=ms, name=request.GET.get('hand', 'firsthand'))
+    bk = _int_from_val(request.GET.get('bk'))
+    al = request.GET.get('al')
+    window = _int_from_val(request.GET.get('window'), PROFILE_WINDOW)
+    k = _int_from_val(request.GET.get('k'), 5)
+    # Only send every step'th window
+    step = _int_from_val(request.GET.get('step'), max(1, window // 10))
+
+    matrix = get_label_matrix(bk, None, None, al)
+    closest = matrix.closest(hand.id, k)
+    rates = matrix.profile(hand.id, window, [x[0][0] for x in closest])
+    starts = list(range(0, rates.shape[1], step))
+    window = len(matrix.variants) - rates.shape[1] + 1
+
+    ret = {'ms_id': ms.id,
+           'ga': ms.ga,
+           'hand': hand.name,
+           'window': window,
+           # The chapter and verse of the first and last variant unit of each window
+           'windows': [[matrix.variants[i][1:], matrix.variants[i + window - 1][1:]]
+                       for i in starts],
+           'series': [{'ms_id': ms_id,
+                       'ga': ga,
+                       'hand': name,
+                       'percent': [None if np.isnan(x) else round(float(x), 1)
+                                   for x in row[starts]]}
+                      for ((hand_id, ms_id, ga, name), agree, compared), row
+                      in zip(closest, rates)]}
+
+    return HttpResponse(json.dumps(ret), content_type='application/json')
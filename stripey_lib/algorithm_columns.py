@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert a database from before Reading, StripeReading and MsStripe had their
+own algorithm column, when only Variant and Stripe did.
+
+The algorithm_id column is added to each of the three tables, filled in from
+the variant or stripe, and then made NOT NULL with a foreign key (on
+PostgreSQL - SQLite can't add those to an existing column, which Django
+doesn't mind).
+
+partitions.py does this first, if it needs doing. This works on PostgreSQL
+and SQLite.
+"""
+
+import os
+import sys
+import logging
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import Algorithm, Variant, Reading, Stripe, StripeReading, MsStripe  # NOQA
+from stripey_app.memoize import memoize  # NOQA
+from django.db import connection, transaction  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# (model, column, model it gets its algorithm from) for each table to convert
+CONVERSIONS = ((Reading, 'variant_id', Variant),
+               (StripeReading, 'stripe_id', Stripe),
+               (MsStripe, 'stripe_id', Stripe))
+
+
+def execute(sql, params=None):
+    logger.debug(sql)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _columns(model):
+    with connection.cursor() as cursor:
+        return [x.name for x in connection.introspection.get_table_description(
+                cursor, model._meta.db_table)]
+
+
+def needs_converting():
+    """
+    Are any of the tables still without their algorithm_id column?
+    """
+    return any('algorithm_id' not in _columns(model) for model, column, source in CONVERSIONS)
+
+
+@transaction.atomic
+def convert():
+    """
+    Add and fill in the algorithm_id columns
+    """
+    algorithm_table = Algorithm._meta.db_table
+    for model, column, source in CONVERSIONS:
+        table = model._meta.db_table
+        if 'algorithm_id' in _columns(model):
+            continue
+
+        logger.info("Updating {}".format(table))
+        execute("ALTER TABLE {} ADD COLUMN algorithm_id integer NULL".format(table))
+        execute("UPDATE {0} SET algorithm_id = (SELECT algorithm_id FROM {1} WHERE {1}.id = {0}.{2})"
+                .format(table, source._meta.db_table, column))
+        execute("CREATE INDEX {0}_algorithm_id ON {0} (algorithm_id)".format(table))
+        if connection.vendor == 'postgresql':
+            execute("ALTER TABLE {} ALTER COLUMN algorithm_id SET NOT NULL".format(table))
+            execute("ALTER TABLE {} ADD FOREIGN KEY (algorithm_id) REFERENCES {} (id) "
+                    "DEFERRABLE INITIALLY DEFERRED".format(table, algorithm_table))
+
+    memoize.invalidate_all()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not needs_converting():
+        print("The collation tables already have their algorithm columns")
+        sys.exit(0)
+
+    print("Add the algorithm column to the collation tables? [N/y]")
+    ok = input()
+    if ok.strip().lower() == 'y':
+        convert()
+        print("Done")
+    else:
+        print("Aborting")
@@ -8,22 +8,50 @@ import subprocess
 import signal
 import socket
 import json
+import string
 import urllib.request
 import urllib.error
 import urllib.parse
 import multiprocessing
 import logging
+import functools
 import collatex
+import Levenshtein
+from collections import Counter, defaultdict, namedtuple
 from contextlib import contextmanager
+from itertools import groupby
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8 - we'll pass the texts through the queue instead
+    shared_memory = None
 
 # Collatex settings:
 COLLATEX_JAR = "collatex-tools-1.7.1.jar"  # For Needleman-Wunsch and Medite
 # How many colatex errors before we restart the service?
 MAX_COLLATEX_ERRORS = 1
-SUPPORTED_ALGORITHMS = ('python', 'dekker', 'needleman-wunsch', 'medite')
+SUPPORTED_ALGORITHMS = ('python', 'numpy-nw', 'dekker', 'needleman-wunsch', 'medite')
+# These algorithms run in our own processes, without the java service
+IN_PROCESS_ALGORITHMS = ('python', 'numpy-nw')
 # levenstein distance: the edit distance threshold for optional fuzzy matching
 #                      of tokens; the default is exact matching
 FUZZY_EDIT_DISTANCE = 3
+# Micro-batching cost model (seconds): every collatex request has a fixed
+# overhead, plus a cost that grows with the number of witnesses and the square
+# of the number of tokens to align.
+COLLATEX_REQUEST_COST = 0.05
+COLLATEX_TOKEN_COST = 2e-6
+# We can't have more verses in a batch than we have sentinels
+MAX_BATCH_VERSES = 26
+# Anchor segmentation: only split verses where a witness has at least this
+# many tokens - shorter verses are quicker to collate in one go
+ANCHOR_MIN_TOKENS = 12
+# Progressive collation: cluster the distinct texts of verses with at least
+# this many of them, putting texts in the same cluster if they are at least
+# CLUSTER_SIMILARITY similar (Levenshtein ratio) to its first text
+PROGRESSIVE_MIN_TEXTS = 40
+CLUSTER_SIMILARITY = 0.9
+MAX_CLUSTER_SIZE = 25
 
 # Sort out the paths so we can import the django stuff
 sys.path.append('../stripey_dj/')
@@ -32,25 +60,120 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
 import django  # NOQA
 django.setup()
 
+from stripey_app.memoize import memoize  # NOQA
 from stripey_app.models import (Chapter, Verse, MsVerse, Book,
-                                get_all_verses, Variant, Reading,
-                                Stripe, MsStripe, Algorithm)  # NOQA
-from django.db import transaction, reset_queries, connections  # NOQA
+                                Variant, Reading,
+                                Stripe, StripeReading, MsStripe, Algorithm,
+                                CollationSnapshot, AttestationIndex, CharacterMatrix,
+                                materialize)  # NOQA
+from stripey_app.attestation import build_index  # NOQA
+from stripey_app.nexus import build_matrix  # NOQA
+from django.db import transaction, reset_queries, connection, connections  # NOQA
 from django.core.exceptions import ObjectDoesNotExist  # NOQA
+from stripey_lib.regularize import regularize  # NOQA
+from stripey_lib.numpy_collate import collate_numpy  # NOQA
+from stripey_lib.partitions import is_partitioned, ensure_partitions, truncate_partitions  # NOQA
 
 logger = logging.getLogger(__name__)
 
+# The workers get these plain tuples, rather than model objects, so they
+# never need to go to the database for anything but storing the results.
+VerseRef = namedtuple('VerseRef', 'book chapter num id')
+# key identifies the hand (and duplicate item), and so one witness across the
+# verses in a batch. text is a WitnessArena reference.
+WitnessRef = namedtuple('WitnessRef', 'ms_verse_id key text')
+
+
+class WitnessArena(object):
+    """
+    The normalized witness texts for a collation, encoded as UTF-8 into one
+    block of shared memory. The parent creates it, and the workers read texts
+    from it by (name, offset, length) - so nothing but those references has
+    to be pickled through the queue.
+    """
+    # Worker processes' attached arenas, by name
+    _attached = {}
+
+    def __init__(self, texts):
+        """
+        @param texts: {text id: text} - see VerseText
+        """
+        self._refs = {}
+        if shared_memory is None:
+            self._shm = None
+            self._refs = dict(texts)
+            return
+
+        blob = bytearray()
+        for text_id, text in texts.items():
+            data = text.encode('utf-8')
+            self._refs[text_id] = (len(blob), len(data))
+            blob += data
+
+        # A zero size block isn't allowed
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, len(blob)))
+        self._shm.buf[:len(blob)] = blob
+        self.name = self._shm.name
+        self._attached[self.name] = self._shm
+        logger.debug("Created witness arena {} ({} texts, {} bytes)".format(
+                     self.name, len(texts), len(blob)))
+
+    def ref(self, text_id):
+        """
+        Return a reference to the text with this id, for read()
+        """
+        if self._shm is None:
+            return self._refs[text_id]
+        offset, length = self._refs[text_id]
+        return (self.name, offset, length)
+
+    @classmethod
+    def read(cls, ref):
+        """
+        Return the text for a reference from ref(). This works in any of our
+        processes, attaching to the arena the first time it's needed.
+        """
+        if isinstance(ref, str):
+            return ref
+        name, offset, length = ref
+        if name not in cls._attached:
+            shm = shared_memory.SharedMemory(name=name)
+            # Only the parent should unlink the arena - otherwise a worker's
+            # resource tracker would remove it when that worker quits.
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            cls._attached[name] = shm
+        return str(cls._attached[name].buf[offset:offset + length], 'utf-8')
+
+    def close(self):
+        """
+        Free the shared memory - only once the workers are finished with it
+        """
+        if self._shm is not None:
+            del self._attached[self.name]
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
 
 class Collator(object):
-    def __init__(self, algo, *, port=7369, nworkers=3, timeout=900, collatex_jar=COLLATEX_JAR):
+    def __init__(self, algo, *, port=7369, nworkers=3, timeout=900, collatex_jar=COLLATEX_JAR,
+                 anchors=False, batch=False, verify_batches=False, regularize=False,
+                 progressive=False, merge=False):
         self.algo = algo
         self.port = port
+        self.anchors = anchors
+        self.merge = merge
+        self.progressive = progressive
+        self.regularize = regularize
+        self.batch = batch
+        self.verify_batches = verify_batches
         self.workers = []
+        self.arenas = []
         self.queue = multiprocessing.Queue()
         self._collatex_errors = multiprocessing.Value('i')
         self._successful_collations = multiprocessing.Value('i')
 
-        if algo.name == 'python':
+        if algo.name in IN_PROCESS_ALGORITHMS:
             # We don't need to start the java service
             self.cx = None
         else:
@@ -80,6 +203,9 @@ class Collator(object):
             # Tell collatex to quit
             self.cx.quit()
 
+        for arena in self.arenas:
+            arena.close()
+
         logger.debug("Done")
 
     def worker(self):
@@ -89,7 +215,8 @@ class Collator(object):
                 logger.debug("Worker quitting...")
                 return
 
-            self.collate_verse(*args)
+            method, args = args
+            getattr(self, method)(*args)
 
     def collate_book(self, book_obj, chapter_ref=None):
         """
@@ -99,49 +226,99 @@ class Collator(object):
         @chapter_ref: (int) chapter number to collate (or None for all)
         """
         logger.info("Collating book {}:{}".format(book_obj.num, book_obj.name))
-        for chapter_obj in Chapter.objects.filter(book=book_obj).order_by('num'):
-            if chapter_ref is None or chapter_ref == chapter_obj.num:
-                logger.info("Collating chapter {} {}".format(book_obj.name, chapter_obj.num))
-                all_verses = get_all_verses(book_obj, chapter_obj)
-                for v, mss in all_verses:
-                    verse_obj = Verse.objects.get(chapter=chapter_obj, num=v)
-                    # 1. check we've not already done this one
-                    if Variant.objects.filter(verse=verse_obj, algorithm=self.algo):
-                        logger.debug("Skipping {} ({}) as it's already done".format(v, self.algo.name))
-                        continue
-                    # 2. queue up the new collation
-                    mss_refs = []
-                    for ms, msverses in mss:
-                        mss_refs.append((ms.id, [x.id for x in msverses]))
-
-                    self.queue.put((book_obj, chapter_obj, verse_obj, mss))
-                    # 3. tidy up django's query list, to free up some memory
-                    reset_queries()
+        ms_verses = MsVerse.objects.filter(verse__chapter__book=book_obj)
+        if chapter_ref is not None:
+            ms_verses = ms_verses.filter(verse__chapter__num=chapter_ref)
+        # The same order as get_all_verses gives us
+        rows = list(ms_verses.order_by('verse__chapter__num', 'verse__num',
+                                       'hand__manuscript_id', 'hand_id', 'id')
+                    .values_list('verse__chapter__num', 'verse__num', 'verse_id',
+                                 'id', 'hand_id', 'item', 'verse_text_id',
+                                 'verse_text__normalized'))
+
+        # Load all the distinct texts into shared memory, once, for the workers
+        arena = WitnessArena({x[6]: x[7] for x in rows})
+        self.arenas.append(arena)
+
+        done = set(Variant.objects.filter(verse__chapter__book=book_obj, algorithm=self.algo)
+                   .values_list('verse_id', flat=True))
+
+        for chapter_num, chapter_rows in groupby(rows, key=lambda x: x[0]):
+            logger.info("Collating chapter {} {}".format(book_obj.name, chapter_num))
+            batch = []
+            for (v, verse_id), verse_rows in groupby(chapter_rows, key=lambda x: (x[1], x[2])):
+                # 1. check we've not already done this one
+                if verse_id in done:
+                    logger.debug("Skipping {} ({}) as it's already done".format(v, self.algo.name))
+                    continue
+                # 2. queue up the new collation
+                verse = VerseRef(book_obj.name, chapter_num, v, verse_id)
+                witnesses = [WitnessRef(x[3], "{}.{}".format(x[4], x[5]), arena.ref(x[6]))
+                             for x in verse_rows]
+
+                if not self.batch:
+                    self.queue.put(('collate_verse', (verse, witnesses)))
+                else:
+                    if batch and not worth_batching([x[1] for x in batch], witnesses):
+                        self._queue_batch(batch)
+                        batch = []
+                    batch.append((verse, witnesses))
 
-    @transaction.atomic
-    def collate_verse(self, book_obj, chapter_obj, verse_obj, mss):
+            if batch:
+                self._queue_batch(batch)
+
+            # 3. tidy up django's query list, to free up some memory
+            reset_queries()
+
+    def _queue_batch(self, batch):
+        if len(batch) == 1:
+            self.queue.put(('collate_verse', batch[0]))
+        else:
+            self.queue.put(('collate_batch', (batch, )))
+
+    def _collate(self, witnesses):
         """
-        We take simple integers for the book, chapter and verse so that
-        we can operate in a separate process safely.
+        Collate the witnesses with our algorithm, returning the collatex
+        {'witnesses', 'table'} structure.
         """
-        logger.debug("Collating verse {}:{}:{} ({})".format(chapter_obj.book.name,
-                                                            chapter_obj.num,
-                                                            verse_obj.num,
-                                                            self.algo.name))
-        start = time.time()
-        witnesses = []
-        for ms, verses in mss:
-            for verse in verses:
-                if verse.text:
-                    witnesses.append({'id': str(verse.id),
-                                      'content': verse.text})
+        collate_func = self._collate_witnesses
+        if self.progressive:
+            collate_func = functools.partial(collate_progressive, collate_func=collate_func)
+
+        if self.anchors:
+            return collate_segmented(witnesses, collate_func,
+                                     key=regularize if self.regularize else None)
+        else:
+            return collate_func(witnesses)
+
+    def _collate_witnesses(self, witnesses):
+        if self.regularize:
+            witnesses = [pretokenize(x) for x in witnesses]
 
         if self.algo.name == 'python':
             collation = collate_python(witnesses, self.algo.name)
+        elif self.algo.name == 'numpy-nw':
+            collation = collate_numpy(witnesses, self.algo.name)
+        else:
+            collation = self.cx.query(witnesses, self.algo.name)
+
+        return plain_collation(collation)
+
+    def collate_verse(self, verse, witnesses):
+        """
+        We take a VerseRef and WitnessRefs rather than model objects, so
+        that we can operate in a separate process safely.
+        """
+        logger.debug("Collating verse {}:{}:{} ({})".format(verse.book, verse.chapter,
+                                                            verse.num, self.algo.name))
+        witnesses = _verse_witnesses(witnesses)
+
+        if self.algo.name in IN_PROCESS_ALGORITHMS:
+            collation = self._collate(witnesses)
         else:
             try:
                 # Get the apparatus from collatex - this is the clever bit...
-                collation = self.cx.query(witnesses, self.algo.name)
+                collation = self._collate(witnesses)
             except Exception as e:
                 # Collate failed
                 with self._collatex_errors.get_lock():
@@ -152,81 +329,123 @@ class Collator(object):
                         self._collatex_errors.value = 0
                 return
 
+        self._store_collation(verse, collation)
+
+    def collate_batch(self, batch):
+        """
+        Collate several short verses in a single request, with sentinel
+        tokens between them, and store each verse's collation separately.
+        If anything goes wrong the verses are collated one by one instead.
+
+        @param batch: list of (verse, witnesses) tuples, as for collate_verse
+        """
+        first = batch[0][0]
+        logger.debug("Collating {} verses {}:{}:{}-{} in one batch ({})".format(
+                     len(batch), first.book, first.chapter,
+                     first.num, batch[-1][0].num, self.algo.name))
+        verse_texts = [_verse_texts(witnesses) for verse, witnesses in batch]
+        try:
+            collation = self._collate_witnesses(batch_witnesses(verse_texts))
+            collations = split_batch(collation, verse_texts)
+        except Exception as e:
+            logger.warning("Batch collation failed ({}) - collating verses separately".format(e))
+            for verse, witnesses in batch:
+                self.collate_verse(verse, witnesses)
+            return
+
+        for (verse, witnesses), collation in zip(batch, collations):
+            # Our batch witnesses are hands - so convert them back to ms_verses
+            ms_verse_ids = {x.key: str(x.ms_verse_id) for x in witnesses}
+            collation['witnesses'] = [ms_verse_ids[x] for x in collation['witnesses']]
+
+            if self.verify_batches:
+                single = self._collate(_verse_witnesses(witnesses))
+                if not same_collation(collation, single):
+                    logger.warning("Batched collation of {}:{}:{} doesn't match per-verse "
+                                   "collation - using the latter".format(verse.book, verse.chapter,
+                                                                         verse.num))
+                    collation = single
+
+            self._store_collation(verse, collation)
+
+    @transaction.atomic
+    def _store_collation(self, verse, collation):
+        """
+        Store a verse's collation in the database. We only write here - the
+        reading labels and stripes are worked out in memory.
+        """
+        start = time.time()
         logger.debug(" .. collatex produced {} entries for {} witnesses".format(
                      len(collation['table']),
                      len(collation['witnesses'])))
 
+        if self.merge:
+            n_columns = len(collation['table'])
+            collation = merge_variant_units(collation)
+            logger.info("Merged variant units in {}:{}:{} - {} -> {}".format(
+                        verse.book, verse.chapter, verse.num,
+                        n_columns, len(collation['table'])))
+
         count = 0
 
-        # Store the readings per ms_verse for later
-        mv_readings = {}
+        # Store the readings per ms_verse id for later
+        mv_readings = defaultdict(list)
 
         for i, entry in enumerate(collation['table']):
             # entry = appararus entry = a variant unit
             variant = Variant()
-            variant.chapter = chapter_obj
-            variant.verse = verse_obj
+            variant.verse_id = verse.id
             variant.variant_num = i
             variant.algorithm = self.algo
             variant.save()
             sys.stdout.write('v')
 
+            readings = {}
             for j, sigil in enumerate(collation['witnesses']):
                 # sigil = a witness = a verse object's id
-                ms_verse = MsVerse.objects.get(id=int(sigil))
                 text = str(' '.join([x.strip() for x in entry[j]]))
 
-                # Get the reading object, or make a new one
-                try:
-                    reading = Reading.objects.get(text=text,
-                                                  variant=variant)
-                except ObjectDoesNotExist:
+                # Get the reading object, or make a new one - labelled in
+                # order of appearance, as Reading.save() would.
+                if text not in readings:
                     reading = Reading()
                     reading.variant = variant
+                    reading.algorithm = self.algo
                     reading.text = text
+                    reading.label = len([x for x in readings if x]) + 1 if text else 0
                     reading.save()
+                    readings[text] = reading
                     sys.stdout.write('r')
 
                 # Store this reading against the correct hand
-                if ms_verse not in mv_readings:
-                    mv_readings[ms_verse] = []
-                mv_readings[ms_verse].append(reading)
+                mv_readings[int(sigil)].append(readings[text])
 
                 count += 1
                 sys.stdout.write("+")
                 sys.stdout.flush()
 
-        # Now sort out the stripes
+        # Now sort out the stripes - one for each unique tuple of readings
         stripe_mapping = {}
+        through = []
         for readings in set([tuple(a) for a in list(mv_readings.values())]):
-            # Get the stripe object, or make a new one, for each unique
-            # tuple of readings.
-            try:
-                stripe = None
-                for poss in Stripe.objects.filter(readings__in=readings):
-                    if poss.readings == readings:
-                        stripe = poss
-                        break
-                if not stripe:
-                    raise ValueError("Can't find one")
-            except (ObjectDoesNotExist, ValueError):
-                stripe = Stripe()
-                stripe.verse = verse_obj
-                stripe.algorithm = self.algo
-                stripe.save()
-                stripe.readings = readings
-                stripe.save()
-                sys.stdout.write('s')
-                sys.stdout.flush()
+            stripe = Stripe()
+            stripe.verse_id = verse.id
+            stripe.algorithm = self.algo
+            stripe.save()
+            through.extend(StripeReading(stripe=stripe, reading=x, algorithm=self.algo)
+                           for x in set(readings))
+            sys.stdout.write('s')
+            sys.stdout.flush()
 
             stripe_mapping[readings] = stripe
 
-        for ms_verse, readings in list(mv_readings.items()):
-            # Save our hand-stripe
-            hs = MsStripe()
-            hs.stripe = stripe_mapping[tuple(readings)]
-            hs.ms_verse = ms_verse
-            hs.save()
+        StripeReading.objects.bulk_create(through)
+
+        # Save our hand-stripes
+        MsStripe.objects.bulk_create([MsStripe(stripe=stripe_mapping[tuple(readings)],
+                                               ms_verse_id=ms_verse_id,
+                                               algorithm=self.algo)
+                                      for ms_verse_id, readings in mv_readings.items()])
 
         t = time.time() - start
         sys.stdout.write('\n')
@@ -241,51 +460,107 @@ class Collator(object):
             logger.debug("CURRENT COLLATEX ERROR COUNT: {}".format(self._collatex_errors.value))
 
 
-@transaction.atomic
-def drop_all(algo, chapter_ref=None):
+def _collation_tables():
+    """
+    Return [(table, where)] for deleting one algorithm's collation of one
+    chapter - in dependency order. The where clauses take (algorithm id,
+    chapter id) parameters.
     """
-    Clear out all collation data from the db
+    verses = "SELECT id FROM {} WHERE chapter_id = %s".format(Verse._meta.db_table)
+    stripes = "SELECT id FROM {} WHERE algorithm_id = %s AND verse_id IN ({})".format(
+        Stripe._meta.db_table, verses)
+    variants = "SELECT id FROM {} WHERE algorithm_id = %s AND verse_id IN ({})".format(
+        Variant._meta.db_table, verses)
+    return [(CollationSnapshot._meta.db_table, "algorithm_id = %s AND verse_id IN ({})".format(verses)),
+            (MsStripe._meta.db_table, "stripe_id IN ({})".format(stripes)),
+            (StripeReading._meta.db_table, "stripe_id IN ({})".format(stripes)),
+            (Reading._meta.db_table, "variant_id IN ({})".format(variants)),
+            (Stripe._meta.db_table, "algorithm_id = %s AND verse_id IN ({})".format(verses)),
+            (Variant._meta.db_table, "algorithm_id = %s AND verse_id IN ({})".format(verses))]
+
+
+def drop_all(algo, chapter_ref=None, dry_run=False):
+    """
+    Clear out all collation data from the db. This deletes whole sets of
+    rows with a few statements per chapter, rather than going through
+    django's per-object cascade.
 
     @param algo: name of an algorithm
     @param chapter_ref: book:chapter, e.g. 04:11, to collate
+    @param dry_run: just count what would be deleted
     """
-    logger.warning("Clearing out old data for {}".format(algo))
+    logger.warning("{} old data for {}".format("Counting" if dry_run else "Clearing out", algo))
 
-    to_del = []
-    if chapter_ref is None:
-        for v in Variant.objects.filter(algorithm__name=algo):
-            to_del.append(v)
-        for s in Stripe.objects.filter(algorithm__name=algo):
-            to_del.append(s)
-    else:
+    try:
+        algo_obj = Algorithm.objects.get(name=algo)
+    except ObjectDoesNotExist:
+        logger.warning("No data for {}".format(algo))
+        return
+
+    if chapter_ref is None and not dry_run and is_partitioned():
+        # Everything for this algorithm is in its own partitions
+        logger.warning(" > Truncating the {} partitions".format(algo))
+        with transaction.atomic():
+            CollationSnapshot.objects.filter(algorithm=algo_obj).delete()
+            AttestationIndex.objects.filter(algorithm=algo_obj).delete()
+            CharacterMatrix.objects.filter(algorithm=algo_obj).delete()
+            truncate_partitions(algo_obj)
+        memoize.invalidate_all()
+        logger.warning("Done")
+        return
+
+    chapters = Chapter.objects.select_related('book').order_by('book__num', 'num')
+    if chapter_ref is not None:
         mubook, muchapter = chapter_ref.split(':')
-        mubook = int(mubook)
-        muchapter = int(muchapter)
-        for v in Variant.objects.filter(algorithm__name=algo,
-                                        verse__chapter__num=muchapter,
-                                        verse__chapter__book__num=mubook):
-            to_del.append(v)
-        for s in Stripe.objects.filter(algorithm__name=algo,
-                                       verse__chapter__num=muchapter,
-                                       verse__chapter__book__num=mubook):
-            to_del.append(s)
-
-    logger.warning(" > Deleting {} objects".format(len(to_del)))
-    print()
-    for i, x in enumerate(to_del):
-        x.delete()
-        sys.stdout.write("\r > {} ({}%)   ".format(i + 1, i * 100.0 / len(to_del)))
-    print()
-
-    logger.warning("Done")
-
-
-def collate_all(algo, *, chapter_ref=None, port=7369, timeout=900, workers=3, collatex_jar=COLLATEX_JAR):
+        chapters = chapters.filter(book__num=int(mubook), num=int(muchapter))
+
+    tables = _collation_tables()
+    totals = Counter()
+    for chapter_obj in chapters:
+        counts = Counter()
+        with transaction.atomic(), connection.cursor() as cursor:
+            for table, where in tables:
+                params = [algo_obj.id, chapter_obj.id]
+                if dry_run:
+                    cursor.execute("SELECT COUNT(*) FROM {} WHERE {}".format(table, where), params)
+                    counts[table] = cursor.fetchone()[0]
+                else:
+                    cursor.execute("DELETE FROM {} WHERE {}".format(table, where), params)
+                    counts[table] = cursor.rowcount
+
+        totals.update(counts)
+        logger.info(" > {} {} {}: {}".format("Would delete" if dry_run else "Deleted",
+                                              chapter_obj.book.name, chapter_obj.num,
+                                              ', '.join("{} {}".format(counts[table], table)
+                                                        for table, where in tables)))
+
+    if not dry_run:
+        # The books' attestation indexes and character matrices are out of
+        # date too
+        AttestationIndex.objects.filter(algorithm=algo_obj,
+                                        book__in=chapters.values('book_id')).delete()
+        CharacterMatrix.objects.filter(algorithm=algo_obj,
+                                       book__in=chapters.values('book_id')).delete()
+        memoize.invalidate_all()
+    logger.warning("Done - {} {} rows".format("would delete" if dry_run else "deleted",
+                                              sum(totals.values())))
+    return totals
+
+
+def collate_all(algo, *, chapter_ref=None, port=7369, timeout=900, workers=3, collatex_jar=COLLATEX_JAR,
+                anchors=False, batch=False, verify_batches=False, regularize=False,
+                progressive=False, merge=False):
     """
     Collate everything using the collatex service
 
     @param algo: name of an algorithm
     @param chapter_ref: book:chapter, e.g. 04:11, to collate
+    @param anchors: split long verses at anchor tokens before collating
+    @param batch: collate consecutive short verses together in one request
+    @param verify_batches: check batched collations against per-verse ones
+    @param regularize: align on regularized spellings rather than fuzzy matching
+    @param progressive: collate clusters of similar texts, then align the clusters
+    @param merge: merge adjacent variant units that divide the witnesses the same way
     """
     if chapter_ref:
         mubook, muchapter = chapter_ref.split(':')
@@ -300,14 +575,480 @@ def collate_all(algo, *, chapter_ref=None, port=7369, timeout=900, workers=3, co
         algo_obj = Algorithm()
         algo_obj.name = algo
         algo_obj.save()
+    ensure_partitions(algo_obj)
 
-    coll = Collator(algo_obj, port=port, timeout=timeout, nworkers=workers, collatex_jar=collatex_jar)
+    coll = Collator(algo_obj, port=port, timeout=timeout, nworkers=workers, collatex_jar=collatex_jar,
+                    anchors=anchors, batch=batch, verify_batches=verify_batches,
+                    regularize=regularize, progressive=progressive, merge=merge)
     for book in Book.objects.all():
         if mubook is None or book.num == mubook:
             coll.collate_book(book, muchapter)
 
     coll.quit()
 
+    chapters = Chapter.objects.select_related('book').order_by('book__num', 'num')
+    if mubook is not None:
+        chapters = chapters.filter(book__num=mubook)
+    if muchapter is not None:
+        chapters = chapters.filter(num=muchapter)
+    materialize_all(algo_obj, chapters)
+
+    for book in Book.objects.all():
+        if mubook is None or book.num == mubook:
+            logger.info("Indexing the attestations of {}".format(book.name))
+            build_index(algo_obj, book)
+            logger.info("Building the character matrix of {}".format(book.name))
+            build_matrix(algo_obj, book)
+
+    # The web app's cached data is out of date now
+    memoize.invalidate_all()
+
+
+def materialize_all(algo_obj, chapters):
+    """
+    Make the collation snapshots (see CollationSnapshot) for every collated
+    verse in these chapters that doesn't have one - which, as drop_all
+    removes the snapshots with the rest of the collation, are the ones whose
+    collation has changed.
+
+    @param algo_obj: the algorithm
+    @param chapters: a queryset of chapters
+    """
+    total = 0
+    for chapter_obj in chapters:
+        collated = Stripe.objects.filter(algorithm=algo_obj,
+                                         verse__chapter=chapter_obj).values('verse_id')
+        materialized = CollationSnapshot.objects.filter(algorithm=algo_obj,
+                                                        verse__chapter=chapter_obj).values('verse_id')
+        count = materialize(algo_obj, Verse.objects.filter(id__in=collated).exclude(id__in=materialized))
+        if count:
+            logger.info(" > Materialized {} verses of {} {}".format(
+                        count, chapter_obj.book.name, chapter_obj.num))
+        total += count
+    logger.info("Materialized {} verses for {}".format(total, algo_obj.name))
+
+
+def find_anchors(token_lists):
+    """
+    Find the anchor tokens in a verse - those that occur exactly once in
+    every witness, and in the same order in all of them.
+
+    @param token_lists: a list of token lists, one per witness
+    @returns: a list of anchors, each one a tuple of the anchor's index in
+              each witness
+    """
+    if not token_lists:
+        return []
+
+    counts = [Counter(tokens) for tokens in token_lists]
+    candidates = [t for t in token_lists[0]
+                  if all(c[t] == 1 for c in counts)]
+    positions = [tuple(tokens.index(t) for tokens in token_lists)
+                 for t in candidates]
+
+    # The positions are in order for the first witness, so find the longest
+    # chain of them that is also in order in all the other witnesses.
+    length = [1] * len(positions)
+    previous = [None] * len(positions)
+    for j, pos_j in enumerate(positions):
+        for i in range(j):
+            if (length[i] + 1 > length[j] and
+                    all(a < b for a, b in zip(positions[i], pos_j))):
+                length[j] = length[i] + 1
+                previous[j] = i
+
+    anchors = []
+    if positions:
+        i = length.index(max(length))
+        while i is not None:
+            anchors.append(positions[i])
+            i = previous[i]
+        anchors.reverse()
+
+    return anchors
+
+
+def collate_segmented(witnesses, collate_func, key=None):
+    """
+    Split the witnesses at anchor tokens (see find_anchors) and collate the
+    segments between them independently, using collate_func. The results are
+    stitched back together into a single collation of the whole verse, in the
+    same {'witnesses', 'table'} form as collatex produces.
+
+    @param witnesses: list of {'id', 'content'} dicts, as for collatex
+    @param collate_func: function taking a list of witnesses and returning
+                         their collation
+    @param key: (optional) function returning the key to compare tokens by
+                when looking for anchors
+    """
+    ids = sorted(x['id'] for x in witnesses)
+    tokens = {x['id']: x['content'].split() for x in witnesses}
+    if max((len(x) for x in tokens.values()), default=0) < ANCHOR_MIN_TOKENS:
+        return collate_func(witnesses)
+
+    if key is None:
+        anchors = find_anchors([tokens[x] for x in ids])
+    else:
+        anchors = find_anchors([[key(t) for t in tokens[x]] for x in ids])
+    if not anchors:
+        return collate_func(witnesses)
+
+    logger.debug("Splitting verse at {} anchors".format(len(anchors)))
+    table = []
+    start = [0] * len(ids)
+    for anchor in anchors + [None]:
+        end = anchor if anchor else [len(tokens[x]) for x in ids]
+        segment = [(wit, tokens[wit][s:e]) for wit, s, e in zip(ids, start, end)
+                   if e > s]
+        if len(segment) == 1:
+            # Nothing to align with...
+            wit, seg_tokens = segment[0]
+            table.append([seg_tokens if x == wit else [] for x in ids])
+        elif segment:
+            collation = collate_func([{'id': wit, 'content': ' '.join(seg_tokens)}
+                                      for wit, seg_tokens in segment])
+            for column in collation['table']:
+                cells = dict(zip(collation['witnesses'], column))
+                table.append([cells.get(x, []) for x in ids])
+
+        if anchor:
+            # The anchor itself is a column that every witness agrees on
+            table.append([[tokens[x][p]] for x, p in zip(ids, anchor)])
+            start = [p + 1 for p in anchor]
+
+    return {'witnesses': ids, 'table': table}
+
+
+def cluster_texts(texts, weights):
+    """
+    Cluster the texts by similarity to each cluster's first (and most
+    common) text.
+
+    @param texts: list of distinct texts
+    @param weights: list of the number of witnesses with each text
+    @returns: list of clusters, each a list of indexes into texts
+    """
+    clusters = []
+    for i in sorted(range(len(texts)), key=lambda x: weights[x], reverse=True):
+        scores = [(Levenshtein.ratio(texts[c[0]], texts[i]), c) for c in clusters
+                  if len(c) < MAX_CLUSTER_SIZE]
+        best = max(scores, key=lambda x: x[0], default=None)
+        if best and best[0] >= CLUSTER_SIMILARITY:
+            best[1].append(i)
+        else:
+            clusters.append([i])
+    return clusters
+
+
+def _consensus(table, weights):
+    """
+    Find the consensus of a collation table - the most common (by weight)
+    cell in each column.
+
+    @param table: a collatex table, with one cell per weight
+    @returns: (consensus tokens, [(start, end) index of each column's cell
+              in the consensus, ...])
+    """
+    tokens = []
+    ranges = []
+    for column in table:
+        counts = Counter()
+        for cell, weight in zip(column, weights):
+            counts[tuple(x.strip() for x in cell)] += weight
+        cell = counts.most_common(1)[0][0]
+        ranges.append((len(tokens), len(tokens) + len(cell)))
+        tokens.extend(cell)
+    return tokens, ranges
+
+
+def collate_progressive(witnesses, collate_func, min_texts=PROGRESSIVE_MIN_TEXTS):
+    """
+    Collate a verse with lots of witnesses progressively. Identical texts are
+    only collated once, and similar texts are clustered together and collated
+    separately. The consensus texts of the clusters are then collated, and
+    the result is projected back onto all the witnesses, to give the same
+    {'witnesses', 'table'} form as collatex produces.
+
+    @param witnesses: list of {'id', 'content'} dicts, as for collatex
+    @param collate_func: function taking a list of witnesses and returning
+                         their collation
+    @param min_texts: only cluster verses with at least this many distinct
+                      texts
+    """
+    ids = sorted(x['id'] for x in witnesses)
+    by_text = defaultdict(list)
+    for wit in witnesses:
+        by_text[wit['content']].append(wit['id'])
+    texts = list(by_text)
+    weights = [len(by_text[x]) for x in texts]
+
+    if len(texts) < min_texts:
+        clusters = [list(range(len(texts)))]
+    else:
+        clusters = cluster_texts(texts, weights)
+    logger.debug("Collating {} witnesses as {} texts in {} clusters".format(
+                 len(witnesses), len(texts), len(clusters)))
+
+    # Collate each cluster, and find its consensus
+    cluster_tables = []
+    consensus = []
+    for cluster in clusters:
+        if len(cluster) == 1:
+            table = [[[x]] for x in texts[cluster[0]].split()]
+        else:
+            collation = collate_func([{'id': str(i), 'content': texts[i]} for i in cluster])
+            order = [cluster.index(int(x)) for x in collation['witnesses']]
+            table = [[column[order.index(j)] for j in range(len(cluster))]
+                     for column in collation['table']]
+        cluster_tables.append(table)
+        consensus.append(_consensus(table, [weights[i] for i in cluster]))
+
+    # Collate the consensus texts, and find where each cluster's consensus
+    # tokens ended up.
+    if len(clusters) == 1:
+        positions = [list(range(len(consensus[0][0])))]
+    else:
+        collation = collate_func([{'id': str(c), 'content': ' '.join(consensus[c][0])}
+                                  for c in range(len(clusters)) if consensus[c][0]])
+        positions = [[] for x in clusters]
+        for g, column in enumerate(collation['table']):
+            for c, cell in zip(collation['witnesses'], column):
+                positions[int(c)].extend([g] * len(cell))
+
+    # Project every cluster column onto the overall table. Each overall
+    # column has a slot for its own tokens, and one per cluster for its
+    # insertions (relative to the consensus) after it - so insertions from
+    # different clusters aren't aligned with each other. Slot 0 is for
+    # insertions before everything else. The slots are keyed on (slot,
+    # cluster), with cluster -1 for the columns' own tokens.
+    slots = defaultdict(lambda: defaultdict(list))
+    for c, cluster in enumerate(clusters):
+        slot = 0
+        for column, (start, end) in zip(cluster_tables[c], consensus[c][1]):
+            if end > start:
+                slot = 2 * positions[c][start] + 1
+                target = (slot, -1)
+            else:
+                target = (slot + 1 if slot % 2 else slot, c)
+            for i, cell in zip(cluster, column):
+                slots[target][i].extend(cell)
+
+    text_index = {wit: i for i, x in enumerate(texts) for wit in by_text[x]}
+    table = []
+    for key in sorted(slots):
+        column = [slots[key].get(text_index[wit], []) for wit in ids]
+        if any(column):
+            table.append(column)
+
+    return {'witnesses': ids, 'table': table}
+
+
+def _partition(column):
+    """
+    Return the partition of the witnesses made by a collation table column,
+    as a set of sets of witness indexes - one set per reading.
+    """
+    groups = defaultdict(set)
+    for i, cell in enumerate(column):
+        groups[' '.join(x.strip() for x in cell)].add(i)
+    return set(frozenset(x) for x in groups.values())
+
+
+def merge_variant_units(collation):
+    """
+    Simplify a collation by dropping columns where all the witnesses agree,
+    and merging adjacent columns that divide the witnesses into the same
+    groups. We always keep at least one column, so the verse still has a
+    variant unit.
+    """
+    table = []
+    last = None
+    for column in collation['table']:
+        partition = _partition(column)
+        if len(partition) == 1:
+            # The columns either side of this aren't adjacent any more
+            last = None
+            continue
+        if partition == last:
+            table[-1] = [a + b for a, b in zip(table[-1], column)]
+        else:
+            table.append(column)
+            last = partition
+
+    if not table and collation['table']:
+        # Everything agrees
+        table = [[sum(cells, []) for cells in zip(*collation['table'])]]
+
+    return {'witnesses': collation['witnesses'], 'table': table}
+
+
+def pretokenize(witness):
+    """
+    Convert a {'id', 'content'} witness into collatex's pre-tokenized form,
+    with the regularized spelling of each token as its normalized form, 'n'.
+    """
+    return {'id': witness['id'],
+            'tokens': [{'t': x, 'n': regularize(x)} for x in witness['content'].split()]}
+
+
+def plain_collation(collation):
+    """
+    Collatex gives us back token objects for pre-tokenized witnesses - so
+    convert them back into plain strings of their original text.
+    """
+    collation['table'] = [[[x['t'] if isinstance(x, dict) else x for x in cell]
+                           for cell in column]
+                          for column in collation['table']]
+    return collation
+
+
+def _verse_texts(witnesses, key=lambda x: x.key):
+    """
+    Return {key: text} for all the non-empty texts of a verse's witnesses,
+    which are WitnessRefs.
+    """
+    texts = {}
+    for witness in witnesses:
+        text = WitnessArena.read(witness.text)
+        if text:
+            texts[key(witness)] = text
+    return texts
+
+
+def _verse_witnesses(witnesses):
+    """
+    Return the collatex witnesses for a verse, one per non-empty ms_verse
+    """
+    return [{'id': key, 'content': text} for key, text in
+            _verse_texts(witnesses, key=lambda x: str(x.ms_verse_id)).items()]
+
+
+def collation_cost(n_witnesses, n_tokens):
+    """
+    Estimate the time (seconds) collatex will take to collate n_witnesses
+    witnesses with n_tokens tokens each.
+    """
+    return COLLATEX_REQUEST_COST + COLLATEX_TOKEN_COST * n_witnesses * n_tokens ** 2
+
+
+def _batch_size(verse_texts):
+    """
+    Return (witness keys, number of tokens) of a batch of verse texts, each
+    one a {key: text} dict. The sentinels are included in the token count.
+    """
+    keys = set()
+    n_tokens = len(verse_texts) - 1
+    for texts in verse_texts:
+        keys.update(texts)
+        n_tokens += max([len(x.split()) for x in texts.values()] or [0])
+    return keys, n_tokens
+
+
+def worth_batching(batch, witnesses):
+    """
+    Use our cost model to decide whether it's quicker to add the verse with
+    these witnesses to the batch, or to collate it separately.
+
+    @param batch: list of witness lists, one per verse, already in the batch
+    @param witnesses: list of WitnessRefs for the new verse
+    """
+    if len(batch) >= MAX_BATCH_VERSES:
+        return False
+
+    b_keys, b_tokens = _batch_size([_verse_texts(x) for x in batch])
+    v_keys, v_tokens = _batch_size([_verse_texts(witnesses)])
+    separate = (collation_cost(len(b_keys), b_tokens) +
+                collation_cost(len(v_keys), v_tokens))
+    together = collation_cost(len(b_keys | v_keys), b_tokens + v_tokens + 1)
+    return together < separate
+
+
+def _sentinel(i):
+    """
+    The sentinel token to put after verse i in a batch. These are latin
+    letters, so they won't match any Greek token, and they are far enough
+    apart that they won't fuzzy-match each other.
+    """
+    return string.ascii_lowercase[i] * 8
+
+
+def batch_witnesses(verse_texts):
+    """
+    Make one set of witnesses for a batch of verses, joining each witness's
+    texts with a sentinel token between verses. Every witness gets every
+    sentinel, even if it lacks some of the verses.
+
+    @param verse_texts: list of {key: text} dicts, one per verse
+    """
+    keys = sorted(set(k for texts in verse_texts for k in texts))
+    witnesses = []
+    for key in keys:
+        content = []
+        for i, texts in enumerate(verse_texts):
+            if i:
+                content.append(_sentinel(i - 1))
+            if key in texts:
+                content.append(texts[key])
+        witnesses.append({'id': key, 'content': ' '.join(content)})
+    return witnesses
+
+
+def split_batch(collation, verse_texts):
+    """
+    Split the collation of a batch of verses (see batch_witnesses) at the
+    sentinels, returning a list of collations - one per verse, containing
+    only the witnesses that have that verse.
+
+    Raises ValueError if the sentinels weren't aligned with each other.
+    """
+    tables = [[] for x in verse_texts]
+    current = 0
+    for column in collation['table']:
+        while current < len(verse_texts) - 1:
+            sentinel = _sentinel(current)
+            found = [[x.strip() for x in cell].index(sentinel)
+                     if sentinel in [x.strip() for x in cell] else None
+                     for cell in column]
+            if all(x is None for x in found):
+                break
+            elif any(x is None for x in found):
+                raise ValueError("Sentinel {} isn't aligned".format(current))
+
+            # Split this column at the sentinel
+            tables[current].append([cell[:i] for cell, i in zip(column, found)])
+            column = [cell[i + 1:] for cell, i in zip(column, found)]
+            current += 1
+        tables[current].append(column)
+
+    if current != len(verse_texts) - 1:
+        raise ValueError("Only found {} of {} sentinels".format(current, len(verse_texts) - 1))
+
+    ret = []
+    for table, texts in zip(tables, verse_texts):
+        idx = [i for i, x in enumerate(collation['witnesses']) if x in texts]
+        missing = [i for i, x in enumerate(collation['witnesses']) if x not in texts]
+        if any(column[i] for column in table for i in missing):
+            raise ValueError("Found text for a missing witness")
+        table = [[column[i] for i in idx] for column in table]
+        ret.append({'witnesses': [collation['witnesses'][i] for i in idx],
+                    'table': [column for column in table if any(column)]})
+
+    return ret
+
+
+def same_collation(coll_a, coll_b):
+    """
+    Are these two collations the same, ignoring witness order and
+    whitespace around the tokens?
+    """
+    def per_witness(coll):
+        ret = {}
+        for i, wit in enumerate(coll['witnesses']):
+            ret[wit] = [[x.strip() for x in column[i]] for column in coll['table']]
+        return ret
+
+    return per_witness(coll_a) == per_witness(coll_b)
+
 
 class TimeoutException(Exception):
     pass
@@ -466,11 +1207,13 @@ class CollateXService(object):
         See http://collatex.net/doc/
 
         @param witnesses: Se above
-        @param algorithm: One of the supported algorithms
+        @param algorithm: One of the supported algorithms that the service
+                          runs (not IN_PROCESS_ALGORITHMS)
         @param quiet: don't chat too much
         @param force: do the query even if we don't know that collatex is ready
         """
-        assert algorithm in SUPPORTED_ALGORITHMS
+        assert algorithm in SUPPORTED_ALGORITHMS and algorithm not in IN_PROCESS_ALGORITHMS, \
+            "The collatex service doesn't do {}".format(algorithm)
 
         def timeout_handler(signum, frame):
             raise TimeoutException('Timeout')
@@ -487,7 +1230,9 @@ class CollateXService(object):
 
         input_d = dict(witnesses=witnesses,
                        algorithm=algorithm)
-        if FUZZY_EDIT_DISTANCE:
+        if FUZZY_EDIT_DISTANCE and not any('tokens' in x for x in witnesses):
+            # Pre-tokenized witnesses are already regularized, so they
+            # only need exact matching
             input_d['tokenComparator'] = {"type": "levenshtein",
                                           "distance": FUZZY_EDIT_DISTANCE}
         data = json.dumps(input_d)
@@ -530,7 +1275,7 @@ def collate_python(witnesses, algorithm):
     dekcol = collatex.Collation()
     input_d = dict(witnesses=witnesses,
                    algorithm=algorithm)
-    if FUZZY_EDIT_DISTANCE:
+    if FUZZY_EDIT_DISTANCE and not any('tokens' in x for x in witnesses):
         input_d['tokenComparator'] = {"type": "levenshtein",
                                       "distance": FUZZY_EDIT_DISTANCE}
     collation = dekcol.create_from_dict(input_d)
@@ -543,33 +1288,128 @@ def collate_python(witnesses, algorithm):
     for column in table.columns:
         col = []
         for wit in ret['witnesses']:
-            col.append([str(x) for x in column.tokens_per_witness.get(wit, [])])
+            col.append([x.token_data['t'].strip() for x in column.tokens_per_witness.get(wit, [])])
         ret['table'].append(col)
 
-    print(table)
+    logger.debug("Collation table:\n%s", table)
 
     return ret
 
 
+TEST_WITNESSES = [{'id': '1',
+                   'content': 'This is a test'},
+                  {'id': '2',
+                   'content': 'This is test'},
+                  {'id': '3',
+                   'content': 'This is a testimony'},
+                  {'id': '4',
+                   'content': 'These are tests'},
+                  {'id': '5',
+                   'content': 'This is a a test'}]
+
+
+def python_tests():
+    """
+    Test everything that doesn't need the collatex service
+    """
+    witnesses = TEST_WITNESSES
+    python_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[['This', 'is'], ['This', 'is'], ['This', 'is'], ['These', 'are', 'tests'], ['This', 'is']], [[], [], [], [], ['a']], [['a'], [], ['a'], [], ['a']], [['test'], ['test'], ['testimony'], [], ['test']]]}
+    numpy_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[['This'], ['This'], ['This'], [], ['This']], [['is'], ['is'], ['is'], [], ['is']], [[], [], [], ['These'], ['a']], [['a'], [], ['a'], ['are'], ['a']], [['test'], ['test'], ['testimony'], ['tests'], ['test']]]}
+
+    # Test Python module
+    resp = collate_python(witnesses, 'python')
+    assert resp == python_resp, "Not what I expected...\n{}\n{}".format(resp, python_resp)
+    logger.info("All python tests passed")
+
+    # Test numpy module
+    resp = collate_numpy(witnesses, 'numpy-nw')
+    assert resp == numpy_resp, "Not what I expected...\n{}\n{}".format(resp, numpy_resp)
+    resp = collate_numpy([], 'numpy-nw')
+    assert resp == {'witnesses': [], 'table': []}, "Not what I expected...\n{}".format(resp)
+    logger.info("All numpy tests passed")
+
+    # Test finding anchors - repeated tokens, tokens missing from a witness
+    # and tokens in a different order in another witness aren't anchors
+    for token_lists, expected in (([['a', 'b', 'a', 'c'], ['a', 'b', 'c']], [(1, 1), (3, 2)]),
+                                  ([['x', 'y', 'z'], ['x', 'z']], [(0, 0), (2, 1)]),
+                                  ([['p', 'q', 'r', 's'], ['p', 'r', 'q', 's']],
+                                   [(0, 0), (1, 2), (3, 3)]),
+                                  ([], [])):
+        resp = find_anchors(token_lists)
+        assert resp == expected, "Not what I expected...\n{}\n{}".format(resp, expected)
+    empty_resp = {'witnesses': [], 'table': []}
+    resp = collate_segmented([], lambda x: empty_resp)
+    assert resp == empty_resp, "Not what I expected...\n{}\n{}".format(resp, empty_resp)
+    logger.info("All anchor tests passed")
+
+    # Test micro-batching gives the same as per-verse collation
+    verse_texts = [{x['id']: x['content'] for x in witnesses},
+                   {'1': 'and then more', '2': 'and more', '4': 'then more'},
+                   {'1': 'This is', '3': 'This was'}]
+    resp = split_batch(collate_python(batch_witnesses(verse_texts), 'python'), verse_texts)
+    for texts, batched in zip(verse_texts, resp):
+        single = collate_python([{'id': k, 'content': v} for k, v in texts.items()], 'python')
+        assert same_collation(batched, single), "Batch mismatch...\n{}\n{}".format(batched, single)
+    logger.info("All batching tests passed")
+
+    # Test regularized spellings collate together
+    reg_witnesses = [{'id': '1', 'content': 'και ειπεν αυτοις ις'},
+                     {'id': '2', 'content': 'κε ειπε αυτοις ιησους'}]
+    reg_resp = {'witnesses': ['1', '2'],
+                'table': [[['και', 'ειπεν', 'αυτοις', 'ις'], ['κε', 'ειπε', 'αυτοις', 'ιησους']]]}
+    resp = plain_collation(collate_python([pretokenize(x) for x in reg_witnesses], 'python'))
+    assert resp == reg_resp, "Not what I expected...\n{}\n{}".format(resp, reg_resp)
+    logger.info("All regularization tests passed")
+
+    # Test progressive collation of duplicated texts
+    dup_witnesses = witnesses + [{'id': '6', 'content': 'This is a test'}]
+    resp = collate_progressive(dup_witnesses, lambda x: collate_python(x, 'python'))
+    expected = collate_python(dup_witnesses, 'python')
+    assert same_collation(resp, expected), "Not what I expected...\n{}\n{}".format(resp, expected)
+    # Test progressive collation in clusters - each witness keeps its tokens
+    # in order, and the two clusters' insertions after 'ef' have a column each
+    cluster_witnesses = [{'id': '1', 'content': 'ab cd ef gh ij kl mn op'},
+                         {'id': '2', 'content': 'ab cd ef gh ij kl mn op'},
+                         {'id': '3', 'content': 'ab cd ef XX gh ij kl mn op'},
+                         {'id': '4', 'content': 'ab zz yy ww vv ef gh uu'},
+                         {'id': '5', 'content': 'ab zz yy ww vv ef gh uu'},
+                         {'id': '6', 'content': 'ab zz yy ww vv ef YY gh uu'}]
+    resp = collate_progressive(cluster_witnesses, lambda x: collate_python(x, 'python'), min_texts=2)
+    for i, wit in enumerate(cluster_witnesses):
+        tokens = [x for column in resp['table'] for x in column[i]]
+        assert tokens == wit['content'].split(), "Not what I expected...\n{}\n{}".format(tokens, wit)
+    insertions = [[x for cell in column for x in cell] for column in resp['table']
+                  if ['XX'] in column or ['YY'] in column]
+    assert insertions == [['XX'], ['YY']], "Not what I expected...\n{}".format(resp)
+    logger.info("All progressive tests passed")
+
+    # Test merging variant units
+    merge_resp = {'witnesses': ['1', '2', '3'], 'table': [[['x', 'y'], [], ['x', 'y']], [['z'], ['w'], ['w']]]}
+    resp = merge_variant_units({'witnesses': ['1', '2', '3'],
+                                'table': [[['a'], ['a'], ['a']], [['x'], [], ['x']], [['y'], [], ['y']],
+                                          [['b'], ['b'], ['b']], [['z'], ['w'], ['w']]]})
+    assert resp == merge_resp, "Not what I expected...\n{}\n{}".format(resp, merge_resp)
+    # Columns either side of an invariant one aren't merged
+    split_collation = {'witnesses': ['1', '2', '3'],
+                       'table': [[['x'], [], ['x']], [['a'], ['a'], ['a']], [['y'], [], ['y']]]}
+    split_resp = {'witnesses': ['1', '2', '3'], 'table': [[['x'], [], ['x']], [['y'], [], ['y']]]}
+    resp = merge_variant_units(split_collation)
+    assert resp == split_resp, "Not what I expected...\n{}\n{}".format(resp, split_resp)
+    logger.info("All merge tests passed")
+
+
 def tests(collatex_jar):
     """
-    Collate everything using the collatex service
+    Collate everything using the collatex service - after the tests that
+    don't need it
     """
-    witnesses = [{'id': '1',
-                  'content': 'This is a test'},
-                 {'id': '2',
-                  'content': 'This is test'},
-                 {'id': '3',
-                  'content': 'This is a testimony'},
-                 {'id': '4',
-                  'content': 'These are tests'},
-                 {'id': '5',
-                  'content': 'This is a a test'}]
+    python_tests()
+
+    witnesses = TEST_WITNESSES
 
     # NOTE: This can vary (sometimes) - so if it fails try running it again.
     # Yes... I know...
     dek_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[['This ', 'is '], ['This ', 'is '], ['This ', 'is '], ['These ', 'are '], ['This ', 'is ']], [['a '], [], ['a '], [], ['a ']], [[], [], ['testimony'], [], ['a ']], [['test'], ['test'], [], ['tests'], ['test']]]}
-    python_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[['This', 'is'], ['This', 'is'], ['This', 'is'], ['These', 'are', 'tests'], ['This', 'is']], [[], [], [], [], ['a']], [['a'], [], ['a'], [], ['a']], [['test'], ['test'], ['testimony'], [], ['test']]]}
 
     nw_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[[], [], [], [], ['This ']], [['This '], [], ['This '], [], ['is ']], [['is ', 'a '], ['This ', 'is '], ['is ', 'a '], ['These ', 'are '], ['a ', 'a ']], [['test'], ['test'], ['testimony'], ['tests'], ['test']]]}
     med_resp = {'witnesses': ['1', '2', '3', '4', '5'], 'table': [[[], [], [], [], ['This ']], [['This '], [], ['This '], ['These '], ['is ']], [['is '], ['This '], ['is '], ['are '], ['a ']], [['a '], ['is '], ['a '], [], ['a ']], [['test'], ['test'], ['testimony'], ['tests'], ['test']]]}
@@ -590,11 +1430,6 @@ def tests(collatex_jar):
     finally:
         cx.quit()
 
-    # Tes Python module
-    resp = collate_python(witnesses, 'python')
-    assert resp == python_resp, "Not what I expected...\n{}\n{}".format(resp, python_resp)
-    logger.info("All python tests passed")
-
 
 def _arg(question, default=None):
     """
@@ -628,11 +1463,16 @@ if __name__ == "__main__":
     parser.add_argument('-a', '--algorithm', default='dekker',
                         help='Which algorithm to use? Options are: {}, all'.format(SUPPORTED_ALGORITHMS))
     parser.add_argument('--test', help="Just run tests and exit", default=False, action='store_true')
-    parser.add_argument('collatex_jar', help="Path to the collatex jar file (e.g. ./{})".format(COLLATEX_JAR))
+    parser.add_argument('--python-test', help="Just run the tests that don't need collatex and exit",
+                        default=False, action='store_true')
+    parser.add_argument('collatex_jar', nargs='?', default=COLLATEX_JAR,
+                        help="Path to the collatex jar file (default ./{})".format(COLLATEX_JAR))
     parser.add_argument('-c', '--clean', help="Clean out old colation before adding new",
                         default=False, action='store_true')
     parser.add_argument('-f', '--force', help="Don't ask any questions - just do it!",
                         default=False, action='store_true')
+    parser.add_argument('--dry-run', help="With --clean, just count the old collation and exit",
+                        default=False, action='store_true')
     parser.add_argument('-t', '--timeout', help="How long until we shoot collatex? (default 900 seconds)",
                         default=900, type=int)
     parser.add_argument('-j', '--workers', help="How many parallel workers to use? (default 3)",
@@ -641,17 +1481,37 @@ if __name__ == "__main__":
                         default=7369, type=int)
     parser.add_argument('--chapter', help="Collate only one specific chapter (04:11 => John 11)",
                         default=None)
+    parser.add_argument('--anchors', help="Split long verses at anchor tokens and collate the pieces separately",
+                        default=False, action='store_true')
+    parser.add_argument('--batch', help="Collate consecutive short verses together in one request",
+                        default=False, action='store_true')
+    parser.add_argument('--verify-batches', help="Check batched collations against per-verse collation",
+                        default=False, action='store_true')
+    parser.add_argument('--regularize', help="Align on regularized spellings instead of fuzzy matching",
+                        default=False, action='store_true')
+    parser.add_argument('--progressive', help="Collate clusters of similar texts, then align the clusters",
+                        default=False, action='store_true')
+    parser.add_argument('--merge', help="Drop invariant variant units, and merge adjacent ones that divide "
+                        "the witnesses the same way", default=False, action='store_true')
     args = parser.parse_args()
 
     if args.test:
         logger.info("Running tests...")
         tests(args.collatex_jar)
+    elif args.python_test:
+        logger.info("Running tests...")
+        python_tests()
     else:
         if args.algorithm == 'all':
             algos = SUPPORTED_ALGORITHMS
         else:
             algos = [args.algorithm]
 
+        if args.clean and args.dry_run:
+            for a in algos:
+                drop_all(a, args.chapter, dry_run=True)
+            sys.exit(0)
+
         if args.clean:
             ok = (args.force or
                   _arg("Remove old ({}) collation for {} before continuing?"
@@ -666,6 +1526,7 @@ if __name__ == "__main__":
         for a in algos:
             collate_all(a, chapter_ref=args.chapter, port=args.collatex_port,
                         timeout=args.timeout, workers=args.workers,
-                        collatex_jar=args.collatex_jar)
-
-        print("\n** Don't forget to delete the old picklify data")
+                        collatex_jar=args.collatex_jar, anchors=args.anchors,
+                        batch=args.batch, verify_batches=args.verify_batches,
+                        regularize=args.regularize, progressive=args.progressive,
+                        merge=args.merge)
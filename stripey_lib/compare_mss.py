@@ -35,7 +35,8 @@ def compare(book, chapter, witnesses, hide_identical):
         texts = {}
         output = "{}\n".format(verse)
         for wit in witnesses:
-            readings = MsVerse.objects.filter(verse=verse).filter(hand__manuscript__ga=wit)
+            readings = (MsVerse.objects.filter(verse=verse).filter(hand__manuscript__ga=wit)
+                        .select_related('hand', 'verse_text'))
             for reading in readings:
                 if reading.hand.name == 'firsthand':
                     ref = wit
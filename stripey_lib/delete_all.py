@@ -13,6 +13,7 @@ from stripey_app import models
 
 mods = [models.MsStripe,
         models.MsVerse,
+        models.VerseText,
         models.MsChapter,
         models.MsBook,
         models.Hand,
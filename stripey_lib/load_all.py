@@ -12,6 +12,9 @@ import django
 django.setup()
 
 from stripey_app.models import ManuscriptTranscription, MsBook
+from stripey_app.memoize import memoize
+from stripey_lib.similarity import update_all as update_similarities
+from stripey_lib.text_matrices import update_all as update_text_matrices
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 
@@ -68,6 +71,15 @@ def load_all(folder):
                 failures.append("{} ({})".format(f, e))
                 raise
 
+    logger.info("Working out the similarities of the texts")
+    update_similarities()
+
+    logger.info("Rebuilding the text matrices")
+    update_text_matrices()
+
+    # The web app's cached data is out of date now
+    memoize.invalidate_all()
+
     if failures:
         logger.error("Load failed for: \n{}".format('\n\t'.join(failures)))
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export NEXUS files of the collations in bulk, for SplitsTree and MrBayes.
+
+For each algorithm and book this writes a NEXUS file for every combination
+of range (the whole book, and each chapter), fragmentary threshold, witness
+subset and NEXUS variant - and a NEXUS file of the distances between the
+witnesses for each range, threshold and subset. They go in a folder per
+algorithm, with a manifest.json listing them and how long each one took.
+
+The books' character matrices (see stripey_app/nexus.py) are loaded once,
+before the worker processes are forked - so the workers share them.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import functools
+import multiprocessing
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import Book, Algorithm  # NOQA
+from stripey_app.nexus import SYMBOLS, get_characters  # NOQA
+from stripey_app.memoize import data_generation  # NOQA
+from django.db import connections  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# The default fragmentary thresholds - as offered by nexus.html
+FRAG_OPTIONS = [0, 10, 20]
+
+# {(book num, algorithm name): Characters} - loaded before the workers fork
+_characters = {}
+
+
+def _subset_name(ga_regex):
+    """
+    Return the part of a file name for a witness subset
+    """
+    if not ga_regex:
+        return 'all'
+    return 'ga-' + hashlib.sha224(ga_regex.encode('utf8')).hexdigest()[:8]
+
+
+def _write(path, chunks):
+    """
+    Write the chunks to path, a chunk at a time
+
+    @returns: (size, sha224 hex digest)
+    """
+    myhash = hashlib.sha224()
+    size = 0
+    with open(path + '.tmp', 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            myhash.update(chunk)
+            size += len(chunk)
+    os.replace(path + '.tmp', path)
+    return size, myhash.hexdigest()
+
+
+def export_one(task):
+    """
+    Write the files of one range, fragmentary threshold and witness subset
+
+    @param task: (outdir, book num, book name, algorithm name, chapter num or
+                  None, frag, ga_regex, [variant, ...])
+    @returns: the manifest entries of the files
+    """
+    outdir, bk, book_name, al, ch, frag, ga_regex, variants = task
+    characters = _characters[(bk, al)]
+    stem = os.path.join(al, "{}{}_{}_frag{}".format(book_name.replace(' ', '_'),
+                                                    '_{}'.format(ch) if ch else '',
+                                                    _subset_name(ga_regex), frag))
+    files = [("{}.{}.nex".format(stem, variant), variant,
+              functools.partial(characters.nexus, ch, None, variant, frag, ga_regex))
+             for variant in variants]
+    files.append(("{}.dist.nex".format(stem), None,
+                  functools.partial(characters.distances, ch, None, frag, ga_regex)))
+
+    ret = []
+    for filename, variant, chunks in files:
+        entry = {'file': filename, 'algorithm': al, 'book': bk, 'chapter': ch, 'frag': frag,
+                 'ga_regex': ga_regex, 'variant': variant}
+        start = time.time()
+        try:
+            entry['bytes'], entry['sha224'] = _write(os.path.join(outdir, filename), chunks())
+        except ValueError as e:
+            # e.g. more readings than the variant has symbols
+            logger.warning("Couldn't write {}: {}".format(filename, e))
+            entry['error'] = str(e)
+        entry['seconds'] = round(time.time() - start, 3)
+        ret.append(entry)
+    return ret
+
+
+def export_all(outdir, algorithms=None, book_num=None, frags=FRAG_OPTIONS, ga_regexes=None,
+               variants=('default', ), processes=None):
+    """
+    Export the NEXUS files of every algorithm, book, chapter, fragmentary
+    threshold and witness subset into outdir, with a manifest.json
+
+    @param algorithms: (optional) just do these algorithm names
+    @param book_num: (optional) just do this book
+    @param frags: the fragmentary thresholds (percentages)
+    @param ga_regexes: (optional) the witness subsets, as regular expressions
+                       matched against the GA numbers - the default is all the
+                       witnesses
+    @param variants: the NEXUS variants (see SYMBOLS)
+    @param processes: how many worker processes to use - the default is one
+                      per CPU
+    @returns: the manifest
+    """
+    books = Book.objects.order_by('num')
+    if book_num is not None:
+        books = books.filter(num=book_num)
+    algorithm_objs = Algorithm.objects.order_by('name')
+    if algorithms:
+        algorithm_objs = algorithm_objs.filter(name__in=algorithms)
+
+    tasks = []
+    for algorithm_obj in algorithm_objs:
+        os.makedirs(os.path.join(outdir, algorithm_obj.name), exist_ok=True)
+        for book_obj in books:
+            logger.info("Loading the character matrix of {} ({})".format(book_obj.name,
+                                                                         algorithm_obj.name))
+            characters = get_characters(book_obj.num, algorithm_obj.name)
+            _characters[(book_obj.num, algorithm_obj.name)] = characters
+            # The whole book, and each chapter with any variant units
+            chapters = sorted(set(x[0] for x in characters.verses if x[3] > x[2]))
+            for ch in [None] + chapters:
+                for frag in frags:
+                    for ga_regex in ga_regexes or ['']:
+                        tasks.append((outdir, book_obj.num, book_obj.name, algorithm_obj.name,
+                                      ch, frag, ga_regex, list(variants)))
+
+    logger.info("Exporting {} sets of files".format(len(tasks)))
+    generation = data_generation()
+    started = time.time()
+    # We need to close the database connections before forking new processes
+    # - not that the workers need them. The workers must be forked (not
+    # spawned), to inherit _characters.
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        files = [x for entries in pool.imap(export_one, tasks) for x in entries]
+
+    manifest = {'data_generation': generation,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                'seconds': round(time.time() - started, 3),
+                'processes': processes or os.cpu_count(),
+                'files': files}
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    logger.info("Wrote {} files in {:.1f}s ({} errors)".format(
+                len([x for x in files if 'error' not in x]), manifest['seconds'],
+                len([x for x in files if 'error' in x])))
+    return manifest
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser("Export NEXUS files of every algorithm, chapter, "
+                                     "fragmentary threshold and witness subset")
+    parser.add_argument('outdir', help="Folder to put the files in")
+    parser.add_argument('-a', '--algorithm', action='append',
+                        help="Only do this algorithm (can be repeated)")
+    parser.add_argument('--book', type=int, help="Only do one specific book (04 => John)",
+                        default=None)
+    parser.add_argument('--frag', type=int, nargs='+', default=FRAG_OPTIONS,
+                        help="Fragmentary thresholds, as percentages (default {})".format(
+                            ' '.join(str(x) for x in FRAG_OPTIONS)))
+    parser.add_argument('--ga-regex', action='append',
+                        help="A witness subset - a regular expression to match the GA numbers "
+                        "against, or '' for all of them (can be repeated - default all)")
+    parser.add_argument('--variant', nargs='+', choices=sorted(SYMBOLS), default=['default'],
+                        help="NEXUS variants (default: default)")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="How many worker processes to use (default one per CPU)")
+    args = parser.parse_args()
+
+    for ga_regex in args.ga_regex or []:
+        try:
+            re.compile(ga_regex)
+        except re.error as e:
+            parser.error("Bad --ga-regex {}: {}".format(ga_regex, e))
+
+    export_all(args.outdir, args.algorithm, args.book, args.frag, args.ga_regex,
+               args.variant, args.processes)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process collation algorithm, 'numpy-nw', that needs neither Java nor
+collatex.
+
+Tokens are interned to integers and every witness is aligned against a
+guide witness with Needleman-Wunsch. The score matrices for all the
+witnesses are filled in together, one anti-diagonal at a time, using numpy.
+
+This is a star alignment, not a progressive one: witnesses are only aligned
+with the guide, never with each other. So tokens that aren't in the guide
+aren't aligned with each other - all the witnesses' insertions before a
+guide token share one column, each witness's tokens in its own cell.
+"""
+
+from collections import Counter
+import numpy as np
+
+MATCH_SCORE = 2
+# A mismatch is better than two gaps - so variant readings share a column
+MISMATCH_SCORE = -1
+GAP_SCORE = -1
+
+
+def _tokens(witness):
+    """
+    Return (texts, keys) of the tokens in a witness. Pre-tokenized witnesses
+    are aligned on their normalized form 'n'.
+    """
+    if 'tokens' in witness:
+        return ([x['t'] for x in witness['tokens']],
+                [x.get('n', x['t']) for x in witness['tokens']])
+    else:
+        tokens = witness['content'].split()
+        return tokens, tokens
+
+
+def nw_scores(guide, others):
+    """
+    Fill in the Needleman-Wunsch score matrices for aligning each of the
+    others against the guide.
+
+    @param guide: int array of token ids
+    @param others: 2D int array of token ids, one row per witness, padded
+                   with -1
+    @returns: int array of scores, (witnesses x len(guide)+1 x others' width+1)
+    """
+    n_wits, width = others.shape
+    n = len(guide)
+    scores = np.zeros((n_wits, n + 1, width + 1), dtype=np.int32)
+    scores[:, :, 0] = np.arange(n + 1) * GAP_SCORE
+    scores[:, 0, :] = np.arange(width + 1) * GAP_SCORE
+
+    # Every cell on an anti-diagonal only depends on the previous two, so we
+    # can do each one (for all witnesses) in one go.
+    for d in range(2, n + width + 1):
+        i = np.arange(max(1, d - width), min(n, d - 1) + 1)
+        j = d - i
+        match = np.where(guide[i - 1] == others[:, j - 1], MATCH_SCORE, MISMATCH_SCORE)
+        scores[:, i, j] = np.maximum(scores[:, i - 1, j - 1] + match,
+                                     np.maximum(scores[:, i - 1, j],
+                                                scores[:, i, j - 1]) + GAP_SCORE)
+    return scores
+
+
+def _traceback(scores, guide, other):
+    """
+    Trace back through a score matrix to find the alignment of other
+    against guide.
+
+    @returns: (aligned, inserted) - aligned[g] is the index of the token in
+              other aligned with guide token g (or None), and inserted[g] is
+              a list of indexes of tokens inserted before guide token g (or
+              at the end, for g == len(guide)).
+    """
+    aligned = [None] * len(guide)
+    inserted = [[] for x in range(len(guide) + 1)]
+    i, j = len(guide), len(other)
+    while i > 0 or j > 0:
+        if i > 0 and j > 0:
+            match = MATCH_SCORE if guide[i - 1] == other[j - 1] else MISMATCH_SCORE
+            if scores[i, j] == scores[i - 1, j - 1] + match:
+                i -= 1
+                j -= 1
+                aligned[i] = j
+                continue
+        if i > 0 and scores[i, j] == scores[i - 1, j] + GAP_SCORE:
+            i -= 1
+        else:
+            j -= 1
+            inserted[i].insert(0, j)
+    return aligned, inserted
+
+
+def collate_numpy(witnesses, algorithm='numpy-nw'):
+    """
+    Collate the witnesses, which are in the same form as for collatex, and
+    return the same {'witnesses', 'table'} form that collatex produces.
+    """
+    ids = sorted(x['id'] for x in witnesses)
+    if not ids:
+        return {'witnesses': [], 'table': []}
+    tokens = {x['id']: _tokens(x) for x in witnesses}
+
+    # Intern the tokens, and only align each distinct text once
+    interned = {}
+    texts = {wit: tuple(interned.setdefault(k, len(interned)) for k in tokens[wit][1])
+             for wit in ids}
+    counts = Counter(texts.values())
+    # The guide is the most common text - or the longest if there's a tie
+    guide = max(counts, key=lambda x: (counts[x], len(x)))
+    distinct = list(counts)
+
+    width = max(len(x) for x in distinct)
+    others = np.full((len(distinct), width), -1, dtype=np.int32)
+    for row, text in zip(others, distinct):
+        row[:len(text)] = text
+    guide_arr = np.array(guide, dtype=np.int32)
+    scores = nw_scores(guide_arr, others)
+    alignments = {text: _traceback(scores[k], guide, text)
+                  for k, text in enumerate(distinct)}
+
+    # Every guide token gets a column, with a column for insertions before
+    # each of them (and one at the end).
+    table = []
+    for g in range(len(guide) + 1):
+        insertions = []
+        main = []
+        for wit in ids:
+            aligned, inserted = alignments[texts[wit]]
+            insertions.append([tokens[wit][0][x] for x in inserted[g]])
+            if g < len(guide):
+                main.append([tokens[wit][0][aligned[g]]] if aligned[g] is not None else [])
+        for column in (insertions, main):
+            if any(column):
+                table.append(column)
+
+    return {'witnesses': ids, 'table': table}
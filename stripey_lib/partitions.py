@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-algorithm partitioning of the collation tables.
+
+Every collation table (Variant, Reading, Stripe, StripeReading and MsStripe)
+has an algorithm column. Running this script converts them into PostgreSQL
+declarative list partitions on that column, with one partition per algorithm
+per table. Queries for one algorithm then only touch its partitions, and
+drop_all can truncate an algorithm's partitions instead of deleting its rows.
+
+This needs PostgreSQL 11 or later (so not the 9.4 in the README). The
+primary keys become (id, algorithm_id) - Django still sees id as the primary
+key, which the sequences keep unique - and the foreign keys between
+collation tables are between each algorithm's own partitions.
+
+Without partitioning (or on another database) the functions here do
+nothing, and everything works as before.
+
+A database from before Reading, StripeReading and MsStripe had their
+algorithm columns is converted first (see algorithm_columns.py).
+"""
+
+import os
+import sys
+import logging
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import (Variant, Reading, Stripe, StripeReading,
+                                MsStripe, Algorithm)  # NOQA
+from django.db import connection, transaction  # NOQA
+from stripey_lib import algorithm_columns  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL 11 - for primary keys and foreign keys on partitioned tables
+MIN_SERVER_VERSION = 110000
+# In dependency order
+PARTITIONED_MODELS = (Variant, Reading, Stripe, StripeReading, MsStripe)
+
+
+def query(sql, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def execute(sql, params=None):
+    logger.debug(sql)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def is_partitioned():
+    """
+    Have the collation tables been partitioned?
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    if connection.pg_version < MIN_SERVER_VERSION:
+        # There's no pg_partitioned_table before PostgreSQL 10 - and we
+        # don't partition before 11
+        return False
+    return bool(query("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+                      [Variant._meta.db_table]))
+
+
+def _partition(model, algo_obj):
+    return "{}_{}".format(model._meta.db_table, algo_obj.id)
+
+
+def ensure_partitions(algo_obj):
+    """
+    Make sure each collation table has a partition for this algorithm
+    """
+    if not is_partitioned():
+        return
+
+    for model in PARTITIONED_MODELS:
+        partition = _partition(model, algo_obj)
+        if query("SELECT to_regclass(%s)", [partition])[0][0] is not None:
+            continue
+        execute("CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({})".format(
+                partition, model._meta.db_table, int(algo_obj.id)))
+        execute("ALTER TABLE {} {}".format(partition, ', '.join(
+                "ADD {}".format(x) for x in _partition_constraints(model, algo_obj))))
+
+
+def truncate_partitions(algo_obj):
+    """
+    Remove all the collation data for this algorithm - in one statement, as
+    the partitions reference each other.
+    """
+    execute("TRUNCATE {}".format(', '.join(_partition(model, algo_obj)
+                                          for model in PARTITIONED_MODELS)))
+
+
+def _foreign_key(field, table):
+    return "FOREIGN KEY ({}) REFERENCES {} (id) DEFERRABLE INITIALLY DEFERRED".format(
+        field.column, table)
+
+
+def _constraints(model):
+    """
+    Return the constraints to add to a partitioned table. Foreign keys to
+    other collation tables go on the partitions - see _partition_constraints.
+    """
+    ret = ["PRIMARY KEY (id, algorithm_id)"]
+    if model is StripeReading:
+        ret.append("UNIQUE (stripe_id, reading_id, algorithm_id)")
+
+    for field in model._meta.fields:
+        if field.is_relation and field.related_model not in PARTITIONED_MODELS:
+            ret.append(_foreign_key(field, field.related_model._meta.db_table))
+    return ret
+
+
+def _partition_constraints(model, algo_obj):
+    """
+    Return the constraints to add to one algorithm's partition of a table.
+    Its foreign keys only reference that algorithm's partitions - so they
+    can all be truncated together without touching any others.
+    """
+    ret = ["UNIQUE (id)"]
+    for field in model._meta.fields:
+        if field.is_relation and field.related_model in PARTITIONED_MODELS:
+            ret.append(_foreign_key(field, _partition(field.related_model, algo_obj)))
+    return ret
+
+
+@transaction.atomic
+def partition_tables():
+    """
+    Convert the collation tables into partitioned tables, copying over any
+    existing data.
+    """
+    # The copy needs the tables to have their algorithm columns
+    if algorithm_columns.needs_converting():
+        algorithm_columns.convert()
+
+    algos = list(Algorithm.objects.all())
+
+    # 1. Move the old tables out of the way
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        execute("ALTER TABLE {0} RENAME TO {0}_unpartitioned".format(table))
+
+    # 2. Make the new ones, taking over the old id sequences
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        execute("CREATE TABLE {0} (LIKE {0}_unpartitioned INCLUDING DEFAULTS) "
+                "PARTITION BY LIST (algorithm_id)".format(table))
+        seq = query("SELECT pg_get_serial_sequence(%s, 'id')",
+                    ["{}_unpartitioned".format(table)])[0][0]
+        execute("ALTER SEQUENCE {} OWNED BY {}.id".format(seq, table))
+        execute("ALTER TABLE {} {}".format(table, ', '.join("ADD {}".format(x)
+                                                            for x in _constraints(model))))
+        for field in model._meta.fields:
+            if field.is_relation:
+                execute("CREATE INDEX ON {} ({})".format(table, field.column))
+
+    # 3. Copy the data
+    for algo_obj in algos:
+        ensure_partitions(algo_obj)
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        logger.info("Copying {}".format(table))
+        execute("INSERT INTO {0} SELECT * FROM {0}_unpartitioned".format(table))
+
+    for model in reversed(PARTITIONED_MODELS):
+        execute("DROP TABLE {}_unpartitioned".format(model._meta.db_table))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if connection.vendor != 'postgresql':
+        print("Partitioning needs PostgreSQL - not {}".format(connection.vendor))
+        sys.exit(1)
+    if connection.pg_version < MIN_SERVER_VERSION:
+        print("Partitioning needs PostgreSQL {} or later".format(MIN_SERVER_VERSION // 10000))
+        sys.exit(1)
+    if is_partitioned():
+        print("The collation tables are already partitioned")
+        sys.exit(0)
+
+    print("Partition the collation tables by algorithm? [N/y]")
+    ok = input()
+    if ok.strip().lower() == 'y':
+        partition_tables()
+        print("Done")
+    else:
+        print("Aborting")
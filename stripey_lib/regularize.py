@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Orthographic regularization of Greek tokens for collation.
+
+This maps common spelling variants - nomina sacra, elision, movable nu and
+itacism - to a canonical key, so that collatex can use exact matching on the
+key while the readings keep their original spelling. It expects text that
+has already been through models.strip_accents.
+
+These keys are for alignment only - they are not meant to be readable.
+"""
+
+# Nomina sacra, by contracted form. Nothing in the text marks a nomen sacrum,
+# so contractions that are also ordinary words (ανω, περ, υς) or spellings of
+# them (κε, for και) are left out.
+NOMINA_SACRA = {
+    'ις': 'ιησους', 'ιυ': 'ιησου', 'ιν': 'ιησουν',
+    'χς': 'χριστος', 'χυ': 'χριστου', 'χω': 'χριστω', 'χν': 'χριστον',
+    'θς': 'θεος', 'θυ': 'θεου', 'θω': 'θεω', 'θν': 'θεον',
+    'κς': 'κυριος', 'κυ': 'κυριου', 'κω': 'κυριω', 'κν': 'κυριον',
+    'πνα': 'πνευμα', 'πνς': 'πνευματος', 'πνι': 'πνευματι',
+    'πηρ': 'πατηρ', 'πρς': 'πατρος', 'πρι': 'πατρι', 'πρα': 'πατερα',
+    'ανος': 'ανθρωπος', 'ανου': 'ανθρωπου', 'ανον': 'ανθρωπον',
+    'ανοι': 'ανθρωποι', 'ανων': 'ανθρωπων', 'ανοις': 'ανθρωποις', 'ανους': 'ανθρωπους',
+    'υυ': 'υιου', 'υω': 'υιω', 'υν': 'υιον',
+    'ουνος': 'ουρανος', 'ουνου': 'ουρανου', 'ουνω': 'ουρανω', 'ουνον': 'ουρανον',
+    'ιηλ': 'ισραηλ', 'δαδ': 'δαυιδ', 'ιλημ': 'ιερουσαλημ',
+    'στς': 'σταυρος', 'στυ': 'σταυρου', 'στν': 'σταυρον',
+}
+
+# Elided forms (the apostrophe has already gone), and other forms that
+# depend on the following word
+ELISIONS = {
+    'αλλ': 'αλλα', 'δι': 'δια', 'δ': 'δε', 'τ': 'τε',
+    'κατ': 'κατα', 'καθ': 'κατα', 'μετ': 'μετα', 'μεθ': 'μετα',
+    'παρ': 'παρα', 'απ': 'απο', 'αφ': 'απο', 'υπ': 'υπο', 'υφ': 'υπο',
+    'επ': 'επι', 'εφ': 'επι', 'αντ': 'αντι', 'ανθ': 'αντι',
+    'ουδ': 'ουδε', 'μηδ': 'μηδε',
+    'ουκ': 'ου', 'ουχ': 'ου', 'εξ': 'εκ',
+}
+
+# Words ending in -εν that don't have a movable nu
+FIXED_NU = ('ουδεν', 'μηδεν', 'ενεκεν', 'ενεν')
+
+# Diphthongs whose upsilon isn't itacistic
+DIPHTHONGS = ('ου', 'αυ', 'ευ', 'ηυ')
+# Vowels and diphthongs pronounced (more or less) the same
+VOWELS = {'ει': 'ι', 'οι': 'ι', 'υι': 'ι', 'η': 'ι', 'υ': 'ι',
+          'αι': 'ε', 'ω': 'ο'}
+
+
+def _movable_nu(word):
+    """
+    Remove movable nu from the end of a word
+    """
+    if word.endswith(('σιν', 'ξιν', 'ψιν', 'εστιν')):
+        return word[:-1]
+    if (len(word) > 4 and word.endswith('εν') and
+            not word.endswith('θεν') and word not in FIXED_NU):
+        return word[:-1]
+    return word
+
+
+def _vowels(word):
+    """
+    Regularize the vowels in a word, to remove itacism
+    """
+    ret = []
+    i = 0
+    while i < len(word):
+        pair = word[i:i + 2]
+        if pair in DIPHTHONGS:
+            ret.append(pair)
+            i += 2
+        elif pair in VOWELS:
+            ret.append(VOWELS[pair])
+            i += 2
+        else:
+            ret.append(VOWELS.get(word[i], word[i]))
+            i += 1
+    return ''.join(ret)
+
+
+def regularize(token):
+    """
+    Return the regularized key for a single token
+    """
+    word = token.strip().lower()
+    word = NOMINA_SACRA.get(word, word)
+    word = ELISIONS.get(word, word)
+    word = _movable_nu(word)
+    word = word.replace('ς', 'σ')
+    return _vowels(word)
+
+
+if __name__ == "__main__":
+    for a, b in (('ειπεν', 'ιπε'),
+                 ('ειπε', 'ιπε'),
+                 ('ις', 'ιισουσ'),
+                 ('ιησους', 'ιισουσ'),
+                 ('ανω', 'ανο'),
+                 ('υς', 'ισ'),
+                 ('κε', 'κε'),
+                 ('αλλ', 'αλλα'),
+                 ('ουκ', 'ου'),
+                 ('ουδεν', 'ουδεν'),
+                 ('λεγουσιν', 'λεγουσι'),
+                 ('ημιν', 'ιμιν'),
+                 ('υμιν', 'ιμιν'),
+                 ('εστιν', 'εστι'),
+                 ('αυτου', 'αυτου'),
+                 ('και', 'κε')):
+        assert regularize(a) == b, (a, regularize(a), b)
+    print("All tests passed")
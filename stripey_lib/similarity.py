@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Work out the similarity of every pair of witness texts in each verse, and
+store them as whole percentages (see VerseSimilarity) - so the chapter view
+can look them up instead of working them out for every request.
+
+load_all.py does this after loading, and only verses whose texts have
+changed are redone. Texts without a stored similarity are still worked out
+as they're needed.
+"""
+
+import os
+import sys
+import logging
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import Chapter, Verse, update_similarities  # NOQA
+
+logger = logging.getLogger(__name__)
+
+
+def update_all(chapter_ref=None):
+    """
+    Update the similarity matrices of every verse
+
+    @param chapter_ref: (optional) book:chapter, e.g. 04:11, to do just one chapter
+    @returns: the number of matrices built
+    """
+    chapters = Chapter.objects.select_related('book').order_by('book__num', 'num')
+    if chapter_ref is not None:
+        mubook, muchapter = chapter_ref.split(':')
+        chapters = chapters.filter(book__num=int(mubook), num=int(muchapter))
+
+    total = 0
+    for chapter_obj in chapters:
+        count = update_similarities(Verse.objects.filter(chapter=chapter_obj))
+        if count:
+            logger.info(" > {} {}: {} verses".format(chapter_obj.book.name, chapter_obj.num, count))
+        total += count
+    logger.info("Updated the similarities of {} verses".format(total))
+    return total
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser("Work out the similarities of each verse's texts")
+    parser.add_argument('--chapter', help="Only do one specific chapter (04:11 => John 11)",
+                        default=None)
+    args = parser.parse_args()
+    update_all(args.chapter)
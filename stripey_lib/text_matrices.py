@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rebuild the per-book matrices of which hands have which texts (see
+stripey_app/text_matrix.py).
+
+load_all.py does this after loading. A book whose matrix has never been
+built gets one when it's first needed.
+"""
+
+import os
+import sys
+import logging
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import Book  # NOQA
+from stripey_app.text_matrix import update_text_matrix  # NOQA
+
+logger = logging.getLogger(__name__)
+
+
+def update_all(book_num=None):
+    """
+    Rebuild the matrix of every book
+
+    @param book_num: (optional) just do this book
+    """
+    books = Book.objects.order_by('num')
+    if book_num is not None:
+        books = books.filter(num=book_num)
+
+    for book_obj in books:
+        matrix = update_text_matrix(book_obj)
+        logger.info(" > {}: {} hands, {} verses".format(book_obj.name, len(matrix.hands),
+                                                        len(matrix.verses)))
+
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser("Rebuild the text matrix of each book")
+    parser.add_argument('--book', type=int, help="Only do one specific book (04 => John)",
+                        default=None)
+    args = parser.parse_args()
+    update_all(args.book)
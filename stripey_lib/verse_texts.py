@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Convert a database from before VerseText, when every MsVerse had its own
+copy of its text in a raw_text column.
+
+The distinct texts are copied into the VerseText table, each MsVerse is
+pointed at its text, and the raw_text column is dropped. The collation
+snapshots are updated to match, and the caches invalidated.
+
+This works on PostgreSQL and on SQLite 3.35 or later (for DROP COLUMN).
+"""
+
+import os
+import sys
+import json
+import logging
+
+if __name__ == "__main__":
+    # Sort out the paths so we can import the django stuff
+    sys.path.append('../stripey_dj/')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'stripey_dj.settings'
+
+    import django
+    django.setup()
+
+from stripey_app.models import MsVerse, VerseText, CollationSnapshot, normalize_text  # NOQA
+from stripey_app.memoize import memoize  # NOQA
+from django.db import connection, transaction  # NOQA
+
+logger = logging.getLogger(__name__)
+
+# How many VerseTexts to insert at a time
+BATCH_SIZE = 1000
+
+
+def query(sql, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def execute(sql, params=None):
+    logger.debug(sql)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def needs_converting():
+    """
+    Does MsVerse still have its raw_text column?
+    """
+    with connection.cursor() as cursor:
+        columns = connection.introspection.get_table_description(cursor, MsVerse._meta.db_table)
+    return 'raw_text' in [x.name for x in columns]
+
+
+def _convert_snapshots(text_ids):
+    """
+    Swap the raw_text of the MsVerses in the collation snapshots for
+    verse_text_id.
+
+    @param text_ids: {raw text: VerseText id}
+    """
+    for snapshot_id, data in CollationSnapshot.objects.values_list('id', 'data'):
+        data = json.loads(data)
+        for stripe, readings, ms_stripes in data['stripes']:
+            for ms_stripe, ms_verse, hand, ms in ms_stripes:
+                ms_verse['verse_text_id'] = text_ids[ms_verse.pop('raw_text')]
+        CollationSnapshot.objects.filter(id=snapshot_id).update(data=json.dumps(data))
+
+
+@transaction.atomic
+def convert():
+    """
+    Move the texts of the MsVerses into the VerseText table
+    """
+    ms_verse_table = MsVerse._meta.db_table
+    text_table = VerseText._meta.db_table
+
+    # 1. Make the VerseText table, if syncdb hasn't already
+    if text_table not in connection.introspection.table_names():
+        with connection.schema_editor() as editor:
+            editor.create_model(VerseText)
+
+    # 2. Copy in the distinct texts
+    raw_texts = [x[0] for x in query("SELECT DISTINCT raw_text FROM {}".format(ms_verse_table))]
+    logger.info("Copying {} distinct texts".format(len(raw_texts)))
+    VerseText.objects.bulk_create([VerseText(hash=VerseText.text_hash(x), raw=x,
+                                             normalized=normalize_text(x))
+                                   for x in raw_texts], batch_size=BATCH_SIZE)
+
+    # 3. Point each MsVerse at its text
+    logger.info("Updating {}".format(ms_verse_table))
+    execute("ALTER TABLE {} ADD COLUMN verse_text_id integer NULL".format(ms_verse_table))
+    execute("CREATE INDEX verse_text_raw_tmp ON {} (raw)".format(text_table))
+    execute("UPDATE {0} SET verse_text_id = (SELECT id FROM {1} WHERE {1}.raw = {0}.raw_text)"
+            .format(ms_verse_table, text_table))
+    execute("DROP INDEX verse_text_raw_tmp")
+    execute("ALTER TABLE {} DROP COLUMN raw_text".format(ms_verse_table))
+    execute("CREATE INDEX {0}_verse_text_id ON {0} (verse_text_id)".format(ms_verse_table))
+    if connection.vendor == 'postgresql':
+        # SQLite can't add these to an existing column
+        execute("ALTER TABLE {} ALTER COLUMN verse_text_id SET NOT NULL".format(ms_verse_table))
+        execute("ALTER TABLE {} ADD FOREIGN KEY (verse_text_id) REFERENCES {} (id) "
+                "DEFERRABLE INITIALLY DEFERRED".format(ms_verse_table, text_table))
+
+    # 4. The collation snapshots have copies of the MsVerses
+    logger.info("Updating the collation snapshots")
+    _convert_snapshots(dict(VerseText.objects.values_list('raw', 'id')))
+
+    memoize.invalidate_all()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not needs_converting():
+        print("The verse texts are already in the VerseText table")
+        sys.exit(0)
+
+    print("Move the verse texts into the VerseText table? [N/y]")
+    ok = input()
+    if ok.strip().lower() == 'y':
+        convert()
+        print("Done")
+    else:
+        print("Aborting")